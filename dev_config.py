@@ -2,4 +2,38 @@ DEBUG = True
 
 SECRET_KEY = 'pleasedontusethisinsprod'
 
+# Keys the stored digests of DynDNS keys. Must never change, as clients can't be found by their
+# key after it has changed. Unlike the SECRET_KEY it's not used for sessions, so it doesn't need
+# to be rotated.
+DYNDNS_DIGEST_KEY = 'pleasedontusethisinprodeither'
+
 SQLALCHEMY_DATABASE_URI = 'sqlite:///db.sqlite'
+
+# Connection pool settings, not used for SQLite. Unset values use the SQLAlchemy defaults.
+# DATABASE_POOL_SIZE = 5
+# DATABASE_MAX_OVERFLOW = 10
+# DATABASE_POOL_TIMEOUT = 30
+# DATABASE_POOL_RECYCLE = 3600
+# Check that connections are alive before using them
+# DATABASE_POOL_PRE_PING = False
+
+# Applied to each new SQLite connection, set to None to keep the SQLite default
+# SQLITE_JOURNAL_MODE = 'WAL'
+# SQLITE_SYNCHRONOUS = 'NORMAL'
+# SQLITE_MMAP_SIZE = 256*2**20
+# SQLITE_BUSY_TIMEOUT_MS = 5000
+
+# Applied to each new PostgreSQL connection, set to None to keep the server default
+# POSTGRES_STATEMENT_TIMEOUT_MS = 30000
+
+# Read-only replica used for GET requests. For a while after a change is redirected, the client
+# reads from the primary instead to see its own change.
+# SQLALCHEMY_REPLICA_DATABASE_URI = 'sqlite:///replica.sqlite'
+# REPLICA_READ_YOUR_WRITES_SECONDS = 10
+
+# Journal record changes per serial, for `GET /domains/<id>/changes?since=<serial>`. Run
+# `poff init` to create the journal table before enabling it, and `poff prune-changes`
+# periodically, e.g. daily from cron, to delete changes older than the retention. Nothing is
+# pruned otherwise.
+# CHANGE_JOURNAL = False
+# CHANGE_JOURNAL_RETENTION_DAYS = 30
@@ -1,13 +1,18 @@
 from flask import Flask, request
-from flask_sqlalchemy import SQLAlchemy
+from flask.sessions import SecureCookieSessionInterface
 from logging import getLogger
+import atexit
 import textwrap
 
 from ._version import __version__
+from .cache import TTLCache
+from .database import TunedSQLAlchemy, read_your_writes, set_config_defaults
+from .ratelimit import Counters, TokenBucketLimiter
+from .writebehind import WriteBehindQueue
 
 _logger = getLogger('poff')
 
-db = SQLAlchemy()
+db = TunedSQLAlchemy()
 
 def create_app(config_file=None):
     app = Flask('poff')
@@ -17,12 +22,52 @@ def create_app(config_file=None):
         app.config.from_envvar('POFF_CONFIG_FILE')
 
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    if not app.config.get('DYNDNS_DIGEST_KEY'):
+        raise ValueError('DYNDNS_DIGEST_KEY must be set in the config file, see dev_config.py')
+    set_config_defaults(app.config)
+    app.config.setdefault('DYNDNS_STATELESS', True)
+    app.config.setdefault('DYNDNS_CACHE_SIZE', 10000)
+    app.config.setdefault('DYNDNS_CACHE_TTL', 60)
+    app.config.setdefault('DYNDNS_NEGATIVE_CACHE_SIZE', 10000)
+    app.config.setdefault('DYNDNS_NEGATIVE_CACHE_TTL', 300)
+    app.config.setdefault('DYNDNS_RATE_LIMIT_RATE', 0.1)
+    # Disabled unless a burst is set
+    app.config.setdefault('DYNDNS_RATE_LIMIT_BURST', 0)
+    app.config.setdefault('DYNDNS_WRITE_BEHIND', False)
+    app.config.setdefault('DYNDNS_WRITE_BEHIND_INTERVAL_MS', 100)
+    app.config.setdefault('DYNDNS_WRITE_BEHIND_QUEUE_SIZE', 10000)
+    app.config.setdefault('CHANGE_JOURNAL', False)
+    app.config.setdefault('CHANGE_JOURNAL_RETENTION_DAYS', 30)
+
+    app.session_interface = _SessionInterface()
 
     db.init_app(app)
 
-    from . import views
+    # Caches the content of DynDNS records by record name and key digest, to answer updates that
+    # doesn't change anything without hitting the database
+    app.extensions['poff_dyndns_cache'] = TTLCache(app.config['DYNDNS_CACHE_SIZE'],
+        app.config['DYNDNS_CACHE_TTL'])
+    # Caches record names that doesn't have a DynDNS client
+    app.extensions['poff_dyndns_negative_cache'] = TTLCache(
+        app.config['DYNDNS_NEGATIVE_CACHE_SIZE'], app.config['DYNDNS_NEGATIVE_CACHE_TTL'])
+    app.extensions['poff_dyndns_limiter'] = TokenBucketLimiter(
+        app.config['DYNDNS_RATE_LIMIT_RATE'], app.config['DYNDNS_RATE_LIMIT_BURST'])
+    app.extensions['poff_dyndns_counters'] = Counters()
+    # Batches DynDNS updates into one transaction per interval
+    app.extensions['poff_dyndns_write_behind'] = None
+    if app.config['DYNDNS_WRITE_BEHIND']:
+        write_behind = WriteBehindQueue(app, app.config['DYNDNS_WRITE_BEHIND_INTERVAL_MS'] / 1000.0,
+            app.config['DYNDNS_WRITE_BEHIND_QUEUE_SIZE'])
+        app.extensions['poff_dyndns_write_behind'] = write_behind
+        atexit.register(write_behind.stop)
+
+    from . import api, views
 
     app.register_blueprint(views.mod)
+    app.register_blueprint(api.mod)
+
+    if app.config['SQLALCHEMY_REPLICA_DATABASE_URI']:
+        app.after_request(read_your_writes)
 
     @app.teardown_appcontext
     def teardown_appcontext(error):
@@ -63,6 +108,15 @@ def create_app(config_file=None):
 
     return app
 
+class _SessionInterface(SecureCookieSessionInterface):
+    """ Skips loading the session for DynDNS updates in stateless mode. """
+
+    def open_session(self, app, request):
+        if app.config['DYNDNS_STATELESS'] and request.path == '/update-record':
+            return self.make_null_session(app)
+        return super(_SessionInterface, self).open_session(app, request)
+
+
 def generic_error_handler(exception):
     """ Log exception to the standard logger. """
     log_msg = textwrap.dedent("""Error occured.
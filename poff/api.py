@@ -0,0 +1,214 @@
+from . import db
+from .models import (Domain, DomainSummary, DynDNSClient, Record, _RECORD_TYPES,
+    bulk_insert_records, invalidate_dyndns_cache, journal_changes, mark_zone_changed, reverse_name)
+from .zonefile import ZoneFileError, import_zone
+
+from flask import abort, current_app, jsonify, request, Blueprint
+from logging import getLogger
+import io
+
+_logger = getLogger('poff.api')
+
+mod = Blueprint('api', __name__, url_prefix='/api/v1')
+
+# Upper bound of ids per IN clause, to stay below the bound parameter limit of SQLite
+_CHUNK_SIZE = 500
+
+_RECORD_FIELDS = ('name', 'type', 'content', 'ttl', 'prio', 'disabled')
+
+
+class ChangesetError(Exception):
+    pass
+
+
+@mod.errorhandler(400)
+@mod.errorhandler(404)
+def api_error(error):
+    return jsonify(errors=[error.description]), error.code
+
+
+@mod.errorhandler(ChangesetError)
+def changeset_error(error):
+    return jsonify(errors=error.args[0]), 400
+
+
+@mod.errorhandler(ZoneFileError)
+def zone_file_error(error):
+    # Parts of the zone may have been inserted already
+    db.session.rollback()
+    return jsonify(errors=[str(error)]), 400
+
+
+@mod.route('/dyndns/stats')
+def dyndns_stats():
+    """ Counters of DynDNS update outcomes and cache sizes for this process, for monitoring. """
+    extensions = current_app.extensions
+    return jsonify(
+        counters=extensions['poff_dyndns_counters'].as_dict(),
+        cache_size=len(extensions['poff_dyndns_cache']),
+        negative_cache_size=len(extensions['poff_dyndns_negative_cache']),
+    )
+
+
+@mod.route('/zones')
+def zones():
+    domains = Domain.query.order_by(Domain.name).all()
+    return jsonify(zones=[{
+        'id': summary.id,
+        'name': summary.name,
+        'serial': summary.serial,
+        'record_count': summary.record_count,
+    } for summary in DomainSummary.load(domains)])
+
+
+@mod.route('/zones/import', methods=['POST'])
+def zone_import():
+    """ Create a zone from a BIND zone file in the request body.
+
+    The file is parsed as it's read, and must start with the SOA record of the zone. The origin of
+    relative names before any $ORIGIN directive can be given by the `origin` query parameter.
+    """
+    lines = io.TextIOWrapper(request.stream, encoding='utf-8')
+    domain, count = import_zone(lines, request.args.get('origin'))
+    db.session.commit()
+    _logger.info('Imported %d records into %s', count, domain.name)
+    return jsonify(id=domain.id, name=domain.name, record_count=count), 201
+
+
+@mod.route('/zones/<int:domain_id>/records')
+def zone_records(domain_id):
+    domain = Domain.query.get_or_404(domain_id)
+    return jsonify(records=[record_json(record) for record in domain.records])
+
+
+@mod.route('/zones/<int:domain_id>/records', methods=['POST'])
+def zone_changeset(domain_id):
+    """ Apply a changeset of record creates, updates and deletes in one transaction.
+
+    The body is a JSON object like `{"create": [{"name": .., "type": .., "content": ..}],
+    "update": [{"id": .., "content": ..}], "delete": [<id>, ..]}`, where all keys are optional.
+    SOA records can't be changed through a changeset.
+    """
+    domain = Domain.query.get_or_404(domain_id)
+    changeset = request.get_json(silent=True)
+    if not isinstance(changeset, dict):
+        abort(400, 'Expected a JSON object')
+
+    for operation in ('create', 'update', 'delete'):
+        if not isinstance(changeset.get(operation, []), list):
+            raise ChangesetError(['%s: Expected a list' % operation])
+    creates = [_parse_record(record, index, 'create')
+        for index, record in enumerate(changeset.get('create', []))]
+    updates = [_parse_record(record, index, 'update', partial=True)
+        for index, record in enumerate(changeset.get('update', []))]
+    deletes = changeset.get('delete', [])
+    if not all(_is_integer(record_id) for record_id in deletes):
+        raise ChangesetError(['delete: Expected a list of record ids'])
+
+    _check_zone_records(domain_id, [record['id'] for record in updates] + deletes)
+
+    for record in creates:
+        record['domain_id'] = domain_id
+    bulk_insert_records(domain_id, creates)
+    db.session.bulk_update_mappings(Record, updates)
+    journal_changes(domain_id, 'update', [record['id'] for record in updates])
+    journal_changes(domain_id, 'delete', deletes)
+    for chunk in _chunks(deletes):
+        DynDNSClient.query.filter(DynDNSClient.record_id.in_(chunk))\
+            .delete(synchronize_session=False)
+        Record.query.filter(Record.id.in_(chunk)).delete(synchronize_session=False)
+    if creates or updates or deletes:
+        mark_zone_changed(domain_id)
+    invalidate_dyndns_cache(record_ids=[record['id'] for record in updates] + deletes)
+    db.session.commit()
+
+    _logger.info('Applied changeset to %s: %d created, %d updated, %d deleted', domain.name,
+        len(creates), len(updates), len(deletes))
+    return jsonify(
+        created=len(creates),
+        updated=len(updates),
+        deleted=len(deletes),
+        serial=domain.soa_record.serial,
+    )
+
+
+def record_json(record):
+    return {
+        'id': record.id,
+        'name': record.name,
+        'type': record.type,
+        'content': record.content,
+        'ttl': record.ttl,
+        'prio': record.prio,
+        'disabled': record.disabled,
+    }
+
+
+def _parse_record(record, index, operation, partial=False):
+    """ Validate a record from a changeset and turn it into a mapping of column values. """
+    def error(message):
+        return ChangesetError(['%s[%d]: %s' % (operation, index, message)])
+
+    if not isinstance(record, dict):
+        raise error('Expected an object')
+
+    mapping = {}
+    if partial:
+        if not _is_integer(record.get('id')):
+            raise error('id is required')
+        mapping['id'] = record['id']
+    else:
+        for field in ('name', 'type', 'content'):
+            if not record.get(field):
+                raise error('%s is required' % field)
+
+    for field in _RECORD_FIELDS:
+        if field in record:
+            mapping[field] = record[field]
+
+    for field in ('name', 'type', 'content'):
+        if field in mapping and not isinstance(mapping[field], str):
+            raise error('%s must be a string' % field)
+    for field in ('ttl', 'prio'):
+        if mapping.get(field) is not None and not _is_integer(mapping[field]):
+            raise error('%s must be an integer' % field)
+    if 'disabled' in mapping and not isinstance(mapping['disabled'], bool):
+        raise error('disabled must be a boolean')
+    if 'type' in mapping and mapping['type'] not in _RECORD_TYPES:
+        raise error('Unsupported record type %s' % mapping['type'])
+    if mapping.get('type') == 'SOA':
+        raise error("SOA records can't be changed through changesets")
+
+    if 'name' in mapping:
+        mapping['reverse_name'] = reverse_name(mapping['name'])
+    if not partial:
+        mapping.setdefault('ttl', 3600)
+        mapping.setdefault('disabled', False)
+        # Ensure MX records always has a prio, like the form does
+        if mapping['type'] == 'MX':
+            mapping['prio'] = mapping.get('prio') or 0
+    return mapping
+
+
+def _is_integer(value):
+    # JSON booleans are decoded as bool, which is a subclass of int
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _check_zone_records(domain_id, record_ids):
+    """ Ensure all the given records exist in the zone, and none of them are SOA records. """
+    found = set()
+    for chunk in _chunks(list(set(record_ids))):
+        found.update(record_id for record_id, in db.session.query(Record.id)\
+            .filter(Record.id.in_(chunk))\
+            .filter(Record.domain_id == domain_id)\
+            .filter(Record.type != 'SOA'))
+    missing = sorted(set(record_ids) - found)
+    if missing:
+        raise ChangesetError(['No record with id %d in this zone' % record_id
+            for record_id in missing])
+
+
+def _chunks(values):
+    for start in range(0, len(values), _CHUNK_SIZE):
+        yield values[start:start + _CHUNK_SIZE]
@@ -1,21 +1,8 @@
 import math
 import string
-import sys
 
 ALPHABET = string.digits + string.ascii_letters
-PY2 = sys.version_info[0] == 2
-
-if PY2:
-    def ord_byte(char):
-        return ord(char)
-else:
-    def ord_byte(byte):
-        return byte
-
-
-def ceildiv(dividend, divisor):
-    ''' integer ceiling division '''
-    return (dividend + divisor - 1) // divisor
+BASE = len(ALPHABET)
 
 
 def calc_chunklen(alph_len):
@@ -32,50 +19,59 @@ def calc_chunklen(alph_len):
     return binlen, int(enclen)
 
 
-def encode(digest):
-    chunklen = calc_chunklen(len(ALPHABET))
-    nchunks = ceildiv(len(digest), chunklen[0])
-    binstr = digest.ljust(nchunks * chunklen[0], b'\0')
+# The chunk geometry only depends on the alphabet, thus compute it once
+BINARY_CHUNK_LENGTH, ENCODED_CHUNK_LENGTH = calc_chunklen(BASE)
 
-    return ''.join([
-            _encode_chunk(binstr, i) for i in range(0, nchunks)
-        ])
+# Every two-digit combination, to emit two digits per lookup
+_DIGIT_PAIRS = [a + b for a in ALPHABET for b in ALPHABET]
+_PAIR_BASE = BASE**2
+_DIGIT_VALUES = dict((digit, value) for value, digit in enumerate(ALPHABET))
 
-def _encode_chunk(data, index):
-    '''
-    gets a chunk from the input data, converts it to a number and
-    encodes that number
-    '''
-    chunk = _get_chunk(data, index)
-    return _encode_long(_chunk_to_long(chunk))
 
+def encode(digest):
+    padding = -len(digest) % BINARY_CHUNK_LENGTH
+    binstr = digest + b'\0' * padding
 
-def _encode_long(val):
-    '''
-    encodes an integer of 8*chunklen[0] bits using the specified
-    alphabet
-    '''
-    chunklen = calc_chunklen(len(ALPHABET))
     return ''.join([
-            ALPHABET[(val//len(ALPHABET)**i) % len(ALPHABET)]
-            for i in reversed(range(chunklen[1]))
+            _encode_long(int.from_bytes(binstr[i:i + BINARY_CHUNK_LENGTH], 'big'))
+            for i in range(0, len(binstr), BINARY_CHUNK_LENGTH)
         ])
 
 
-def _chunk_to_long(chunk):
+def decode(encoded):
     '''
-    parses a chunk of bytes to integer using big-endian representation
+    decodes a string created by `encode` back to bytes.
+
+    Note that the encoded chunks can't represent every value of a binary
+    chunk, thus the high digit of chunks above that range has wrapped around
+    during encoding. Decoding gives the lowest value matching the digits, which
+    means that `encode(decode(s)) == s` always holds, but `decode(encode(b))`
+    can differ from `b`. The output includes any padding added by `encode`.
     '''
-    chunklen = calc_chunklen(len(ALPHABET))
-    return sum([
-            256**(chunklen[0]-1-i) * ord_byte(chunk[i])
-            for i in range(chunklen[0])
-        ])
+    if len(encoded) % ENCODED_CHUNK_LENGTH:
+        raise ValueError('Encoded length must be a multiple of %d' % ENCODED_CHUNK_LENGTH)
 
+    chunks = []
+    for i in range(0, len(encoded), ENCODED_CHUNK_LENGTH):
+        val = 0
+        for digit in encoded[i:i + ENCODED_CHUNK_LENGTH]:
+            try:
+                val = val * BASE + _DIGIT_VALUES[digit]
+            except KeyError:
+                raise ValueError('Invalid base62 digit: %r' % digit)
+        chunks.append(val.to_bytes(BINARY_CHUNK_LENGTH, 'big'))
+    return b''.join(chunks)
 
-def _get_chunk(data, index):
+
+def _encode_long(val):
     '''
-    partition the data into chunks and retrieve the chunk at the given index
+    encodes an integer of 8*BINARY_CHUNK_LENGTH bits using the alphabet,
+    two digits at a time. Digits beyond ENCODED_CHUNK_LENGTH are dropped.
     '''
-    chunklen = calc_chunklen(len(ALPHABET))
-    return data[index*chunklen[0]:(index+1)*chunklen[0]]
+    digits = []
+    for _ in range(ENCODED_CHUNK_LENGTH // 2):
+        val, pair = divmod(val, _PAIR_BASE)
+        digits.append(_DIGIT_PAIRS[pair])
+    if ENCODED_CHUNK_LENGTH % 2:
+        digits.append(ALPHABET[val % BASE])
+    return ''.join(reversed(digits))
@@ -0,0 +1,66 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+class TTLCache(object):
+    """ A thread safe, size bounded LRU cache where entries expire after `ttl` seconds.
+
+    Entries can be tagged when set, to be able to invalidate all entries with a given tag.
+    A max size of 0 disables the cache.
+    """
+
+    def __init__(self, max_size, ttl, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._tagged_keys = {}
+        self._lock = threading.Lock()
+
+
+    def get(self, key):
+        """ Get the value of a key, or None if not cached or expired. """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value, _ = entry
+            if expires <= self.clock():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+
+    def set(self, key, value, tags=()):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (self.clock() + self.ttl, value, tags)
+            for tag in tags:
+                self._tagged_keys.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+
+    def invalidate(self, tag):
+        """ Remove all entries with the given tag. """
+        with self._lock:
+            for key in list(self._tagged_keys.get(tag, ())):
+                self._remove(key)
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def _remove(self, key):
+        _, _, tags = self._entries.pop(key)
+        for tag in tags:
+            keys = self._tagged_keys[tag]
+            keys.discard(key)
+            if not keys:
+                del self._tagged_keys[tag]
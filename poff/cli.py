@@ -1,12 +1,28 @@
 from  . import create_app, db
-from .models import DynDNSClient
+from .journal import ChangesPrunedError, change_json, changes_since, prune_changes
+from .models import (Domain, DomainMeta, DynDNSClient, Record, RecordChange, TsigKey,
+    reverse_name)
+from .database import engine_info
+from .dyndnsserver import DynDNSServer
+from .server import PreforkServer
+from .zonefile import EXPORT_FORMATS, ZoneFileError, export_zone, import_zone
+from .zonesync import ZoneSyncError, apply_diff, diff_zone, load_zone
 
 import argparse
+import json
 import logging.config
+import sys
 import yaml
-from sqlalchemy.schema import CreateTable
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateIndex, CreateTable
 
 
+# Models with indexes used by poff's queries, checked by `poff indexes`
+_INDEXED_MODELS = (Domain, DomainMeta, TsigKey, Record, DynDNSClient, RecordChange)
+
+# Columns poff has added to existing tables, which `poff init` adds if they're missing
+_ADDED_COLUMNS = (Record.__table__.c.reverse_name, DynDNSClient.__table__.c.key_digest)
+
 _CONFIG_FILE_PARSER = argparse.ArgumentParser(add_help=False)
 
 _CONFIG_FILE_PARSER.add_argument('-c', '--config-file',
@@ -25,6 +41,16 @@ def cli_entry():
 
     add_init_parser(subparser)
     add_serve_parser(subparser)
+    add_serve_dyndns_parser(subparser)
+    add_backfill_digests_parser(subparser)
+    add_backfill_reverse_names_parser(subparser)
+    add_db_info_parser(subparser)
+    add_indexes_parser(subparser)
+    add_import_zone_parser(subparser)
+    add_export_zone_parser(subparser)
+    add_apply_parser(subparser)
+    add_changes_parser(subparser)
+    add_prune_changes_parser(subparser)
 
     args = parser.parse_args()
     args.target(args)
@@ -56,39 +82,500 @@ def add_serve_parser(subparser):
         metavar='<log-config-file>',
         help='Path to a YAML file to load logging config from.',
     )
+    parser.add_argument('-w', '--workers',
+        metavar='<workers>',
+        type=int,
+        help='Run a pre-forking server with this many worker processes, instead of the ' +
+        'single process development server.',
+    )
+    parser.add_argument('--max-requests',
+        metavar='<max-requests>',
+        type=int,
+        default=0,
+        help='Restart a worker after it has handled this many requests, 0 to never restart ' +
+        'them. Default: %(default)s',
+    )
 
     parser.set_defaults(target=serve)
 
 
+def add_serve_dyndns_parser(subparser):
+    """ Add the parser for the `serve-dyndns` command. """
+    parser = subparser.add_parser('serve-dyndns',
+        help='Run a lightweight server for DynDNS updates only',
+        parents=[_CONFIG_FILE_PARSER],
+    )
+    parser.add_argument('-H', '--host',
+        metavar='<host>',
+        default='127.0.0.1',
+        help='Which address to listen to. Default: %(default)s',
+    )
+    parser.add_argument('-p', '--port',
+        metavar='<port>',
+        type=int,
+        default=5354,
+        help='Which port to bind to. Default: %(default)s',
+    )
+    parser.add_argument('-t', '--threads',
+        metavar='<threads>',
+        type=int,
+        default=10,
+        help='How many threads to access the database from, which limits the number of ' +
+        'database connections. Default: %(default)s',
+    )
+    parser.add_argument('--idle-timeout',
+        metavar='<seconds>',
+        type=float,
+        default=60,
+        help='Close keep-alive connections after being idle this long. Default: %(default)s',
+    )
+    parser.add_argument('-l', '--log-config',
+        metavar='<log-config-file>',
+        help='Path to a YAML file to load logging config from.',
+    )
+    parser.set_defaults(target=serve_dyndns, debug=False)
+
+
 def add_init_parser(subparser):
     """ Add the `init` command parser. """
     parser = subparser.add_parser('init',
-        help='Create the database tables',
+        help='Create the database tables, and add the columns poff needs to existing tables',
         parents=[_CONFIG_FILE_PARSER],
     )
     parser.add_argument('-p', '--print',
         action='store_true',
-        help='Print the table creation SQL instead of executing it. The SQL assumes that the ' +
-        'rest of the tables has already been created.',
+        help='Print the table and index creation SQL instead of executing it. The SQL assumes ' +
+        'that the rest of the tables has already been created.',
+    )
+    parser.add_argument('-i', '--indexes',
+        action='store_true',
+        help='Only create the missing indexes on the existing tables.',
     )
     parser.set_defaults(target=init)
 
 
+def add_indexes_parser(subparser):
+    """ Add the `indexes` command parser. """
+    parser = subparser.add_parser('indexes',
+        help='Check for or create missing indexes used by poff',
+    )
+    index_subparser = parser.add_subparsers(title='index action',
+        help='Action to be performed',
+    )
+    check_parser = index_subparser.add_parser('check',
+        help='List the missing indexes, exits with status 1 if any are missing',
+        parents=[_CONFIG_FILE_PARSER],
+    )
+    check_parser.set_defaults(target=check_indexes)
+    create_parser = index_subparser.add_parser('create',
+        help='Create the missing indexes',
+        parents=[_CONFIG_FILE_PARSER],
+    )
+    create_parser.add_argument('-p', '--print',
+        action='store_true',
+        help='Print the index creation SQL instead of executing it.',
+    )
+    create_parser.set_defaults(target=create_indexes)
+
+
+def add_backfill_digests_parser(subparser):
+    """ Add the `backfill-digests` command parser. """
+    parser = subparser.add_parser('backfill-digests',
+        help='Set the key digest of DynDNS clients created before key digests were introduced',
+        parents=[_CONFIG_FILE_PARSER],
+    )
+    parser.add_argument('-b', '--batch-size',
+        metavar='<batch-size>',
+        type=int,
+        default=500,
+        help='How many clients to update per transaction. Default: %(default)s',
+    )
+    parser.set_defaults(target=backfill_digests)
+
+
+def add_backfill_reverse_names_parser(subparser):
+    """ Add the `backfill-reverse-names` command parser. """
+    parser = subparser.add_parser('backfill-reverse-names',
+        help='Set the reverse name used for sorting of records created outside of poff',
+        parents=[_CONFIG_FILE_PARSER],
+    )
+    parser.add_argument('-b', '--batch-size',
+        metavar='<batch-size>',
+        type=int,
+        default=500,
+        help='How many records to update per transaction. Default: %(default)s',
+    )
+    parser.set_defaults(target=backfill_reverse_names)
+
+
+def add_db_info_parser(subparser):
+    """ Add the `db-info` command parser. """
+    parser = subparser.add_parser('db-info',
+        help='Print the effective database engine, pool and connection settings',
+        parents=[_CONFIG_FILE_PARSER],
+    )
+    parser.set_defaults(target=db_info)
+
+
+def add_import_zone_parser(subparser):
+    """ Add the `import-zone` command parser. """
+    parser = subparser.add_parser('import-zone',
+        help='Create a domain from a BIND zone file',
+        parents=[_CONFIG_FILE_PARSER],
+    )
+    parser.add_argument('zone_file',
+        metavar='<zone-file>',
+        type=argparse.FileType('r'),
+        help='The zone file to import, or - to read from stdin. Must start with the SOA record.',
+    )
+    parser.add_argument('-o', '--origin',
+        metavar='<origin>',
+        help='Origin of relative names before any $ORIGIN directive.',
+    )
+    parser.set_defaults(target=import_zone_file)
+
+
+def add_export_zone_parser(subparser):
+    """ Add the `export-zone` command parser. """
+    parser = subparser.add_parser('export-zone',
+        help='Export the records of a domain as a BIND zone file or NDJSON',
+        parents=[_CONFIG_FILE_PARSER],
+    )
+    parser.add_argument('domain',
+        metavar='<domain>',
+        help='Name of the domain to export.',
+    )
+    parser.add_argument('-f', '--format',
+        choices=EXPORT_FORMATS,
+        default='bind',
+        help='Output format. Default: %(default)s',
+    )
+    parser.add_argument('-o', '--output',
+        metavar='<file>',
+        type=argparse.FileType('w'),
+        default='-',
+        help='File to write to. Default: stdout',
+    )
+    parser.set_defaults(target=export_zone_file)
+
+
+def add_apply_parser(subparser):
+    """ Add the `apply` command parser. """
+    parser = subparser.add_parser('apply',
+        help='Make the records of a domain match a YAML zone definition',
+        parents=[_CONFIG_FILE_PARSER],
+    )
+    parser.add_argument('zone_file',
+        metavar='<zone.yaml>',
+        type=argparse.FileType('r'),
+        help='The zone definition, or - to read from stdin.',
+    )
+    parser.add_argument('-n', '--dry-run',
+        action='store_true',
+        help='Only print the changes that would be made.',
+    )
+    parser.set_defaults(target=apply_zone)
+
+
+def add_changes_parser(subparser):
+    """ Add the `changes` command parser. """
+    parser = subparser.add_parser('changes',
+        help='Print the journaled record changes of a domain as one JSON object per line',
+        parents=[_CONFIG_FILE_PARSER],
+    )
+    parser.add_argument('domain',
+        metavar='<domain>',
+        help='Name of the domain.',
+    )
+    parser.add_argument('-s', '--since',
+        metavar='<serial>',
+        type=int,
+        default=0,
+        help='Only print changes after this serial. Default: all changes',
+    )
+    parser.set_defaults(target=print_changes)
+
+
+def add_prune_changes_parser(subparser):
+    """ Add the `prune-changes` command parser. """
+    parser = subparser.add_parser('prune-changes',
+        help='Delete old entries from the change journal. Run it periodically, e.g. from cron, '
+            'as the journal is never pruned otherwise',
+        parents=[_CONFIG_FILE_PARSER],
+    )
+    parser.add_argument('-d', '--days',
+        type=int,
+        help='Delete changes older than this. Default: CHANGE_JOURNAL_RETENTION_DAYS from the '
+            'config, or 30',
+    )
+    parser.add_argument('--compact',
+        action='store_true',
+        help='Also delete creates and updates followed by a newer change to the same record.',
+    )
+    parser.set_defaults(target=prune_changes_command)
+
+
 def serve(args):
     """ Run the webserver. """
     _init_logging(args)
     app = create_app(config_file=args.config_file)
-    app.run(host=args.host, port=args.port, debug=args.debug)
+    if args.workers:
+        app.debug = args.debug
+        server = PreforkServer(app, args.host, args.port, args.workers, args.max_requests)
+        server.run()
+    else:
+        app.run(host=args.host, port=args.port, debug=args.debug)
+
+
+def serve_dyndns(args):
+    """ Run the DynDNS server. """
+    _init_logging(args)
+    app = create_app(config_file=args.config_file)
+    server = DynDNSServer(app, threads=args.threads, idle_timeout=args.idle_timeout)
+    server.run(args.host, args.port)
 
 
 def init(args):
     """ Initialize the database tables. """
+    if args.indexes:
+        create_indexes(args)
+        return
     app = create_app(config_file=args.config_file)
     with app.app_context():
         if getattr(args, 'print'):
             print(CreateTable(DynDNSClient.__table__).compile(db.engine))
+            print(CreateTable(RecordChange.__table__).compile(db.engine))
+            for column in _missing_columns(db.engine):
+                print(_add_column_sql(column))
+            for index in _missing_indexes(db.engine):
+                print(CreateIndex(index).compile(db.engine))
         else:
             db.create_all()
+            for column in _missing_columns(db.engine):
+                db.engine.execute(_add_column_sql(column))
+            for index in _missing_indexes(db.engine):
+                index.create(db.engine)
+
+
+def check_indexes(args):
+    """ List the indexes missing on the existing tables. """
+    app = create_app(config_file=args.config_file)
+    with app.app_context():
+        missing = _missing_indexes(db.engine, include_missing_tables=False)
+        for index in missing:
+            print('Missing index %s on %s (%s)' % (index.name, index.table.name,
+                ', '.join(column.name for column in index.columns)))
+        if missing:
+            sys.exit(1)
+        print('No missing indexes')
+
+
+def create_indexes(args):
+    """ Create the indexes missing on the existing tables. """
+    app = create_app(config_file=args.config_file)
+    with app.app_context():
+        for index in _missing_indexes(db.engine, include_missing_tables=False):
+            if getattr(args, 'print'):
+                print('%s;' % CreateIndex(index).compile(db.engine))
+            else:
+                print('Creating index %s on %s' % (index.name, index.table.name))
+                index.create(db.engine)
+
+
+def backfill_digests(args):
+    """ Add the key digest column if missing, and set the digest of all clients without one. """
+    app = create_app(config_file=args.config_file)
+    with app.app_context():
+        _add_missing_column(DynDNSClient.__table__.c.key_digest)
+        query = DynDNSClient.query.filter(DynDNSClient.key_digest.is_(None))
+        updated = _backfill(query, DynDNSClient.update_key_digest, args.batch_size)
+        print('Set key digest for %d DynDNS clients' % updated)
+
+
+def backfill_reverse_names(args):
+    """ Add the reverse name column if missing, and set it for all records without one. """
+    app = create_app(config_file=args.config_file)
+    with app.app_context():
+        _add_missing_column(Record.__table__.c.reverse_name)
+        query = Record.query.filter(Record.reverse_name.is_(None), Record.name.isnot(None))
+        def update(record):
+            record.reverse_name = reverse_name(record.name)
+        updated = _backfill(query, update, args.batch_size)
+        print('Set reverse name for %d records' % updated)
+
+
+def db_info(args):
+    """ Print the effective database settings. """
+    app = create_app(config_file=args.config_file)
+    with app.app_context():
+        for name, value in engine_info(db.engine):
+            print('%-20s %s' % (name + ':', value))
+        replica_engine = db.get_replica_engine(app)
+        if replica_engine is not None:
+            print('\nReplica')
+            for name, value in engine_info(replica_engine):
+                print('%-20s %s' % (name + ':', value))
+
+
+def import_zone_file(args):
+    """ Create a domain from a zone file. """
+    app = create_app(config_file=args.config_file)
+    with app.app_context():
+        try:
+            with args.zone_file:
+                domain, count = import_zone(args.zone_file, args.origin)
+            db.session.commit()
+        except ZoneFileError as error:
+            db.session.rollback()
+            sys.exit('Failed to import zone: %s' % error)
+        print('Imported %d records into %s' % (count, domain.name))
+
+
+def export_zone_file(args):
+    """ Write the records of a domain to a file. """
+    app = create_app(config_file=args.config_file)
+    with app.app_context():
+        domain = Domain.query.filter_by(name=args.domain).first()
+        if not domain:
+            sys.exit('No domain named %s' % args.domain)
+        with args.output:
+            args.output.writelines(export_zone(domain, args.format))
+
+
+def apply_zone(args):
+    """ Apply the changes needed to make a domain match a zone definition. """
+    try:
+        with args.zone_file:
+            domain_name, desired = load_zone(args.zone_file)
+    except (ZoneSyncError, yaml.YAMLError) as error:
+        sys.exit('Invalid zone definition: %s' % error)
+    app = create_app(config_file=args.config_file)
+    with app.app_context():
+        domain = Domain.query.filter_by(name=domain_name).first()
+        if not domain:
+            sys.exit('No domain named %s' % domain_name)
+        diff = diff_zone(domain, desired)
+        for record in diff.deletes:
+            print('- %s %s %s' % (record['name'], record['type'], record['content']))
+        for record in diff.updates:
+            print('~ %s %s %s (ttl %s, prio %s, disabled %s)' % (record['name'], record['type'],
+                record['content'], record['ttl'], record['prio'], record['disabled']))
+        for record in diff.creates:
+            print('+ %s %s %s' % (record['name'], record['type'], record['content']))
+        summary = '%d to create, %d to update, %d to delete' % (len(diff.creates),
+            len(diff.updates), len(diff.deletes))
+        if args.dry_run:
+            db.session.rollback()
+            print('Dry run, %s' % summary)
+            return
+        apply_diff(domain, diff)
+        db.session.commit()
+        print('Applied to %s, %s' % (domain.name, summary))
+
+
+def print_changes(args):
+    """ Print the changes of a domain after a serial. """
+    app = create_app(config_file=args.config_file)
+    with app.app_context():
+        domain = Domain.query.filter_by(name=args.domain).first()
+        if not domain:
+            sys.exit('No domain named %s' % args.domain)
+        try:
+            for change in changes_since(domain.id, args.since):
+                print(json.dumps(change_json(change)))
+        except ChangesPrunedError as error:
+            sys.exit(str(error))
+
+
+def prune_changes_command(args):
+    """ Delete old changes from the change journal. """
+    app = create_app(config_file=args.config_file)
+    with app.app_context():
+        days = args.days
+        if days is None:
+            days = app.config['CHANGE_JOURNAL_RETENTION_DAYS']
+        deleted = prune_changes(days, compact=args.compact)
+        db.session.commit()
+        print('Deleted %d changes' % deleted)
+
+
+def _add_missing_column(column):
+    """ Add the column to its table if it doesn't exist in the database, and create any indexes
+    that are missing afterwards.
+    """
+    if _missing_columns(db.engine, (column,)):
+        db.engine.execute(_add_column_sql(column))
+    for index in _missing_indexes(db.engine):
+        index.create(db.engine)
+
+
+def _missing_columns(engine, columns=_ADDED_COLUMNS):
+    """ Get the columns that doesn't exist in the database, skipping tables that doesn't exist. """
+    inspector = inspect(engine)
+    table_names = inspector.get_table_names()
+    missing = []
+    for column in columns:
+        if column.table.name not in table_names:
+            continue
+        existing = [c['name'] for c in inspector.get_columns(column.table.name)]
+        if column.name not in existing:
+            missing.append(column)
+    return missing
+
+
+def _add_column_sql(column):
+    column_type = column.type.compile(db.engine.dialect)
+    return 'ALTER TABLE %s ADD COLUMN %s %s' % (column.table.name, column.name, column_type)
+
+
+def _backfill(query, update, batch_size):
+    """ Call `update` on all objects matched by the query, committing every `batch_size` objects.
+
+    The update must make the object no longer match the query. Returns the number of objects
+    updated.
+    """
+    updated = 0
+    while True:
+        objects = query.limit(batch_size).all()
+        if not objects:
+            break
+        for obj in objects:
+            update(obj)
+        db.session.commit()
+        updated += len(objects)
+    return updated
+
+
+def _missing_indexes(engine, include_missing_tables=True):
+    """ Get the indexes poff needs that doesn't exist in the database.
+
+    The pdns tables are usually created by the pdns schema and not by poff, thus `create_all`
+    will skip them and any indexes declared on them. An index is considered present if there's an
+    existing index or unique constraint starting with the same columns, regardless of name.
+    Indexes on columns that doesn't exist yet are skipped, as are the indexes of tables that
+    doesn't exist unless `include_missing_tables` is set.
+    """
+    inspector = inspect(engine)
+    table_names = inspector.get_table_names()
+    missing = []
+    for model in _INDEXED_MODELS:
+        table = model.__table__
+        indexes = sorted(table.indexes, key=lambda index: index.name)
+        if table.name not in table_names:
+            if include_missing_tables:
+                missing.extend(indexes)
+            continue
+        columns = set(column['name'] for column in inspector.get_columns(table.name))
+        existing = [tuple(index['column_names']) for index in inspector.get_indexes(table.name)]
+        existing.extend(tuple(constraint['column_names'])
+            for constraint in inspector.get_unique_constraints(table.name))
+        for index in indexes:
+            index_columns = tuple(column.name for column in index.columns)
+            covered = any(existing_columns[:len(index_columns)] == index_columns
+                for existing_columns in existing)
+            if not covered and columns.issuperset(index_columns):
+                missing.append(index)
+    return missing
 
 
 def _init_logging(args):
@@ -0,0 +1,187 @@
+from flask import current_app, has_request_context, request
+from flask_sqlalchemy import SignallingSession, SQLAlchemy, get_state
+from sqlalchemy import event, exc, orm
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+import threading
+
+
+# Config keys passed to the engine as pool arguments. SQLite doesn't use a connection pool for
+# file databases, so they're only applied to other dialects.
+_POOL_OPTIONS = (
+    ('DATABASE_POOL_SIZE', 'pool_size'),
+    ('DATABASE_MAX_OVERFLOW', 'max_overflow'),
+    ('DATABASE_POOL_TIMEOUT', 'pool_timeout'),
+    ('DATABASE_POOL_RECYCLE', 'pool_recycle'),
+)
+
+
+def set_config_defaults(config):
+    """ Set the defaults of the database tuning config keys. """
+    for key, _ in _POOL_OPTIONS:
+        config.setdefault(key, None)
+    config.setdefault('DATABASE_POOL_PRE_PING', False)
+    config.setdefault('SQLITE_JOURNAL_MODE', 'WAL')
+    config.setdefault('SQLITE_SYNCHRONOUS', 'NORMAL')
+    config.setdefault('SQLITE_MMAP_SIZE', 256*2**20)
+    config.setdefault('SQLITE_BUSY_TIMEOUT_MS', 5000)
+    config.setdefault('POSTGRES_STATEMENT_TIMEOUT_MS', 30000)
+    config.setdefault('SQLALCHEMY_REPLICA_DATABASE_URI', None)
+    config.setdefault('REPLICA_READ_YOUR_WRITES_SECONDS', 10)
+
+
+# Set after a change is redirected, to read from the primary until the replica has caught up
+_READ_PRIMARY_COOKIE = 'poff-read-primary'
+
+
+class TunedSQLAlchemy(SQLAlchemy):
+    """ Applies the pool config and per-dialect connection settings to the engines created, and
+    sends reads to the replica if one is configured.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(TunedSQLAlchemy, self).__init__(*args, **kwargs)
+        self._replica_lock = threading.Lock()
+
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=_RoutingSession, db=self, **options)
+
+
+    def get_replica_engine(self, app):
+        """ Get the engine for SQLALCHEMY_REPLICA_DATABASE_URI, or None if it's not set. """
+        uri = app.config['SQLALCHEMY_REPLICA_DATABASE_URI']
+        if not uri:
+            return None
+        with self._replica_lock:
+            engine = app.extensions.get('poff_replica_engine')
+            if engine is None:
+                sa_url, options = self.apply_driver_hacks(app, make_url(uri), {})
+                options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+                engine = self.create_engine(sa_url, options)
+                app.extensions['poff_replica_engine'] = engine
+            return engine
+
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        sa_url, options = super(TunedSQLAlchemy, self).apply_driver_hacks(app, sa_url, options)
+        if sa_url.drivername != 'sqlite':
+            for key, option in _POOL_OPTIONS:
+                if app.config[key] is not None:
+                    options[option] = app.config[key]
+        # Removed again before creating the engine, as they're not engine arguments
+        options['poff_connect_statements'] = connect_statements(app.config, sa_url.drivername)
+        options['poff_pre_ping'] = app.config['DATABASE_POOL_PRE_PING']
+        return sa_url, options
+
+
+    def create_engine(self, sa_url, engine_opts):
+        engine_opts = dict(engine_opts)
+        statements = engine_opts.pop('poff_connect_statements', ())
+        pre_ping = engine_opts.pop('poff_pre_ping', False)
+        engine = super(TunedSQLAlchemy, self).create_engine(sa_url, engine_opts)
+        if statements:
+            @event.listens_for(engine, 'connect')
+            def configure_connection(dbapi_connection, connection_record):
+                cursor = dbapi_connection.cursor()
+                for statement in statements:
+                    cursor.execute(statement)
+                cursor.close()
+                if sa_url.drivername.startswith('postgresql'):
+                    dbapi_connection.commit()
+        if pre_ping:
+            event.listen(engine, 'checkout', _ping_connection)
+        return engine
+
+
+class _RoutingSession(SignallingSession):
+    """ Reads from the replica engine when handling GET requests.
+
+    Flushes always go to the primary, as do reads by requests that aren't GETs, reads outside of
+    requests, reads shortly after a change was redirected and reads after the session has
+    flushed changes.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing:
+            self.info['poff_flushed'] = True
+        elif not self.info.get('poff_flushed') and _read_from_replica():
+            engine = get_state(self.app).db.get_replica_engine(self.app)
+            if engine is not None:
+                return engine
+        return super(_RoutingSession, self).get_bind(mapper, clause)
+
+
+def _read_from_replica():
+    return has_request_context() and request.method in ('GET', 'HEAD') \
+        and _READ_PRIMARY_COOKIE not in request.cookies
+
+
+def read_your_writes(response):
+    """ Make the client read from the primary for a while after a change is redirected.
+
+    Registered as an `after_request` handler if a replica is configured.
+    """
+    if request.method not in ('GET', 'HEAD') and 300 <= response.status_code < 400:
+        response.set_cookie(_READ_PRIMARY_COOKIE, '1', httponly=True,
+            max_age=current_app.config['REPLICA_READ_YOUR_WRITES_SECONDS'])
+    return response
+
+
+def connect_statements(config, drivername):
+    """ Get the statements to run on new connections for the dialect. """
+    dialect = drivername.split('+')[0]
+    statements = []
+    if dialect == 'sqlite':
+        if config['SQLITE_JOURNAL_MODE']:
+            statements.append('PRAGMA journal_mode=%s' % config['SQLITE_JOURNAL_MODE'])
+        if config['SQLITE_SYNCHRONOUS']:
+            statements.append('PRAGMA synchronous=%s' % config['SQLITE_SYNCHRONOUS'])
+        if config['SQLITE_MMAP_SIZE'] is not None:
+            statements.append('PRAGMA mmap_size=%d' % config['SQLITE_MMAP_SIZE'])
+        if config['SQLITE_BUSY_TIMEOUT_MS'] is not None:
+            statements.append('PRAGMA busy_timeout=%d' % config['SQLITE_BUSY_TIMEOUT_MS'])
+    elif dialect == 'postgresql':
+        if config['POSTGRES_STATEMENT_TIMEOUT_MS'] is not None:
+            statements.append('SET statement_timeout = %d' %
+                config['POSTGRES_STATEMENT_TIMEOUT_MS'])
+    return statements
+
+
+def engine_info(engine):
+    """ Get the effective settings of an engine, as a list of (name, value) tuples. """
+    pool = engine.pool
+    info = [
+        ('url', repr(engine.url)),
+        ('dialect', engine.dialect.name),
+        ('driver', engine.driver),
+        ('pool', type(pool).__name__),
+    ]
+    if isinstance(pool, QueuePool):
+        info.append(('pool size', pool.size()))
+        info.append(('max overflow', pool._max_overflow)) # pylint: disable=protected-access
+        info.append(('pool timeout', pool._timeout)) # pylint: disable=protected-access
+    info.append(('pool recycle', pool._recycle)) # pylint: disable=protected-access
+    info.append(('pre ping', _ping_connection in list(pool.dispatch.checkout)))
+
+    with engine.connect() as connection:
+        if engine.dialect.name == 'sqlite':
+            for pragma in ('journal_mode', 'synchronous', 'mmap_size', 'busy_timeout'):
+                info.append((pragma, connection.execute('PRAGMA %s' % pragma).scalar()))
+        elif engine.dialect.name == 'postgresql':
+            for setting in ('server_version', 'statement_timeout'):
+                info.append((setting, connection.execute('SHOW %s' % setting).scalar()))
+    return info
+
+
+def _ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """ Check that a connection is alive before it's used, to not fail on connections closed by
+    the server. The pool retries with a new connection if this fails.
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+    except Exception: # pylint: disable=broad-except
+        raise exc.DisconnectionError()
+    finally:
+        cursor.close()
@@ -0,0 +1,182 @@
+from . import base62
+from .models import DynDNSClient, key_digest
+
+from collections import namedtuple
+from flask import current_app
+from logging import getLogger
+import hmac
+import ipaddress
+import json
+import math
+
+_logger = getLogger('poff.dyndns')
+
+# Status shown in the body of DynDNS responses in stateless mode
+STATUSES = {
+    200: 'unchanged',
+    201: 'updated',
+    202: 'accepted',
+    400: 'bad request',
+    403: 'forbidden',
+    404: 'not found',
+    429: 'rate limited',
+}
+
+
+UpdateResult = namedtuple('UpdateResult', ['status_code', 'addresses', 'message', 'headers'])
+
+
+def update(form, access_route):
+    """ Update the records of a DynDNS client.
+
+    `form` holds the submitted parameters, and `access_route` the address the request came from
+    followed by any proxies. Must be called within an app context, the changes are committed when
+    it ends. Returns an `UpdateResult`.
+    """
+    record_name = form.get('record')
+    submitted_key = str(form.get('key', ''))
+    submitted_digest = key_digest(submitted_key)
+    extensions = current_app.extensions
+    counters = extensions['poff_dyndns_counters']
+
+    wait = extensions['poff_dyndns_limiter'].consume(
+        (record_name or submitted_digest, access_route[0]))
+    if wait:
+        counters.increment('rate_limited')
+        return _result(429, headers={'Retry-After': str(int(math.ceil(min(wait, 3600))))})
+
+    addresses = parse_addresses(form, access_route)
+    if not addresses:
+        counters.increment('bad_request')
+        return _result(400)
+
+    negative_cache = extensions['poff_dyndns_negative_cache']
+    # Keyed by the record types too, as a name can have a client for only some of them
+    negative_cache_key = (record_name, frozenset(addresses))
+    if record_name and negative_cache.get(negative_cache_key):
+        counters.increment('negative_cache_hits')
+        return _result(404)
+
+    cache = extensions['poff_dyndns_cache']
+    cache_key = (record_name, submitted_digest)
+    cached = cache.get(cache_key)
+    if cached and cached[0] == addresses:
+        counters.increment('cache_hits')
+        return _result(200, cached[1], 'Still on the same IP, no change applied')
+
+    results = DynDNSClient.lookup_all(record_name, addresses, key_digest=submitted_digest)
+    if not results:
+        results, error_code = _authenticate_legacy_client(record_name, addresses, submitted_key)
+        if error_code == 404:
+            negative_cache.set(negative_cache_key, True, tags=(('name', record_name),))
+        if error_code:
+            counters.increment(STATUSES[error_code].replace(' ', '_'))
+            return _result(error_code)
+
+    write_behind = extensions['poff_dyndns_write_behind']
+    updated = []
+    queued = []
+    for _, record, _, _ in results:
+        origin_ip = addresses[record.type]
+        current = record.content
+        if write_behind is not None:
+            current = write_behind.pending(record.id) or current
+        if current == origin_ip:
+            continue
+        if write_behind is not None and write_behind.put(record.id, record.domain_id, origin_ip):
+            _logger.info('Queued update of record %s %s to %s', record.name, record.type,
+                origin_ip)
+            queued.append(origin_ip)
+        else:
+            _logger.info('Updating record %s %s to %s', record.name, record.type, origin_ip)
+            record.content = origin_ip
+            updated.append(origin_ip)
+    applied = sorted(set(addresses[record.type] for _, record, _, _ in results),
+        key=lambda ip: ':' in ip)
+
+    if updated:
+        counters.increment('updated')
+        return _result(201, applied,
+            'Successfully updated record to new IP: %s' % ', '.join(updated + queued))
+    elif queued:
+        counters.increment('queued')
+        return _result(202, applied, 'Update to new IP accepted: %s' % ', '.join(queued))
+    else:
+        tags = []
+        for dyndns_client, record, _, _ in results:
+            tags.extend((('record', record.id), ('client', dyndns_client.id)))
+        cache.set(cache_key, (addresses, applied), tags=tags)
+        counters.increment('unchanged')
+        return _result(200, applied, 'Still on the same IP, no change applied')
+
+
+def format_body(result, prefer_json=False):
+    """ Format the body of a DynDNS response. Returns a tuple of the body and its content type.
+
+    The body is a short status line like `updated 1.2.3.4`, or a JSON object if the client prefers
+    JSON.
+    """
+    status = STATUSES[result.status_code]
+    addresses = result.addresses
+    if prefer_json:
+        body = {'status': status}
+        if addresses:
+            body['ip'] = addresses[0]
+        if len(addresses) > 1:
+            body['ips'] = list(addresses)
+        return json.dumps(body) + '\n', 'application/json'
+    return ' '.join([status] + list(addresses)) + '\n', 'text/plain; charset=utf-8'
+
+
+def parse_addresses(form, access_route):
+    """ Get the addresses to update to, as a dict from record type to address.
+
+    The addresses are given by the `ipv4` and `ipv6` parameters, to update both the A and AAAA
+    records in one request. If neither is given the address the request came from is used, and
+    only records of its type are updated. Returns None if a given address is invalid.
+    """
+    addresses = {}
+    for param, version, record_type in (('ipv4', 4, 'A'), ('ipv6', 6, 'AAAA')):
+        value = form.get(param)
+        if value:
+            try:
+                address = ipaddress.ip_address(value)
+            except ValueError:
+                return None
+            if address.version != version:
+                return None
+            addresses[record_type] = str(address)
+    if not addresses:
+        origin_ip = access_route[0]
+        if origin_ip.startswith('::ffff:'):
+            origin_ip = origin_ip[len('::ffff:'):]
+        addresses['AAAA' if ':' in origin_ip else 'A'] = origin_ip
+    return addresses
+
+
+def _result(status_code, addresses=(), message=None, headers=None):
+    return UpdateResult(status_code, addresses, message, headers or {})
+
+
+def _authenticate_legacy_client(record_name, record_types, submitted_key):
+    """ Authenticate a client by record name when the key digest didn't match any client.
+
+    Returns a tuple of the lookup results and an error status code, one of which is None. The error
+    is 404 for unknown records and 403 for bad keys. Clients created before key digests were
+    introduced are authenticated by comparing the encoded key, and get their digest set on success.
+    """
+    if not record_name:
+        _logger.warning('Bad auth for key-only record update')
+        return None, 403
+    results = DynDNSClient.lookup_all(record_name, record_types)
+    if not results:
+        return None, 404
+    for result in results:
+        dyndns_client = result[0]
+        if dyndns_client.key_digest is None:
+            record_key = base62.encode(dyndns_client.key)
+            if hmac.compare_digest(submitted_key, record_key):
+                dyndns_client.update_key_digest()
+                return [result], None
+    _logger.warning('Bad auth for trying to update record %s', record_name)
+    return None, 403
@@ -0,0 +1,183 @@
+from . import dyndns
+
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from urllib.parse import parse_qsl
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+import asyncio
+import signal
+
+_logger = getLogger('poff.dyndnsserver')
+
+_MAX_HEADER_SIZE = 8192
+_MAX_BODY_SIZE = 4096
+
+_REASONS = {
+    200: 'OK',
+    201: 'Created',
+    202: 'Accepted',
+    400: 'Bad Request',
+    403: 'Forbidden',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    429: 'Too Many Requests',
+    500: 'Internal Server Error',
+}
+
+
+class DynDNSServer(object):
+    """ A lightweight asyncio HTTP server for DynDNS updates only.
+
+    Implements `POST /update-record` like the web app does in stateless mode, without the rest of
+    the request handling of Flask. Connections are kept alive between requests, and closed after
+    being idle for `idle_timeout` seconds. The database is only accessed from a pool of `threads`
+    threads, which bounds the number of database connections used.
+    """
+
+    def __init__(self, app, threads=10, idle_timeout=60):
+        self.app = app
+        self.idle_timeout = idle_timeout
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+
+
+    def run(self, host, port):
+        """ Run the server until SIGTERM or SIGINT is received. """
+        asyncio.run(self._serve(host, port))
+
+
+    async def start(self, host, port):
+        """ Start listening, and return the `asyncio.Server`. """
+        return await asyncio.start_server(self.handle_connection, host, port,
+            limit=_MAX_HEADER_SIZE)
+
+
+    async def _serve(self, host, port):
+        server = await self.start(host, port)
+        stopped = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stopped.set)
+        _logger.info('Listening on %s', ', '.join('%s:%d' % s.getsockname()[:2]
+            for s in server.sockets))
+        async with server:
+            await stopped.wait()
+        self.executor.shutdown()
+        write_behind = self.app.extensions.get('poff_dyndns_write_behind')
+        if write_behind is not None:
+            write_behind.stop()
+
+
+    async def handle_connection(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        remote_addr = peer[0] if peer else '127.0.0.1'
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'),
+                        self.idle_timeout)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                    break
+                except asyncio.LimitOverrunError:
+                    await self._write(writer, 413, b'', 'text/plain', False)
+                    break
+                keep_alive = await self._handle_request(head, reader, writer, remote_addr)
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+    async def _handle_request(self, head, reader, writer, remote_addr):
+        """ Handle a single request. Returns whether the connection should be kept alive. """
+        try:
+            request_line, headers = _parse_head(head)
+            method, target, version = request_line
+        except ValueError:
+            await self._write(writer, 400, b'bad request\n', 'text/plain', False)
+            return False
+
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            keep_alive = connection != 'close'
+        else:
+            keep_alive = connection == 'keep-alive'
+
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            length = -1
+        if length < 0 or length > _MAX_BODY_SIZE:
+            await self._write(writer, 413, b'', 'text/plain', False)
+            return False
+        try:
+            body = await asyncio.wait_for(reader.readexactly(length),
+                self.idle_timeout) if length else b''
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+            return False
+
+        if target.split('?', 1)[0] != '/update-record':
+            await self._write(writer, 404, b'not found\n', 'text/plain', keep_alive)
+            return keep_alive
+        if method != 'POST':
+            await self._write(writer, 405, b'method not allowed\n', 'text/plain', keep_alive,
+                {'Allow': 'POST'})
+            return keep_alive
+
+        form = dict(parse_qsl(body.decode('utf-8', 'replace')))
+        forwarded_for = headers.get('x-forwarded-for')
+        if forwarded_for:
+            access_route = [ip.strip() for ip in forwarded_for.split(',')]
+        else:
+            access_route = [remote_addr]
+        loop = asyncio.get_running_loop()
+        try:
+            result = await loop.run_in_executor(self.executor, self._update, form, access_route)
+        except Exception: # pylint: disable=broad-except
+            _logger.exception('DynDNS update failed')
+            await self._write(writer, 500, b'internal server error\n', 'text/plain', False)
+            return False
+
+        accept = parse_accept_header(headers.get('accept'), MIMEAccept)
+        prefer_json = accept.best_match(['text/plain', 'application/json']) == 'application/json'
+        response_body, content_type = dyndns.format_body(result, prefer_json)
+        await self._write(writer, result.status_code, response_body.encode('utf-8'),
+            content_type, keep_alive, result.headers)
+        return keep_alive
+
+
+    def _update(self, form, access_route):
+        # The changes are committed when the app context ends
+        with self.app.app_context():
+            return dyndns.update(form, access_route)
+
+
+    async def _write(self, writer, status_code, body, content_type, keep_alive, headers=None):
+        lines = [
+            'HTTP/1.1 %d %s' % (status_code, _REASONS[status_code]),
+            'Content-Type: %s' % content_type,
+            'Content-Length: %d' % len(body),
+            'Connection: %s' % ('keep-alive' if keep_alive else 'close'),
+        ]
+        for name, value in (headers or {}).items():
+            lines.append('%s: %s' % (name, value))
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+
+
+def _parse_head(head):
+    """ Parse the request line and headers. Header names are lowercased. """
+    lines = head.decode('latin-1').split('\r\n')
+    request_line = lines[0].split(' ')
+    if len(request_line) != 3 or not request_line[2].startswith('HTTP/'):
+        raise ValueError('Invalid request line')
+    headers = {}
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return request_line, headers
@@ -0,0 +1,99 @@
+from . import db
+from .models import DomainMeta, RecordChange
+
+import time
+
+# Serials are compared with serial number arithmetic, as the counter strategy wraps around at
+# 2^32, see RFC 1982
+_SERIAL_HALF_RANGE = 2**31
+
+
+class ChangesPrunedError(Exception):
+    pass
+
+
+def changes_since(domain_id, since):
+    """ Query for the journaled changes of a domain with a serial newer than `since`, oldest
+    first.
+
+    Raises `ChangesPrunedError` if changes after `since` have been pruned, in which case the
+    whole zone must be read again. Serials are compared like RFC 1982 does, so serials that
+    wrapped around are still newer, as long as the journal spans less than 2^31 serials.
+    """
+    pruned_serial = db.session.query(DomainMeta.content)\
+        .filter(DomainMeta.domain_id == domain_id)\
+        .filter(DomainMeta.kind == DomainMeta.JOURNAL_PRUNED_KIND)\
+        .scalar()
+    if pruned_serial is not None and _serial_newer(int(pruned_serial), since):
+        raise ChangesPrunedError('Changes up to serial %s have been pruned' % pruned_serial)
+    return RecordChange.query\
+        .filter(RecordChange.domain_id == domain_id)\
+        .filter(db.or_(
+            db.and_(RecordChange.serial > since,
+                RecordChange.serial < since + _SERIAL_HALF_RANGE),
+            RecordChange.serial < since - _SERIAL_HALF_RANGE,
+        ))\
+        .order_by(RecordChange.id)
+
+
+def _serial_newer(serial, other):
+    """ Whether `serial` is newer than `other` in serial number arithmetic. """
+    return (other < serial < other + _SERIAL_HALF_RANGE) or serial < other - _SERIAL_HALF_RANGE
+
+
+def change_json(change):
+    return {
+        'serial': change.serial,
+        'action': change.action,
+        'id': change.record_id,
+        'name': change.name,
+        'type': change.type,
+        'content': change.content,
+        'ttl': change.ttl,
+        'prio': change.prio,
+        'disabled': change.disabled,
+        'time': change.created_at,
+    }
+
+
+def prune_changes(max_age_days, compact=False):
+    """ Delete journaled changes older than `max_age_days`, and with `compact` also every create
+    or update that's followed by a newer change to the same record.
+
+    The serial of the newest pruned change of each domain is stored as domain metadata, to tell
+    readers asking for older changes that they're gone. Compacting keeps the latest state of each record, so
+    readers still end up with the same zone, but a record may be updated without having been
+    created or deleted without having been seen. Deletes are never compacted, as SQLite may reuse
+    the id of a deleted record for a new one. Nothing is committed. Returns the number of
+    changes deleted.
+    """
+    cutoff = int(time.time()) - max_age_days*86400
+    # The newest change rather than the highest serial, as serials may have wrapped around
+    newest_pruned = db.session.query(db.func.max(RecordChange.id))\
+        .filter(RecordChange.created_at < cutoff)\
+        .group_by(RecordChange.domain_id)
+    pruned_serials = dict(db.session.query(RecordChange.domain_id, RecordChange.serial)\
+        .filter(RecordChange.id.in_(newest_pruned))\
+        .all())
+    if pruned_serials:
+        existing = DomainMeta.query\
+            .filter(DomainMeta.kind == DomainMeta.JOURNAL_PRUNED_KIND)\
+            .filter(DomainMeta.domain_id.in_(list(pruned_serials)))
+        for meta in existing:
+            # Changes are pruned oldest first, so this is always newer than the previous one
+            meta.content = str(pruned_serials.pop(meta.domain_id))
+        for domain_id, serial in pruned_serials.items():
+            db.session.add(DomainMeta(domain_id=domain_id, kind=DomainMeta.JOURNAL_PRUNED_KIND,
+                content=str(serial)))
+
+    deleted = RecordChange.query\
+        .filter(RecordChange.created_at < cutoff)\
+        .delete(synchronize_session=False)
+    if compact:
+        latest_changes = db.session.query(db.func.max(RecordChange.id))\
+            .group_by(RecordChange.domain_id, RecordChange.record_id)
+        deleted += RecordChange.query\
+            .filter(RecordChange.action != 'delete')\
+            .filter(~RecordChange.id.in_(latest_changes))\
+            .delete(synchronize_session=False)
+    return deleted
@@ -1,14 +1,23 @@
 from . import db, base62
 
 from markupsafe import Markup
+from flask import current_app, has_app_context
 from flask_wtf import FlaskForm
 from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm.attributes import set_committed_value
 from wtforms.fields import HiddenField, TextField
 from wtforms.validators import Regexp, Optional
 from wtforms_alchemy import model_form_factory
+from logging import getLogger
 import base64
 import datetime
+import hashlib
+import heapq
+import hmac
 import os
+import time
+
+_logger = getLogger('poff.models')
 
 # Types supported by PowerDNS, see http://doc.powerdns.com/html/types.html
 _RECORD_TYPES = (
@@ -52,6 +61,10 @@ _TSIG_ALGORITHMS = (
 
 class Domain(db.Model):
     __tablename__ = 'domains'
+    __table_args__ = (
+        # Matches the index created by the stock pdns schema, used to sort the domain list
+        db.Index('name_index', 'name', unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(255), nullable=False)
     master = db.Column(db.String(128))
@@ -60,10 +73,60 @@ class Domain(db.Model):
     notified_serial = db.Column(db.Integer)
     account = db.Column(db.String(40))
 
+    @classmethod
+    def create(cls, name, soa_content):
+        """ Create a domain with its SOA record and the metadata poff sets on new domains.
+
+        The objects are added to the session. Returns the domain and the SOA record.
+        """
+        domain = cls(name=name)
+        soa_record = Record(content=soa_content, domain=domain, type='SOA', name=name)
+        db.session.add(domain)
+        db.session.add(soa_record)
+        db.session.add(DomainMeta(domain=domain, kind='SOA-EDIT', content='INCEPTION-INCREMENT'))
+        db.session.add(DomainMeta(domain=domain, kind='NSEC3NARROW', content='1'))
+        nsec3params = '1 0 1 %s' % os.urandom(16).hex()
+        db.session.add(DomainMeta(domain=domain, kind='NSEC3PARAMS', content=nsec3params))
+        return domain, soa_record
+
+
+    def delete(self):
+        """ Delete the domain with its records, their DynDNS clients, its metadata and the TSIG
+        keys only allowed for this domain.
+
+        Done with bulk statements, so it's a constant number of statements regardless of the size
+        of the zone. The domain is expunged from the session, objects that belong to it which were
+        already loaded are left stale.
+        """
+        allowed_keys = db.session.query(DomainMeta.content)\
+            .filter(DomainMeta.kind == 'TSIG-ALLOW-DNSUPDATE')
+        other_domains_keys = allowed_keys.filter(DomainMeta.domain_id != self.id)
+        TsigKey.query\
+            .filter(TsigKey.name.in_(allowed_keys.filter(DomainMeta.domain_id == self.id)))\
+            .filter(~TsigKey.name.in_(other_domains_keys))\
+            .delete(synchronize_session=False)
+
+        record_ids = db.session.query(Record.id).filter(Record.domain_id == self.id)
+        clients = db.session.query(DynDNSClient.id, DynDNSClient.record_id)\
+            .filter(DynDNSClient.record_id.in_(record_ids))\
+            .all()
+        if clients:
+            DynDNSClient.query.filter(DynDNSClient.record_id.in_(record_ids))\
+                .delete(synchronize_session=False)
+            invalidate_dyndns_cache(record_ids=[record_id for _, record_id in clients],
+                client_ids=[client_id for client_id, _ in clients])
+
+        DomainMeta.query.filter_by(domain_id=self.id).delete(synchronize_session=False)
+        RecordChange.query.filter_by(domain_id=self.id).delete(synchronize_session=False)
+        Record.query.filter_by(domain_id=self.id).delete(synchronize_session=False)
+        Domain.query.filter_by(id=self.id).delete(synchronize_session=False)
+        db.session.expunge(self)
+
+
     @property
     def records(self):
         """ Sort records such that subdomains are grouped together. """
-        return sorted(self._records, key=lambda r: '.'.join(reversed(r.name.split('.'))))
+        return list(in_tree_order(self._records))
 
 
     @property
@@ -72,8 +135,12 @@ class Domain(db.Model):
 
 
     def update_soa(self):
-        """ Update the serial number of the SOA associated with this domain. """
-        self.soa_record.update_serial()
+        """ Update the serial number of the SOA associated with this domain.
+
+        This is done automatically on commit for domains with changed records, thus only needed
+        to bump the serial without changing anything.
+        """
+        self.soa_record.increment_serial()
 
 
     @property
@@ -118,17 +185,71 @@ class Domain(db.Model):
         return DomainForm(obj=self)
 
 
+def reverse_name(name):
+    """ Reverse the labels of a domain name, ie. 'www.example.com' becomes 'com.example.www'. """
+    return '.'.join(reversed(name.split('.')))
+
+
+def in_tree_order(query):
+    """ Iterate over the rows of a query for records or record columns including the id and name,
+    sorted such that subdomains are grouped together.
+
+    Records are sorted by their reverse name in the database, except those without one, like
+    records added by pdns itself, which are sorted in memory and merged in.
+    """
+    def sort_key(row):
+        return reverse_name(row.name), row.id
+    with_reverse_name = query.filter(Record.reverse_name.isnot(None))\
+        .order_by(Record.reverse_name, Record.id)
+    without_reverse_name = sorted(query.filter(Record.reverse_name.is_(None)), key=sort_key)
+    if not without_reverse_name:
+        return iter(with_reverse_name)
+    return heapq.merge(with_reverse_name, without_reverse_name, key=sort_key)
+
+
 class DomainMeta(db.Model):
     __tablename__ = 'domainmetadata'
+    __table_args__ = (
+        # The stock pdns schema only indexes domain_id
+        db.Index('ix_domainmetadata_domain_id_kind', 'domain_id', 'kind'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     domain = db.relationship('Domain', backref=db.backref('_metadata', lazy='dynamic', cascade='delete'))
     domain_id = db.Column(db.Integer, db.ForeignKey('domains.id'))
     kind = db.Column(db.String(16))
     content = db.Column(db.Text())
 
+    # pdns ignores metadata kinds prefixed with X-
+    SERIAL_STRATEGY_KIND = 'X-POFF-SERIAL'
+    # The newest serial with changes removed from the change journal
+    JOURNAL_PRUNED_KIND = 'X-POFF-PRUNED'
+
+
+    @classmethod
+    def serial_strategy(cls, domain_id):
+        """ Get the serial strategy set for the domain, defaulting to 'date'. """
+        strategy = db.session.query(cls.content)\
+            .filter(cls.domain_id == domain_id, cls.kind == cls.SERIAL_STRATEGY_KIND)\
+            .scalar()
+        return validate_serial_strategy(strategy)
+
+
+def validate_serial_strategy(strategy):
+    """ Get the given serial strategy if valid, otherwise the default 'date' strategy. """
+    if strategy is None:
+        return 'date'
+    if strategy not in SERIAL_STRATEGIES:
+        _logger.warning('Unknown serial strategy %r, using date', strategy)
+        return 'date'
+    return strategy
+
 
 class TsigKey(db.Model):
     __tablename__ = 'tsigkeys'
+    __table_args__ = (
+        # Matches the index created by the stock pdns schema
+        db.Index('namealgoindex', 'name', 'algorithm', unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(255))
     algorithm = db.Column(db.String(50), info={
@@ -145,6 +266,13 @@ class TsigKey(db.Model):
 
 class Record(db.Model):
     __tablename__ = 'records'
+    __table_args__ = (
+        # Matches the index created by the stock pdns schema, used by DynDNS lookups
+        db.Index('nametype_index', 'name', 'type'),
+        db.Index('ix_records_domain_id_reverse_name', 'domain_id', 'reverse_name'),
+        # Used to find the SOA record of a domain
+        db.Index('ix_records_domain_id_type', 'domain_id', 'type'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     domain_id = db.Column(db.Integer, db.ForeignKey('domains.id'))
     name = db.Column(db.String(255), nullable=False)
@@ -155,8 +283,40 @@ class Record(db.Model):
     ttl = db.Column(db.Integer, default=3600)
     prio = db.Column(db.Integer)
     disabled = db.Column(db.Boolean, default=False)
+    # Not part of the pdns schema. Set when the name is set, run `poff backfill-reverse-names` to
+    # set it for records created outside of poff. Compared bytewise, like Python compares strings.
+    reverse_name = db.Column(db.String(255).with_variant(db.String(255, collation='C'),
+        'postgresql'))
     domain = db.relationship('Domain', backref=db.backref('_records', lazy='dynamic', cascade='all,delete'))
 
+    @db.validates('name')
+    def validate_name(self, key, name):
+        self.reverse_name = reverse_name(name) if name is not None else None
+        return name
+
+
+    @classmethod
+    def in_subtree(cls, name):
+        """ Get a filter matching records named `name` or any name below it.
+
+        Matches on the reverse name, such that it can be resolved as a range scan of the index,
+        or on the name for records without a reverse name.
+        """
+        reversed_name = reverse_name(name)
+        return db.or_(
+            cls.reverse_name == reversed_name,
+            db.and_(
+                cls.reverse_name >= reversed_name + '.',
+                # '/' is the character following '.'
+                cls.reverse_name < reversed_name + '/',
+            ),
+            db.and_(
+                cls.reverse_name.is_(None),
+                db.or_(cls.name == name, cls.name.endswith('.' + name, autoescape=True)),
+            ),
+        )
+
+
     @property
     def serial(self):
         """ Get the serial number of a SOA record. """
@@ -177,29 +337,128 @@ class Record(db.Model):
         self.content = ' '.join(parts)
 
 
-    def update_serial(self, date=None):
+    def update_serial(self, date=None, strategy=None):
         """ Update the serial number of the SOA record, assuming the given date.
 
-        Will set the serial number according to the YYYYMMDDss convention, where ss is a number
-        incremented once per change per day, and reset every day.
+        See `SERIAL_STRATEGIES` for how the new serial is computed by each strategy. If no strategy
+        is given, the domain's serial strategy is looked up.
         """
         assert self.type == 'SOA', 'tried to update serial number of non-SOA record'
-        if not date:
-            date = datetime.datetime.now().date()
-        current_serial = self.serial
-        serial_date = datetime.datetime.strptime(current_serial[:8], '%Y%m%d')
-        change_num = int(current_serial[8:])
-        if serial_date.date() == date:
-            change_num += 1
-        else:
-            change_num = 0
-        self.serial = '%s%02d' % (date.strftime('%Y%m%d'), change_num)
+        if strategy is None:
+            strategy = self._serial_strategy()
+        self.serial = _next_serial(self.serial, strategy, date)
+
+
+    def increment_serial(self, date=None, strategy=None):
+        """ Increment the serial number of a stored SOA record directly in the database.
+
+        The new content is written with an update conditional on the content not having changed
+        since it was read, such that concurrent increments aren't lost. If someone else got there
+        first the current content is re-read while locking the row, and the update retried. If the
+        record has been deleted in the meantime there's nothing to increment.
+
+        If no strategy is given, the domain's serial strategy is looked up.
+        """
+        assert self.type == 'SOA', 'tried to update serial number of non-SOA record'
+        if strategy is None:
+            strategy = self._serial_strategy()
+        session = db.object_session(self)
+        session.flush()
+        records = Record.__table__
+        current_content = self.content
+        while True:
+            parts = current_content.split()
+            assert len(parts) >= 2, 'Malformed SOA record, no serial number set'
+            parts[2] = _next_serial(parts[2], strategy, date)
+            new_content = ' '.join(parts)
+            result = session.execute(records.update()
+                .where(records.c.id == self.id)
+                .where(records.c.content == current_content)
+                .values(content=new_content))
+            if result.rowcount == 1:
+                break
+            current_content = session.query(Record.content)\
+                .filter(Record.id == self.id)\
+                .with_for_update()\
+                .scalar()
+            if current_content is None:
+                _logger.warning('SOA record %s was deleted before its serial could be incremented',
+                    self.id)
+                return
+        set_committed_value(self, 'content', new_content)
+
+
+    def _serial_strategy(self):
+        # Domains that aren't stored yet can't have a strategy set
+        if self.domain_id is None:
+            return validate_serial_strategy(None)
+        return DomainMeta.serial_strategy(self.domain_id)
+
+
+# Serials are unsigned 32-bit integers, see RFC 1982
+_MAX_SERIAL = 2**32 - 1
+
+
+class SerialOverflowError(Exception):
+    pass
+
+
+def _date_serial(current_serial, date=None):
+    """ YYYYMMDDnn, where nn is incremented once per change per day, and reset every day.
+
+    After the 100th change in a day the serial rolls into the next day's range, instead of
+    growing an extra digit.
+    """
+    if not date:
+        date = datetime.datetime.now().date()
+    return max(int(date.strftime('%Y%m%d00')), current_serial + 1)
+
+
+def _counter_serial(current_serial, date=None):
+    """ Incremented by one for each change, wrapping around to 1. """
+    return current_serial % _MAX_SERIAL + 1
+
+
+def _epoch_serial(current_serial, date=None):
+    """ The current unix time, or incremented by one if changed more than once per second. """
+    return max(int(time.time()), current_serial + 1)
+
+
+SERIAL_STRATEGIES = {
+    'date': _date_serial,
+    'counter': _counter_serial,
+    'epoch': _epoch_serial,
+}
+
+
+def _next_serial(current_serial, strategy='date', date=None):
+    serial_strategy = SERIAL_STRATEGIES[strategy]
+    next_serial = serial_strategy(int(current_serial), date)
+    if next_serial > _MAX_SERIAL:
+        raise SerialOverflowError('Serial number %d overflowed with strategy %s' % (next_serial,
+            strategy))
+    return str(next_serial)
+
+
+def key_digest(printable_key):
+    """ Get the keyed digest of a printable DynDNS key, as stored in `DynDNSClient.key_digest`.
+
+    The digest is keyed with the DYNDNS_DIGEST_KEY config value, which is separate from the
+    SECRET_KEY so that rotating the session secret doesn't invalidate the stored digests.
+    """
+    secret = current_app.config['DYNDNS_DIGEST_KEY']
+    if not isinstance(secret, bytes):
+        secret = secret.encode('utf-8')
+    return hmac.new(secret, printable_key.encode('utf-8'), hashlib.sha256).hexdigest()
 
 
 class DynDNSClient(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     record_id = db.Column(db.Integer, db.ForeignKey('records.id'))
     key = db.Column(db.LargeBinary(64), nullable=False)
+    # Not unique, as the A and AAAA records of a name can share a key. Nullable to support clients
+    # created before digests were introduced, run `poff backfill-digests` to set them
+    key_digest = db.Column(db.String(64), index=True)
     record = db.relationship('Record', backref=db.backref('dyndns_client', uselist=False))
 
 
@@ -210,6 +469,39 @@ class DynDNSClient(db.Model):
 
     def set_new_key(self):
         self.key = os.urandom(30)
+        # Updated on flush, as it depends on the app config
+        self.key_digest = None
+
+
+    def share_key(self, other):
+        """ Use the same key as another client, to update both records in one request. """
+        self.key = other.key
+        self.key_digest = other.key_digest
+
+
+    def rekey(self):
+        """ Set a new key for this client and all clients sharing its key. """
+        shared = DynDNSClient.query\
+            .filter(DynDNSClient.key == self.key, DynDNSClient.id != self.id)\
+            .all()
+        self.set_new_key()
+        for client in shared:
+            client.share_key(self)
+
+
+    @classmethod
+    def find_shared(cls, record):
+        """ Find a client whose key should be shared by a new client for the given record.
+
+        That's a client for an A or AAAA record with the same name in the same domain, so that
+        dual-stack hosts can update both records with one key.
+        """
+        return cls.query.join(Record, cls.record_id == Record.id)\
+            .filter(Record.domain_id == record.domain_id)\
+            .filter(Record.name == record.name)\
+            .filter(Record.type.in_(('A', 'AAAA')))\
+            .order_by(cls.id)\
+            .first()
 
 
     @property
@@ -217,6 +509,454 @@ class DynDNSClient(db.Model):
         return base62.encode(self.key)
 
 
+    def update_key_digest(self):
+        self.key_digest = key_digest(self.printable_key)
+
+
+    @classmethod
+    def lookup(cls, record_name=None, record_type='A', key_digest=None):
+        """ Find a DynDNS client by record name and/or key digest in a single query.
+
+        Returns a tuple of (client, record, soa_record, serial_strategy), or None if there's no
+        matching record that has a DynDNS client.
+        """
+        results = cls.lookup_all(record_name, (record_type,), key_digest)
+        if results:
+            return results[0]
+
+
+    @classmethod
+    def lookup_all(cls, record_name=None, record_types=('A',), key_digest=None):
+        """ Find all DynDNS clients by record name and/or key digest in a single query.
+
+        Several clients match a key digest if the key is shared. Returns a list of tuples of
+        (client, record, soa_record, serial_strategy), ordered by record name and type.
+        """
+        soa_record = db.aliased(Record)
+        query = db.session.query(cls, Record, soa_record, DomainMeta.content)\
+            .join(Record, cls.record_id == Record.id)\
+            .join(soa_record, db.and_(
+                soa_record.domain_id == Record.domain_id,
+                soa_record.type == 'SOA',
+            ))\
+            .outerjoin(DomainMeta, db.and_(
+                DomainMeta.domain_id == Record.domain_id,
+                DomainMeta.kind == DomainMeta.SERIAL_STRATEGY_KIND,
+            ))\
+            .filter(Record.type.in_(tuple(record_types)))\
+            .order_by(Record.name, Record.type, cls.id)
+        if record_name is not None:
+            query = query.filter(Record.name == record_name)
+        if key_digest is not None:
+            query = query.filter(cls.key_digest == key_digest)
+        results = []
+        for client, record, soa_record, serial_strategy in query:
+            serial_strategy = validate_serial_strategy(serial_strategy)
+            remember_soa_record(soa_record, serial_strategy)
+            results.append((client, record, soa_record, serial_strategy))
+        return results
+
+
+class RecordChange(db.Model):
+    """ An entry in the change journal: a record created, updated or deleted by the change that
+    bumped the serial of its domain to `serial`.
+
+    Creates and updates hold the state of the record after the change, deletes the state it had
+    when deleted. Changes to SOA records aren't journaled, as the serial is part of every entry.
+    """
+    __table_args__ = (
+        db.Index('ix_record_change_domain_id_serial', 'domain_id', 'serial'),
+        # Used when compacting the journal
+        db.Index('ix_record_change_record_id', 'record_id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    domain_id = db.Column(db.Integer, db.ForeignKey('domains.id'), nullable=False)
+    # Serials are unsigned 32-bit integers
+    serial = db.Column(db.BigInteger, nullable=False)
+    action = db.Column(db.String(6), nullable=False)
+    record_id = db.Column(db.Integer, nullable=False)
+    name = db.Column(db.String(255))
+    type = db.Column(db.String(10))
+    content = db.Column(db.String(65535))
+    ttl = db.Column(db.Integer)
+    prio = db.Column(db.Integer)
+    disabled = db.Column(db.Boolean)
+    # Unix time of the change
+    created_at = db.Column(db.Integer, nullable=False)
+
+
+@db.event.listens_for(DynDNSClient, 'before_insert')
+@db.event.listens_for(DynDNSClient, 'before_update')
+def _set_key_digest(mapper, connection, client):
+    if client.key_digest is None:
+        client.update_key_digest()
+
+
+class DomainOverview(object):
+    """ A domain with its records, SOA and TSIG keys pre-loaded, for rendering.
+
+    Use `DomainOverview.load` to load several domains in a constant number of queries.
+    """
+
+    def __init__(self, domain, records, tsigkeys):
+        self.domain = domain
+        self.id = domain.id
+        self.name = domain.name
+        self.records = records
+        self.tsigkeys = tsigkeys
+        self.soa_record = next((r for r in records if r.type == 'SOA'), None)
+        self._form = None
+
+
+    @classmethod
+    def load(cls, domains):
+        """ Load the records, DynDNS clients and TSIG keys of the given domains. """
+        domain_ids = [domain.id for domain in domains]
+        records = dict((domain_id, []) for domain_id in domain_ids)
+        tsigkeys = dict((domain_id, []) for domain_id in domain_ids)
+        if domain_ids:
+            domain_records = in_tree_order(Record.query.options(db.joinedload('dyndns_client'))\
+                .filter(Record.domain_id.in_(domain_ids)))
+            for record in domain_records:
+                records[record.domain_id].append(record)
+
+            domain_tsigkeys = db.session.query(DomainMeta.domain_id, TsigKey)\
+                .join(TsigKey, TsigKey.name == DomainMeta.content)\
+                .filter(DomainMeta.kind=='TSIG-ALLOW-DNSUPDATE')\
+                .filter(DomainMeta.domain_id.in_(domain_ids))
+            for domain_id, tsigkey in domain_tsigkeys:
+                tsigkeys[domain_id].append(tsigkey)
+
+        return [cls(domain, records[domain.id], tsigkeys[domain.id]) for domain in domains]
+
+
+    @property
+    def mname(self):
+        if self.soa_record:
+            return self.soa_record.content.split(' ')[0]
+
+
+    @property
+    def rname(self):
+        if self.soa_record:
+            return self.soa_record.content.split(' ')[1].replace('.', '@', 1)
+
+
+    @property
+    def form(self):
+        if self._form is None:
+            self._form = DomainForm(obj=self)
+        return self._form
+
+
+class DomainSummary(object):
+    """ The name, record count and serial of a domain, for listing domains.
+
+    Use `DomainSummary.load` to load several domains in a constant number of queries.
+    """
+
+    def __init__(self, domain, record_count, soa_content):
+        self.domain = domain
+        self.id = domain.id
+        self.name = domain.name
+        self.record_count = record_count
+        self.serial = soa_content.split()[2] if soa_content else None
+
+
+    @classmethod
+    def load(cls, domains):
+        """ Load the record counts and SOA contents of the given domains. """
+        domain_ids = [domain.id for domain in domains]
+        record_counts = {}
+        soa_contents = {}
+        if domain_ids:
+            record_counts = dict(db.session.query(Record.domain_id, db.func.count(Record.id))\
+                .filter(Record.domain_id.in_(domain_ids))\
+                .group_by(Record.domain_id))
+            soa_contents = dict(db.session.query(Record.domain_id, Record.content)\
+                .filter(Record.domain_id.in_(domain_ids), Record.type == 'SOA'))
+        return [cls(domain, record_counts.get(domain.id, 0), soa_contents.get(domain.id))
+            for domain in domains]
+
+
+# Record attributes that affect the zone served by pdns
+_ZONE_ATTRIBUTES = (
+    'domain_id',
+    'name',
+    'type',
+    'content',
+    'ttl',
+    'prio',
+    'disabled',
+)
+
+
+# Record columns copied to the change journal
+_JOURNAL_COLUMNS = (
+    'name',
+    'type',
+    'content',
+    'ttl',
+    'prio',
+    'disabled',
+)
+
+# Upper bound of ids per IN clause, to stay below the bound parameter limit of SQLite
+_JOURNAL_CHUNK_SIZE = 500
+
+
+def mark_zone_changed(domain_id, session=None):
+    """ Bump the SOA serial of the zone on commit.
+
+    Changes done through the ORM are tracked automatically, this is only needed for bulk
+    operations that bypass it.
+    """
+    session = session or db.session
+    session.info.setdefault('poff_changed_zones', set()).add(domain_id)
+
+
+def journal_enabled():
+    """ Whether record changes are written to the change journal. """
+    return has_app_context() and current_app.config.get('CHANGE_JOURNAL', False)
+
+
+def journal_changes(domain_id, action, record_ids, session=None):
+    """ Add changes to the records of a zone to the change journal on commit.
+
+    `action` is 'create', 'update' or 'delete'. The state of deleted records is read right away,
+    so it must be called before they're deleted, the state of other records is read when the
+    journal is written. Changes done through the ORM are journaled automatically, this is only
+    needed for bulk operations that bypass it.
+    """
+    if not journal_enabled():
+        return
+    session = session or db.session
+    if action != 'delete':
+        for record_id in record_ids:
+            _journal(session, domain_id, action, record_id)
+        return
+    record_ids = list(record_ids)
+    for start in range(0, len(record_ids), _JOURNAL_CHUNK_SIZE):
+        chunk = record_ids[start:start + _JOURNAL_CHUNK_SIZE]
+        query = session.query(Record.id, *[getattr(Record, column) for column in _JOURNAL_COLUMNS])\
+            .filter(Record.id.in_(chunk))\
+            .filter(Record.type != 'SOA')
+        for row in query:
+            _journal(session, domain_id, action, row[0], dict(zip(_JOURNAL_COLUMNS, row[1:])))
+
+
+def bulk_insert_records(domain_id, mappings):
+    """ Insert records of a zone in bulk and add them to the change journal on commit.
+
+    Getting the ids with `return_defaults` would make SQLAlchemy insert one row at a time, thus
+    the created records are instead found by name, type and content after inserting them, skipping
+    those that existed before.
+    """
+    if not journal_enabled():
+        db.session.bulk_insert_mappings(Record, mappings)
+        return
+    names = sorted(set(mapping['name'] for mapping in mappings))
+    keys = set((mapping['name'], mapping['type'], mapping['content']) for mapping in mappings)
+    existing_ids = set(_record_ids_by_key(domain_id, names, keys))
+    db.session.bulk_insert_mappings(Record, mappings)
+    created_ids = set(_record_ids_by_key(domain_id, names, keys)) - existing_ids
+    journal_changes(domain_id, 'create', sorted(created_ids))
+
+
+def _record_ids_by_key(domain_id, names, keys):
+    """ Get the ids of records in the zone with a (name, type, content) among `keys`. """
+    for start in range(0, len(names), _JOURNAL_CHUNK_SIZE):
+        query = db.session.query(Record.id, Record.name, Record.type, Record.content)\
+            .filter(Record.domain_id == domain_id)\
+            .filter(Record.name.in_(names[start:start + _JOURNAL_CHUNK_SIZE]))
+        for record_id, name, record_type, content in query:
+            if (name, record_type, content) in keys:
+                yield record_id
+
+
+def _journal(session, domain_id, action, record_id, values=None):
+    """ Note a change to a record, merged with earlier changes to it in the transaction. """
+    changes = session.info.setdefault('poff_journal', {}).setdefault(domain_id, {})
+    previous_action = changes.get(record_id, (None, None))[0]
+    if previous_action == 'create' and action == 'delete':
+        # Never visible outside of the transaction
+        del changes[record_id]
+    elif previous_action != 'create':
+        changes[record_id] = (action, values)
+
+
+def _write_journal(session, serials):
+    """ Write the changes noted in the transaction to the journal, with the new serials. """
+    journal = session.info.pop('poff_journal', {})
+    changes_table = RecordChange.__table__
+    records = Record.__table__
+    now = int(time.time())
+    for domain_id, changes in journal.items():
+        # Zones that were created or deleted in the transaction aren't journaled
+        if domain_id not in serials or not changes:
+            continue
+        serial = serials[domain_id]
+        deletes = []
+        for action in ('create', 'update'):
+            record_ids = [record_id for record_id, (change_action, _) in changes.items()
+                if change_action == action]
+            for start in range(0, len(record_ids), _JOURNAL_CHUNK_SIZE):
+                chunk = record_ids[start:start + _JOURNAL_CHUNK_SIZE]
+                columns = [records.c[column] for column in _JOURNAL_COLUMNS]
+                select = db.select([db.literal(domain_id), db.literal(serial),
+                        db.literal(action), records.c.id] + columns + [db.literal(now)])\
+                    .where(records.c.id.in_(chunk))\
+                    .where(records.c.type != 'SOA')
+                session.execute(changes_table.insert().from_select(['domain_id', 'serial',
+                    'action', 'record_id'] + list(_JOURNAL_COLUMNS) + ['created_at'], select))
+        for record_id, (action, values) in changes.items():
+            if action == 'delete':
+                deletes.append(dict(values, domain_id=domain_id, serial=serial, action=action,
+                    record_id=record_id, created_at=now))
+        if deletes:
+            session.execute(changes_table.insert(), deletes)
+
+
+def remember_soa_record(soa_record, serial_strategy):
+    """ Let the SOA bump at commit use an already loaded SOA record instead of querying for it. """
+    session = db.object_session(soa_record)
+    session.info.setdefault('poff_soa_records', {})[soa_record.domain_id] = (
+        soa_record, serial_strategy)
+
+
+@db.event.listens_for(db.session, 'after_flush')
+def _track_changed_zones(session, flush_context):
+    """ Note which zones had records created, modified or deleted, to bump their SOA on commit.
+
+    Zones which had their SOA record created are skipped, as the SOA already has a fresh serial.
+    """
+    changed_zones = session.info.setdefault('poff_changed_zones', set())
+    new_zones = session.info.setdefault('poff_new_zones', set())
+    for record in session.new:
+        if isinstance(record, Record):
+            changed_zones.add(record.domain_id)
+            if record.type == 'SOA':
+                new_zones.add(record.domain_id)
+    for record in session.deleted:
+        if isinstance(record, Record):
+            changed_zones.add(record.domain_id)
+    for record in session.dirty:
+        if not isinstance(record, Record):
+            continue
+        attributes = db.inspect(record).attrs
+        if any(attributes[attr].history.has_changes() for attr in _ZONE_ATTRIBUTES):
+            changed_zones.add(record.domain_id)
+            # Moving a record between zones changes the old one too
+            changed_zones.update(attributes.domain_id.history.deleted)
+
+
+def invalidate_dyndns_cache(record_ids=(), client_ids=(), record_names=(), session=None):
+    """ Remove the cached DynDNS state of the given records and DynDNS clients, and forget that
+    the given record names didn't have a DynDNS client, when the transaction is committed.
+
+    Invalidating before the commit would let concurrent updates cache the old state again until
+    the entries expire. Changes done through the ORM are handled automatically, this is only
+    needed for bulk operations that bypass it.
+    """
+    if not has_app_context():
+        return
+    session = session or db.session
+    invalidations = session.info.setdefault('poff_dyndns_invalidations', (set(), set(), set()))
+    invalidations[0].update(record_ids)
+    invalidations[1].update(client_ids)
+    invalidations[2].update(record_names)
+
+
+@db.event.listens_for(db.session, 'after_commit')
+def _invalidate_dyndns_cache(session):
+    record_ids, client_ids, record_names = session.info.pop('poff_dyndns_invalidations',
+        ((), (), ()))
+    if not has_app_context():
+        return
+    cache = current_app.extensions.get('poff_dyndns_cache')
+    if cache is not None:
+        for record_id in record_ids:
+            cache.invalidate(('record', record_id))
+        for client_id in client_ids:
+            cache.invalidate(('client', client_id))
+    negative_cache = current_app.extensions.get('poff_dyndns_negative_cache')
+    if negative_cache is not None:
+        for record_name in record_names:
+            negative_cache.invalidate(('name', record_name))
+
+
+@db.event.listens_for(db.session, 'after_flush')
+def _invalidate_changed_dyndns_clients(session, flush_context):
+    record_ids = set()
+    client_ids = set()
+    record_names = set()
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Record):
+            record_ids.add(obj.id)
+        elif isinstance(obj, DynDNSClient):
+            client_ids.add(obj.id)
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, Record):
+            record_names.add(obj.name)
+        elif isinstance(obj, DynDNSClient) and obj.record:
+            record_names.add(obj.record.name)
+    invalidate_dyndns_cache(record_ids, client_ids, record_names, session)
+
+
+@db.event.listens_for(db.session, 'after_flush')
+def _journal_changed_records(session, flush_context):
+    if not journal_enabled():
+        return
+    for record in session.new:
+        if isinstance(record, Record) and record.type != 'SOA':
+            _journal(session, record.domain_id, 'create', record.id)
+    for record in session.deleted:
+        if isinstance(record, Record) and record.type != 'SOA':
+            _journal(session, record.domain_id, 'delete', record.id,
+                dict((column, getattr(record, column)) for column in _JOURNAL_COLUMNS))
+    for record in session.dirty:
+        if not isinstance(record, Record) or record.type == 'SOA':
+            continue
+        attributes = db.inspect(record).attrs
+        if any(attributes[attr].history.has_changes() for attr in _ZONE_ATTRIBUTES):
+            _journal(session, record.domain_id, 'update', record.id)
+
+
+@db.event.listens_for(db.session, 'before_commit')
+def _bump_changed_zones(session):
+    """ Increment the SOA serial once per zone changed in the transaction. """
+    session.flush()
+    changed_zones = session.info.pop('poff_changed_zones', set())
+    changed_zones -= session.info.pop('poff_new_zones', set())
+    changed_zones.discard(None)
+    soa_records = session.info.pop('poff_soa_records', {})
+    unknown_zones = changed_zones.difference(soa_records)
+    if unknown_zones:
+        query = session.query(Record, DomainMeta.content)\
+            .outerjoin(DomainMeta, db.and_(
+                DomainMeta.domain_id == Record.domain_id,
+                DomainMeta.kind == DomainMeta.SERIAL_STRATEGY_KIND,
+            ))\
+            .filter(Record.type == 'SOA', Record.domain_id.in_(unknown_zones))
+        for soa_record, serial_strategy in query:
+            soa_records[soa_record.domain_id] = (soa_record,
+                validate_serial_strategy(serial_strategy))
+    serials = {}
+    for domain_id in changed_zones:
+        if domain_id in soa_records:
+            soa_record, serial_strategy = soa_records[domain_id]
+            soa_record.increment_serial(strategy=serial_strategy)
+            serials[domain_id] = int(soa_record.serial)
+    _write_journal(session, serials)
+
+
+@db.event.listens_for(db.session, 'after_rollback')
+def _forget_changed_zones(session):
+    for key in ('poff_changed_zones', 'poff_new_zones', 'poff_soa_records', 'poff_journal',
+            'poff_dyndns_invalidations'):
+        session.info.pop(key, None)
+
+
 class _PrintableForm(model_form_factory(FlaskForm)):
 
     def render(self):
@@ -0,0 +1,62 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+class TokenBucketLimiter(object):
+    """ A thread safe token bucket rate limiter, with one bucket per key.
+
+    Each bucket holds up to `burst` tokens and is refilled with `rate` tokens per second. Only the
+    `max_keys` most recently used buckets are kept, a bucket that's dropped starts out full again.
+    A burst of 0 disables the limiter.
+    """
+
+    def __init__(self, rate, burst, max_keys=100000, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.clock = clock
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def consume(self, key):
+        """ Take a token from the bucket for the key.
+
+        Returns 0 if a token was available, otherwise the number of seconds until one will be.
+        """
+        if self.burst <= 0:
+            return 0
+        now = self.clock()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            elif self.rate > 0:
+                wait = (1 - tokens) / self.rate
+            else:
+                wait = float('inf')
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return wait
+
+
+class Counters(object):
+    """ Thread safe event counters, for monitoring. """
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + value
+
+
+    def as_dict(self):
+        with self._lock:
+            return dict(self._counts)
@@ -0,0 +1,153 @@
+from . import db
+
+from logging import getLogger
+from werkzeug.serving import BaseWSGIServer
+import os
+import signal
+import time
+
+_logger = getLogger('poff.server')
+
+# Workers failing within this many seconds of being started are restarted with an exponential
+# backoff from _MIN_RESTART_DELAY up to _MAX_RESTART_DELAY seconds
+_QUICK_FAILURE_SECONDS = 5
+_MIN_RESTART_DELAY = 0.1
+_MAX_RESTART_DELAY = 30
+
+
+class PreforkServer(object):
+    """ A pre-forking HTTP server, running the app in several worker processes.
+
+    The listening socket is created up front and shared by the workers, which are restarted when
+    they exit. A worker exits after handling `max_requests` requests, unless it's 0. Workers that
+    keep failing right after starting are restarted less and less often. On SIGTERM or SIGINT the
+    workers finish the request they're handling and exit, workers that haven't exited after
+    `graceful_timeout` seconds are killed.
+    """
+
+    def __init__(self, app, host, port, workers, max_requests=0, graceful_timeout=30):
+        self.app = app
+        self.workers = workers
+        self.max_requests = max_requests
+        self.graceful_timeout = graceful_timeout
+        self.server = _WorkerServer(host, port, app)
+        self.server.timeout = 1
+        self.port = self.server.server_port
+        # Maps the pid of each worker to when it was started
+        self._children = {}
+        self._stopping = False
+        self._quick_failures = 0
+        self._next_spawn = 0
+
+
+    def run(self):
+        """ Run the server until told to stop. """
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        # The workers must not share the connections of the parent
+        self._dispose_engines()
+        _logger.info('Listening on %s:%d with %d workers', self.server.server_address[0],
+            self.port, self.workers)
+        try:
+            while not self._stopping:
+                while (len(self._children) < self.workers and not self._stopping
+                        and time.monotonic() >= self._next_spawn):
+                    self._spawn()
+                self._reap()
+                time.sleep(0.1)
+        finally:
+            self._shutdown()
+            self.server.server_close()
+
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid:
+            self._children[pid] = time.monotonic()
+            return
+        status = 0
+        try:
+            self._run_worker()
+        except BaseException: # pylint: disable=broad-except
+            _logger.exception('Worker %d failed', os.getpid())
+            status = 1
+        finally:
+            os._exit(status) # pylint: disable=protected-access
+
+
+    def _run_worker(self):
+        self._stopping = False
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, self._stop)
+        self._dispose_engines()
+        while not self._stopping:
+            if self.max_requests and self.server.handled >= self.max_requests:
+                _logger.info('Worker %d recycled after %d requests', os.getpid(),
+                    self.server.handled)
+                break
+            self.server.handle_request()
+        write_behind = self.app.extensions.get('poff_dyndns_write_behind')
+        if write_behind is not None:
+            write_behind.stop()
+
+
+    def _dispose_engines(self):
+        with self.app.app_context():
+            db.engine.dispose()
+        replica_engine = db.get_replica_engine(self.app)
+        if replica_engine is not None:
+            replica_engine.dispose()
+
+
+    def _reap(self, block=False):
+        while self._children:
+            pid, status = os.waitpid(-1, 0 if block else os.WNOHANG)
+            if not pid:
+                return
+            started = self._children.pop(pid, None)
+            if status:
+                _logger.warning('Worker %d exited with status %d', pid, status)
+            now = time.monotonic()
+            if status and started is not None and now - started < _QUICK_FAILURE_SECONDS:
+                self._quick_failures += 1
+                delay = min(_MAX_RESTART_DELAY,
+                    _MIN_RESTART_DELAY * 2**(self._quick_failures - 1))
+                self._next_spawn = now + delay
+                _logger.warning('Worker failed %d times in a row right after starting, restarting '
+                    'it in %.1f seconds', self._quick_failures, delay)
+            else:
+                self._quick_failures = 0
+
+
+    def _shutdown(self):
+        for pid in self._children:
+            _kill(pid, signal.SIGTERM)
+        deadline = time.monotonic() + self.graceful_timeout
+        while self._children and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        for pid in self._children:
+            _logger.warning('Killing worker %d', pid)
+            _kill(pid, signal.SIGKILL)
+        self._reap(block=True)
+
+
+class _WorkerServer(BaseWSGIServer):
+    """ Counts the requests handled by the worker. """
+
+    handled = 0
+
+    def process_request(self, request, client_address):
+        self.handled += 1
+        super(_WorkerServer, self).process_request(request, client_address)
+
+
+def _kill(pid, signum):
+    try:
+        os.kill(pid, signum)
+    except ProcessLookupError:
+        pass
@@ -1,13 +1,32 @@
 from poff import create_app, db
 
+from contextlib import contextmanager
 from functools import partial
+from sqlalchemy import event
 import os
 import tempfile
 import unittest
 
 
+class FakeClock(object):
+    """ A clock that only moves when `now` is set, for code taking a `clock` argument. """
+
+    def __init__(self):
+        self.now = 0
+
+
+    def __call__(self):
+        return self.now
+
+
 class DBTestCase(unittest.TestCase):
 
+    # use a database file instead of an in-memory database, to allow concurrent connections
+    use_file_database = False
+
+    # lines added to the config file
+    extra_config = ()
+
     # used to create the assertXXX helpers
     _assert_helpers = (
         200,
@@ -18,13 +37,20 @@ class DBTestCase(unittest.TestCase):
     )
 
     def _set_up(self):
+        self.database_file = None
+        database_uri = 'sqlite://'
+        if self.use_file_database:
+            database_fd, self.database_file = tempfile.mkstemp(suffix='.sqlite')
+            os.close(database_fd)
+            database_uri = 'sqlite:///%s' % self.database_file
         self.config_file = tempfile.NamedTemporaryFile(delete=False)
         self.config_file.write('\n'.join([
-            'SQLALCHEMY_DATABASE_URI = "sqlite://"',
+            'SQLALCHEMY_DATABASE_URI = "%s"' % database_uri,
             'SECRET_KEY = "testkey"',
+            'DYNDNS_DIGEST_KEY = "testdigestkey"',
 #            'TESTING = True',
             'WTF_CSRF_ENABLED = False',
-        ]).encode('utf-8'))
+        ] + list(self.extra_config)).encode('utf-8'))
         self.config_file.close()
         self.app = create_app(self.config_file.name)
         with self.app.app_context():
@@ -40,6 +66,10 @@ class DBTestCase(unittest.TestCase):
 
     def _tear_down(self):
         os.remove(self.config_file.name)
+        if self.database_file:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(self.database_file + suffix):
+                    os.remove(self.database_file + suffix)
 
 
     def __call__(self, *args, **kwargs):
@@ -65,3 +95,18 @@ class DBTestCase(unittest.TestCase):
 
     def assertForbidden(self, response):
         self.assert403(response)
+
+
+    @contextmanager
+    def count_queries(self):
+        """ Collect the SQL statements executed within the block. """
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        with self.app.app_context():
+            engine = db.get_engine(self.app)
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
@@ -0,0 +1,135 @@
+from . import DBTestCase
+from poff.models import Domain, DynDNSClient, Record
+
+import datetime
+import json
+
+class ApiTest(DBTestCase):
+
+    def set_up(self):
+        domain = Domain(name='test.com')
+        soa_record = Record(type='SOA', content='x y 2014010100', name='test.com', domain=domain)
+        record = Record(name='www.test.com', type='A', content='127.0.0.1', domain=domain)
+        client = DynDNSClient(record=record)
+        self.domain_id, self.soa_id, self.record_id, _ = self.add_objects(domain, soa_record,
+            record, client)
+
+
+    def post_changeset(self, changeset, domain_id=None):
+        return self.client.post('/api/v1/zones/%d/records' % (domain_id or self.domain_id),
+            data=json.dumps(changeset), content_type='application/json')
+
+
+    def test_list_zones(self):
+        response = self.client.get('/api/v1/zones')
+        self.assert200(response)
+        self.assertEqual(response.get_json(), {
+            'zones': [{
+                'id': self.domain_id,
+                'name': 'test.com',
+                'serial': '2014010100',
+                'record_count': 2,
+            }],
+        })
+
+
+    def test_list_records(self):
+        response = self.client.get('/api/v1/zones/%d/records' % self.domain_id)
+        self.assert200(response)
+        records = response.get_json()['records']
+        self.assertEqual([r['name'] for r in records], ['test.com', 'www.test.com'])
+        self.assertNotIn('Set-Cookie', response.headers)
+
+
+    def test_list_records_nonexisting_zone(self):
+        response = self.client.get('/api/v1/zones/1234/records')
+        self.assert404(response)
+        self.assertIn('errors', response.get_json())
+
+
+    def test_changeset(self):
+        response = self.post_changeset({
+            'create': [{
+                'name': 'host%d.test.com' % num,
+                'type': 'A',
+                'content': '10.0.0.%d' % num,
+            } for num in range(100)] + [{
+                'name': 'test.com',
+                'type': 'MX',
+                'content': 'mail.test.com',
+            }],
+            'update': [{
+                'id': self.record_id,
+                'name': 'web.test.com',
+                'content': '127.0.0.2',
+            }],
+        })
+        self.assert200(response)
+        self.assertNotIn('Set-Cookie', response.headers)
+        today = datetime.datetime.now().strftime('%Y%m%d00')
+        self.assertEqual(response.get_json(), {
+            'created': 101,
+            'updated': 1,
+            'deleted': 0,
+            'serial': today,
+        })
+
+        with self.app.app_context():
+            self.assertEqual(Record.query.count(), 103)
+            record = Record.query.get(self.record_id)
+            self.assertEqual(record.name, 'web.test.com')
+            self.assertEqual(record.reverse_name, 'com.test.web')
+            self.assertEqual(record.content, '127.0.0.2')
+            self.assertEqual(Record.query.filter_by(type='MX').one().prio, 0)
+            self.assertEqual(Record.query.filter_by(name='host5.test.com').one().ttl, 3600)
+
+
+    def test_changeset_delete(self):
+        response = self.post_changeset({
+            'delete': [self.record_id],
+        })
+        self.assert200(response)
+        self.assertEqual(response.get_json()['deleted'], 1)
+        with self.app.app_context():
+            self.assertEqual(Record.query.count(), 1)
+            self.assertEqual(DynDNSClient.query.count(), 0)
+            self.assertNotEqual(Record.query.get(self.soa_id).serial, '2014010100')
+
+
+    def test_changeset_invalid(self):
+        invalid_changesets = (
+            {'create': [{'name': 'foo.test.com', 'type': 'BOGUS', 'content': 'foo'}]},
+            {'create': [{'name': 'foo.test.com', 'type': 'A'}]},
+            {'create': [{'name': 'foo.test.com', 'type': 'SOA', 'content': 'x y 1'}]},
+            {'create': [{'name': 'foo.test.com', 'type': 'A', 'content': '1.2.3.4', 'ttl': 'a'}]},
+            {'update': [{'content': '127.0.0.3'}]},
+            {'update': [{'id': self.soa_id, 'content': 'x y 1'}]},
+            {'delete': [1234]},
+            {'delete': ['foo']},
+            {'delete': [True]},
+            {'create': 5},
+            {'update': {'id': 1}},
+            {'delete': 5},
+            {'create': [{'name': 'foo.test.com', 'type': 'A', 'content': '1.2.3.4', 'ttl': True}]},
+            ['not', 'an', 'object'],
+        )
+        for changeset in invalid_changesets:
+            response = self.post_changeset(changeset)
+            self.assert400(response)
+            self.assertIn('errors', response.get_json())
+
+        with self.app.app_context():
+            self.assertEqual(Record.query.count(), 2)
+            self.assertEqual(Record.query.get(self.soa_id).serial, '2014010100')
+
+
+    def test_changeset_other_zone(self):
+        domain = Domain(name='other.com')
+        soa_record = Record(type='SOA', content='x y 2014010100', name='other.com', domain=domain)
+        other_domain_id, _ = self.add_objects(domain, soa_record)
+        response = self.post_changeset({
+            'delete': [self.record_id],
+        }, domain_id=other_domain_id)
+        self.assert400(response)
+        with self.app.app_context():
+            self.assertEqual(Record.query.count(), 3)
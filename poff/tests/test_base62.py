@@ -0,0 +1,44 @@
+from poff import base62
+
+import os
+import unittest
+
+class Base62Test(unittest.TestCase):
+
+    def test_encode_known_values(self):
+        # Keys handed out by earlier versions must stay the same
+        known_values = (
+            (b'', ''),
+            (b'a', 'qFK8'),
+            (b'\xff\xff\xff', '8owf'),
+            (bytes(range(30)), '004a0PpH1ELe2u6L3jsi48NP4Y9m5NuT6CQq7sbX'),
+            (b'\xfe'*30, '87p4'*10),
+        )
+        for digest, expected in known_values:
+            self.assertEqual(base62.encode(digest), expected)
+
+
+    def test_chunk_geometry(self):
+        self.assertEqual(base62.BINARY_CHUNK_LENGTH, 3)
+        self.assertEqual(base62.ENCODED_CHUNK_LENGTH, 4)
+
+
+    def test_decode(self):
+        self.assertEqual(base62.decode('004a0PpH'), b'\x00\x01\x02\x03\x04\x05')
+        self.assertEqual(base62.decode('qFK8'), b'a\x00\x00')
+
+
+    def test_encode_decode_roundtrip(self):
+        for _ in range(100):
+            encoded = base62.encode(os.urandom(30))
+            self.assertEqual(base62.encode(base62.decode(encoded)), encoded)
+
+
+    def test_decode_invalid(self):
+        invalid_values = (
+            'abc',
+            'abc-',
+            'æøå1',
+        )
+        for invalid_value in invalid_values:
+            self.assertRaises(ValueError, base62.decode, invalid_value)
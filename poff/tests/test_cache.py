@@ -0,0 +1,53 @@
+from . import FakeClock
+from poff.cache import TTLCache
+
+import unittest
+
+class TTLCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = TTLCache(3, 10, clock=self.clock)
+
+
+    def test_get_set(self):
+        self.assertIsNone(self.cache.get('foo'))
+        self.cache.set('foo', 'bar')
+        self.assertEqual(self.cache.get('foo'), 'bar')
+
+
+    def test_expiry(self):
+        self.cache.set('foo', 'bar')
+        self.clock.now = 9
+        self.assertEqual(self.cache.get('foo'), 'bar')
+        self.clock.now = 10
+        self.assertIsNone(self.cache.get('foo'))
+        self.assertEqual(len(self.cache), 0)
+
+
+    def test_evicts_least_recently_used(self):
+        for key in ('a', 'b', 'c'):
+            self.cache.set(key, key)
+        self.cache.get('a')
+        self.cache.set('d', 'd')
+        self.assertIsNone(self.cache.get('b'))
+        for key in ('a', 'c', 'd'):
+            self.assertEqual(self.cache.get(key), key)
+
+
+    def test_invalidate(self):
+        self.cache.set('a', 'a', tags=('x', 'y'))
+        self.cache.set('b', 'b', tags=('y',))
+        self.cache.set('c', 'c')
+        self.cache.invalidate('x')
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.get('b'), 'b')
+        self.cache.invalidate('y')
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('c'), 'c')
+
+
+    def test_disabled(self):
+        cache = TTLCache(0, 10)
+        cache.set('foo', 'bar')
+        self.assertIsNone(cache.get('foo'))
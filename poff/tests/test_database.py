@@ -0,0 +1,53 @@
+from . import DBTestCase
+from poff import db
+from poff.database import connect_statements, engine_info, set_config_defaults
+
+from sqlalchemy.engine.url import make_url
+import unittest
+
+class ConnectStatementsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.config = {}
+        set_config_defaults(self.config)
+
+
+    def test_sqlite(self):
+        self.assertEqual(connect_statements(self.config, 'sqlite'), [
+            'PRAGMA journal_mode=WAL',
+            'PRAGMA synchronous=NORMAL',
+            'PRAGMA mmap_size=268435456',
+            'PRAGMA busy_timeout=5000',
+        ])
+        self.config['SQLITE_JOURNAL_MODE'] = None
+        self.config['SQLITE_MMAP_SIZE'] = None
+        self.assertEqual(connect_statements(self.config, 'sqlite'), [
+            'PRAGMA synchronous=NORMAL',
+            'PRAGMA busy_timeout=5000',
+        ])
+
+
+    def test_postgres(self):
+        self.assertEqual(connect_statements(self.config, 'postgresql+psycopg2'), [
+            'SET statement_timeout = 30000',
+        ])
+        self.assertEqual(connect_statements(self.config, 'mysql'), [])
+
+
+class EngineInfoTest(DBTestCase):
+
+    use_file_database = True
+
+    def test_sqlite_settings_applied(self):
+        with self.app.app_context():
+            info = dict(engine_info(db.get_engine(self.app)))
+        self.assertEqual(info['dialect'], 'sqlite')
+        self.assertEqual(info['journal_mode'], 'wal')
+        self.assertEqual(info['synchronous'], 1)
+        self.assertEqual(info['mmap_size'], 268435456)
+        self.assertEqual(info['pre ping'], False)
+
+
+    def test_pre_ping(self):
+        engine = db.create_engine(make_url('sqlite://'), {'poff_pre_ping': True})
+        self.assertEqual(dict(engine_info(engine))['pre ping'], True)
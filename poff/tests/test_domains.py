@@ -1,8 +1,10 @@
 from . import DBTestCase
-from poff.models import Domain, Record, DomainMeta, TsigKey
+from poff import db
+from poff.models import Domain, DynDNSClient, Record, DomainMeta, SerialOverflowError, TsigKey
 
 import datetime
 import re
+import time
 
 class DomainTest(DBTestCase):
 
@@ -191,6 +193,43 @@ class DomainTest(DBTestCase):
             self.assertEqual(len(records), 0)
 
 
+    def test_delete_domain_with_clients_and_keys(self):
+        domain_id = self.add_domain(0)
+        other_domain_id = self.add_domain(1)
+        # A key allowed for both domains is kept
+        self.add_objects(DomainMeta(domain_id=domain_id, kind='TSIG-ALLOW-DNSUPDATE',
+            content='key-1'))
+        response = self.client.delete('/domains/%d' % domain_id)
+        self.assertEqual(response.status_code, 302)
+        with self.app.app_context():
+            self.assertIsNone(Domain.query.get(domain_id))
+            self.assertEqual(Record.query.filter_by(domain_id=domain_id).count(), 0)
+            self.assertEqual(DomainMeta.query.filter_by(domain_id=domain_id).count(), 0)
+            self.assertEqual([key.name for key in TsigKey.query.all()], ['key-1'])
+            clients = DynDNSClient.query.all()
+            self.assertEqual(len(clients), 1)
+            self.assertEqual(clients[0].record.domain_id, other_domain_id)
+
+
+    def test_delete_domain_query_count(self):
+        domain_id = self.add_domain(1)
+        with self.count_queries() as statements:
+            self.client.delete('/domains/%d' % domain_id)
+        query_count = len(statements)
+
+        domain_id = self.add_domain(0)
+        with self.app.app_context():
+            for num in range(50):
+                db.session.add(Record(name='host%d.example0.com' % num, type='A',
+                    content='127.0.0.1', domain_id=domain_id))
+            db.session.commit()
+        with self.count_queries() as statements:
+            self.client.delete('/domains/%d' % domain_id)
+        self.assertEqual(len(statements), query_count)
+        with self.app.app_context():
+            self.assertEqual(Record.query.filter_by(domain_id=domain_id).count(), 0)
+
+
     def test_update_soa_serial(self):
         soa_record = Record(type='SOA', content='x y 2014010100')
         new_date = datetime.date(2014, 1, 2)
@@ -201,3 +240,129 @@ class DomainTest(DBTestCase):
         soa_record.update_serial()
         today = datetime.datetime.now()
         self.assertEqual(soa_record.serial, today.strftime('%Y%m%d00'))
+
+
+    def test_update_soa_serial_date_overflow(self):
+        soa_record = Record(type='SOA', content='x y 2014010298')
+        date = datetime.date(2014, 1, 2)
+        soa_record.update_serial(date)
+        self.assertEqual(soa_record.serial, '2014010299')
+        # Should roll into the next day instead of adding a digit
+        soa_record.update_serial(date)
+        self.assertEqual(soa_record.serial, '2014010300')
+        soa_record.update_serial(datetime.date(2014, 1, 3))
+        self.assertEqual(soa_record.serial, '2014010301')
+
+
+    def test_update_soa_serial_max_overflow(self):
+        soa_record = Record(type='SOA', content='x y %d' % (2**32 - 1))
+        with self.assertRaises(SerialOverflowError):
+            soa_record.update_serial(strategy='epoch')
+
+
+    def test_increment_serial_of_deleted_soa(self):
+        domain_id = self.add_domain(0)
+        with self.app.app_context():
+            soa_record = Domain.query.get(domain_id).soa_record
+            # Like a concurrent delete of the domain
+            records = Record.__table__
+            db.session.execute(records.delete().where(records.c.id == soa_record.id))
+            soa_record.increment_serial(strategy='counter')
+            self.assertEqual(soa_record.serial, '1970010100')
+
+
+    def test_update_soa_serial_counter(self):
+        soa_record = Record(type='SOA', content='x y 41')
+        soa_record.update_serial(strategy='counter')
+        self.assertEqual(soa_record.serial, '42')
+        soa_record.serial = str(2**32 - 1)
+        soa_record.update_serial(strategy='counter')
+        self.assertEqual(soa_record.serial, '1')
+
+
+    def test_update_soa_serial_epoch(self):
+        soa_record = Record(type='SOA', content='x y 1')
+        before = int(time.time())
+        soa_record.update_serial(strategy='epoch')
+        self.assertTrue(before <= int(soa_record.serial) <= time.time())
+        soa_record.serial = str(2**32 - 2)
+        soa_record.update_serial(strategy='epoch')
+        self.assertEqual(soa_record.serial, str(2**32 - 1))
+
+
+    def test_domain_serial_strategy(self):
+        self.add_objects(DomainMeta(domain_id=self.domain_id, kind='X-POFF-SERIAL',
+            content='counter'))
+        response = self.client.post('/domains/%d/new_record' % self.domain_id, data={
+            'name': 'ftp.example.com',
+            'type': 'A',
+            'content': '127.0.0.1',
+        })
+        self.assertEqual(response.status_code, 302)
+        with self.app.app_context():
+            soa_record = Record.query.filter(Record.type=='SOA').one()
+            self.assertEqual(soa_record.serial, '1970010102')
+
+
+    def add_domain(self, num):
+        domain = Domain(name='example%d.com' % num)
+        soa_record = Record(name=domain.name, type='SOA',
+            content='ns.%s hostmaster.%s 19700101%02d' % (domain.name, domain.name, num),
+            domain=domain)
+        record = Record(name='www.' + domain.name, type='A', content='127.0.0.1',
+            domain=domain)
+        client = DynDNSClient(record=record)
+        tsigkey = TsigKey(name='key-%d' % num)
+        tsigmeta = DomainMeta(domain=domain, kind='TSIG-ALLOW-DNSUPDATE', content=tsigkey.name)
+        domain_id = self.add_objects(domain, soa_record, record, client, tsigkey, tsigmeta)[0]
+        return domain_id
+
+
+    def test_main_page_query_count(self):
+        self.add_domain(0)
+        with self.count_queries() as statements:
+            response = self.client.get('/')
+        self.assert200(response)
+        self.assertIn(b'1970010100', response.data)
+        query_count = len(statements)
+
+        for num in range(1, 10):
+            self.add_domain(num)
+        with self.count_queries() as statements:
+            response = self.client.get('/')
+        self.assert200(response)
+        self.assertIn(b'1970010109', response.data)
+        self.assertEqual(len(statements), query_count)
+
+
+    def test_main_page_pagination(self):
+        self.app.config['DOMAINS_PER_PAGE'] = 5
+        for num in range(10):
+            self.add_domain(num)
+
+        response = self.client.get('/')
+        self.assert200(response)
+        self.assertIn(b'example0.com', response.data)
+        self.assertNotIn(b'example9.com', response.data)
+
+        response = self.client.get('/?page=3')
+        self.assert200(response)
+        self.assertIn(b'example9.com', response.data)
+        self.assertNotIn(b'example0.com', response.data)
+
+
+    def test_domain_page(self):
+        domain_id = self.add_domain(0)
+        self.add_domain(1)
+        with self.count_queries() as statements:
+            response = self.client.get('/domains/%d' % domain_id)
+        self.assert200(response)
+        self.assertIn(b'ns.example0.com', response.data)
+        self.assertIn(b'key-0', response.data)
+        self.assertNotIn(b'example1.com', response.data)
+        # The domain, its records with and without a reverse name, and its TSIG keys
+        self.assertEqual(len(statements), 4)
+
+
+    def test_domain_page_nonexisting(self):
+        self.assert404(self.client.get('/domains/1234'))
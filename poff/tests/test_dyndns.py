@@ -1,5 +1,12 @@
 from . import DBTestCase
-from poff.models import Domain, DynDNSClient, Record
+from poff import db
+from poff.models import Domain, DynDNSClient, Record, key_digest
+from poff.ratelimit import TokenBucketLimiter
+from poff.writebehind import WriteBehindQueue
+
+import datetime
+import threading
+import time
 
 class DynDNSTest(DBTestCase):
 
@@ -51,6 +58,358 @@ class DynDNSTest(DBTestCase):
             self.assertEqual(Record.query.get(self.soa_id).serial, new_serial)
 
 
+    def test_update_record_single_lookup(self):
+        data = {
+            'record': 'www.test.com',
+            'key': self.client_key,
+        }
+        headers = {
+            'X-Forwarded-For': '1.2.3.4',
+        }
+        with self.count_queries() as statements:
+            response = self.client.post('/update-record', data=data, headers=headers)
+        self.assert201(response)
+        selects = [s for s in statements if s.lstrip().upper().startswith('SELECT')]
+        self.assertEqual(len(selects), 1)
+
+
+    def test_lookup_ignores_records_without_client(self):
+        domain = Domain(name='other.com')
+        soa_record = Record(name='other.com', type='SOA', content='x y 2014010100', domain=domain)
+        record = Record(name='www.other.com', type='A', content='127.0.0.1', domain=domain)
+        self.add_objects(domain, soa_record, record)
+        with self.app.app_context():
+            self.assertIsNone(DynDNSClient.lookup('www.other.com'))
+            client, record, soa_record, serial_strategy = DynDNSClient.lookup('www.test.com')
+            self.assertEqual(client.id, self.client_id)
+            self.assertEqual(record.id, self.record_id)
+            self.assertEqual(soa_record.id, self.soa_id)
+            self.assertEqual(serial_strategy, 'date')
+
+
+    def test_update_record_key_only(self):
+        data = {
+            'key': self.client_key,
+        }
+        headers = {
+            'X-Forwarded-For': '1.2.3.4',
+        }
+        response = self.client.post('/update-record', data=data, headers=headers)
+        self.assert201(response)
+        with self.app.app_context():
+            self.assertEqual(Record.query.get(self.record_id).content, '1.2.3.4')
+
+
+    def test_update_record_key_only_invalid_key(self):
+        response = self.client.post('/update-record', data={'key': 'hopefully invalid'})
+        self.assertForbidden(response)
+
+
+    def test_update_record_legacy_client(self):
+        # Clients created before key digests were introduced doesn't have one
+        with self.app.app_context():
+            DynDNSClient.query.get(self.client_id).key_digest = None
+            db.session.commit()
+
+        data = {
+            'record': 'www.test.com',
+            'key': self.client_key,
+        }
+        headers = {
+            'X-Forwarded-For': '1.2.3.4',
+        }
+        response = self.client.post('/update-record', data=data, headers=headers)
+        self.assert201(response)
+
+        with self.app.app_context():
+            client = DynDNSClient.query.get(self.client_id)
+            self.assertEqual(client.key_digest, key_digest(self.client_key))
+
+
+    def test_update_record_stateless_response(self):
+        data = {
+            'record': 'www.test.com',
+            'key': self.client_key,
+        }
+        headers = {
+            'X-Forwarded-For': '1.2.3.4',
+        }
+        response = self.client.post('/update-record', data=data, headers=headers)
+        self.assert201(response)
+        self.assertEqual(response.data, b'updated 1.2.3.4\n')
+        self.assertEqual(response.mimetype, 'text/plain')
+        self.assertNotIn('Set-Cookie', response.headers)
+
+        headers['Accept'] = 'application/json'
+        response = self.client.post('/update-record', data=data, headers=headers)
+        self.assert200(response)
+        self.assertEqual(response.get_json(), {'status': 'unchanged', 'ip': '1.2.3.4'})
+        self.assertNotIn('Set-Cookie', response.headers)
+
+        response = self.client.post('/update-record', data={'key': 'invalid'})
+        self.assertForbidden(response)
+        self.assertEqual(response.data, b'forbidden\n')
+
+
+    def test_update_record_stateful(self):
+        self.app.config['DYNDNS_STATELESS'] = False
+        data = {
+            'record': 'www.test.com',
+            'key': self.client_key,
+        }
+        response = self.client.post('/update-record', data=data,
+            headers={'X-Forwarded-For': '1.2.3.4'})
+        self.assert201(response)
+        self.assertEqual(response.data, b'')
+        self.assertIn('Set-Cookie', response.headers)
+
+
+    def test_rate_limit_stateful(self):
+        self.app.config['DYNDNS_STATELESS'] = False
+        self.app.extensions['poff_dyndns_limiter'] = TokenBucketLimiter(0.01, 1)
+        data = {
+            'record': 'www.test.com',
+            'key': 'hopefully invalid',
+        }
+        headers = {
+            'X-Forwarded-For': '1.2.3.4',
+        }
+        self.assertForbidden(self.client.post('/update-record', data=data, headers=headers))
+        response = self.client.post('/update-record', data=data, headers=headers)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '100')
+
+
+    def test_unchanged_update_cached(self):
+        data = {
+            'record': 'www.test.com',
+            'key': self.client_key,
+        }
+        headers = {
+            'X-Forwarded-For': '127.0.0.1',
+        }
+        self.assert200(self.client.post('/update-record', data=data, headers=headers))
+        with self.count_queries() as statements:
+            response = self.client.post('/update-record', data=data, headers=headers)
+        self.assert200(response)
+        self.assertEqual(statements, [])
+
+        # A changed IP must still be written
+        headers['X-Forwarded-For'] = '1.2.3.4'
+        self.assert201(self.client.post('/update-record', data=data, headers=headers))
+        with self.app.app_context():
+            self.assertEqual(Record.query.get(self.record_id).content, '1.2.3.4')
+
+
+    def test_cache_invalidated_by_rekey(self):
+        data = {
+            'record': 'www.test.com',
+            'key': self.client_key,
+        }
+        headers = {
+            'X-Forwarded-For': '127.0.0.1',
+        }
+        self.assert200(self.client.post('/update-record', data=data, headers=headers))
+        self.client.post('/records/%d/rekey' % self.record_id)
+        self.assertForbidden(self.client.post('/update-record', data=data, headers=headers))
+
+
+    def test_cache_invalidated_by_client_delete(self):
+        data = {
+            'record': 'www.test.com',
+            'key': self.client_key,
+        }
+        headers = {
+            'X-Forwarded-For': '127.0.0.1',
+        }
+        self.assert200(self.client.post('/update-record', data=data, headers=headers))
+        self.client.delete('/dyndns-clients/%d' % self.client_id)
+        self.assert404(self.client.post('/update-record', data=data, headers=headers))
+
+
+    def test_cache_invalidated_by_record_change(self):
+        data = {
+            'record': 'www.test.com',
+            'key': self.client_key,
+        }
+        headers = {
+            'X-Forwarded-For': '127.0.0.1',
+        }
+        self.assert200(self.client.post('/update-record', data=data, headers=headers))
+        self.client.post('/records/%d' % self.record_id, data={
+            'name': 'www.test.com',
+            'type': 'A',
+            'content': '127.0.0.2',
+        })
+        self.assert201(self.client.post('/update-record', data=data, headers=headers))
+        with self.app.app_context():
+            self.assertEqual(Record.query.get(self.record_id).content, '127.0.0.1')
+
+
+    def test_cache_invalidated_on_commit(self):
+        cache = self.app.extensions['poff_dyndns_cache']
+        with self.app.app_context():
+            Record.query.get(self.record_id).content = '127.0.0.2'
+            db.session.flush()
+            # Like a concurrent update caching the committed state before this commits
+            cache.set('old-state', '127.0.0.1', tags=[('record', self.record_id)])
+            self.assertEqual(cache.get('old-state'), '127.0.0.1')
+            db.session.commit()
+            self.assertIsNone(cache.get('old-state'))
+
+
+    def add_aaaa_record(self):
+        with self.app.app_context():
+            record = Record(name='www.test.com', type='AAAA', content='::1',
+                domain_id=Record.query.get(self.record_id).domain_id)
+            db.session.add(record)
+            db.session.commit()
+            record_id = record.id
+        response = self.client.post('/records/%d/new-dyndns-client' % record_id)
+        self.assertEqual(response.status_code, 302)
+        return record_id
+
+
+    def test_new_client_shares_key_with_same_name(self):
+        aaaa_record_id = self.add_aaaa_record()
+        with self.app.app_context():
+            client = Record.query.get(aaaa_record_id).dyndns_client
+            self.assertEqual(client.printable_key, self.client_key)
+
+        self.client.post('/records/%d/rekey' % aaaa_record_id)
+        with self.app.app_context():
+            a_client = Record.query.get(self.record_id).dyndns_client
+            aaaa_client = Record.query.get(aaaa_record_id).dyndns_client
+            self.assertNotEqual(a_client.printable_key, self.client_key)
+            self.assertEqual(a_client.key_digest, aaaa_client.key_digest)
+
+
+    def test_update_dual_stack(self):
+        aaaa_record_id = self.add_aaaa_record()
+        data = {
+            'record': 'www.test.com',
+            'key': self.client_key,
+            'ipv4': '1.2.3.4',
+            'ipv6': '2001:db8::1',
+        }
+        with self.app.app_context():
+            serial = int(Record.query.get(self.soa_id).serial)
+        response = self.client.post('/update-record', data=data)
+        self.assert201(response)
+        self.assertEqual(response.data, b'updated 1.2.3.4 2001:db8::1\n')
+        with self.app.app_context():
+            self.assertEqual(Record.query.get(self.record_id).content, '1.2.3.4')
+            self.assertEqual(Record.query.get(aaaa_record_id).content, '2001:db8::1')
+            # One bump for both records
+            self.assertEqual(int(Record.query.get(self.soa_id).serial), serial + 1)
+
+        # Without the record name, all records with the key are updated
+        del data['record']
+        data['ipv6'] = '2001:db8::2'
+        response = self.client.post('/update-record', data=data,
+            headers={'Accept': 'application/json'})
+        self.assert201(response)
+        self.assertEqual(response.get_json(), {
+            'status': 'updated',
+            'ip': '1.2.3.4',
+            'ips': ['1.2.3.4', '2001:db8::2'],
+        })
+        with self.app.app_context():
+            self.assertEqual(Record.query.get(aaaa_record_id).content, '2001:db8::2')
+
+
+    def test_update_ipv6_origin(self):
+        aaaa_record_id = self.add_aaaa_record()
+        data = {
+            'record': 'www.test.com',
+            'key': self.client_key,
+        }
+        response = self.client.post('/update-record', data=data,
+            headers={'X-Forwarded-For': '2001:db8::1'})
+        self.assert201(response)
+        with self.app.app_context():
+            self.assertEqual(Record.query.get(self.record_id).content, '127.0.0.1')
+            self.assertEqual(Record.query.get(aaaa_record_id).content, '2001:db8::1')
+
+
+    def test_update_invalid_address(self):
+        for ipv4, ipv6 in (('1.2.3', None), ('2001:db8::1', None), (None, '1.2.3.4')):
+            data = {
+                'record': 'www.test.com',
+                'key': self.client_key,
+            }
+            if ipv4:
+                data['ipv4'] = ipv4
+            if ipv6:
+                data['ipv6'] = ipv6
+            self.assert400(self.client.post('/update-record', data=data))
+
+
+    def test_unknown_record_negative_cache(self):
+        data = {
+            'record': 'new.test.com',
+            'key': self.client_key,
+        }
+        self.assert404(self.client.post('/update-record', data=data))
+        with self.count_queries() as statements:
+            self.assert404(self.client.post('/update-record', data=data))
+        self.assertEqual(statements, [])
+
+        # Adding the record and a DynDNS client should make it updatable right away
+        with self.app.app_context():
+            record = Record(name='new.test.com', type='A', content='127.0.0.1',
+                domain=Domain.query.filter_by(name='test.com').one())
+            client = DynDNSClient(record=record)
+            db.session.add(record)
+            db.session.add(client)
+            db.session.commit()
+            data['key'] = client.printable_key
+        response = self.client.post('/update-record', data=data,
+            headers={'X-Forwarded-For': '1.2.3.4'})
+        self.assert201(response)
+
+
+    def test_negative_cache_per_record_type(self):
+        data = {
+            'record': 'www.test.com',
+            'key': self.client_key,
+        }
+        # There's only an A record for the name
+        self.assert404(self.client.post('/update-record', data=data,
+            headers={'X-Forwarded-For': '2001:db8::1'}))
+        self.assert201(self.client.post('/update-record', data=data,
+            headers={'X-Forwarded-For': '1.2.3.4'}))
+
+
+    def test_rate_limit(self):
+        self.app.extensions['poff_dyndns_limiter'] = TokenBucketLimiter(0.01, 2)
+        data = {
+            'record': 'www.test.com',
+            'key': 'hopefully invalid',
+        }
+        headers = {
+            'X-Forwarded-For': '1.2.3.4',
+        }
+        for _ in range(2):
+            self.assertForbidden(self.client.post('/update-record', data=data, headers=headers))
+        with self.count_queries() as statements:
+            response = self.client.post('/update-record', data=data, headers=headers)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '100')
+        self.assertEqual(statements, [])
+
+        # Other addresses are unaffected
+        headers['X-Forwarded-For'] = '1.2.3.5'
+        self.assertForbidden(self.client.post('/update-record', data=data, headers=headers))
+
+        response = self.client.get('/api/v1/dyndns/stats')
+        self.assert200(response)
+        self.assertEqual(response.get_json()['counters'], {
+            'forbidden': 3,
+            'rate_limited': 1,
+        })
+
+
     def test_update_tunneled_ipv4_record(self):
         origin = '::ffff:10.10.10.10'
         data = {
@@ -102,10 +461,153 @@ class DynDNSTest(DBTestCase):
         response = self.client.post('/records/%d/rekey' % self.record_id, follow_redirects=True)
         self.assert200(response)
         with self.app.app_context():
-            new_key = Record.query.get(self.record_id).dyndns_client.printable_key
-            self.assertNotEqual(new_key, self.client_key)
+            client = Record.query.get(self.record_id).dyndns_client
+            self.assertNotEqual(client.printable_key, self.client_key)
+            self.assertEqual(client.key_digest, key_digest(client.printable_key))
 
 
     def test_rekey_invalid(self):
         response = self.client.post('/records/0101/rekey')
         self.assert404(response)
+
+
+class ConcurrentDynDNSTest(DBTestCase):
+
+    use_file_database = True
+
+    def set_up(self):
+        domain = Domain(name='test.com')
+        today = datetime.date.today().strftime('%Y%m%d')
+        soa_record = Record(name='test.com', type='SOA', content='x y %s00' % today,
+            domain=domain)
+        self.client_keys = []
+        objects = [domain, soa_record]
+        for num in range(20):
+            record = Record(name='host%d.test.com' % num, type='A', content='127.0.0.1',
+                domain=domain)
+            client = DynDNSClient(record=record)
+            self.client_keys.append(client.printable_key)
+            objects.extend([record, client])
+        self.soa_id = self.add_objects(*objects)[1]
+
+
+    def test_concurrent_updates(self):
+        responses = []
+        def update(key):
+            client = self.app.test_client()
+            response = client.post('/update-record', data={'key': key},
+                headers={'X-Forwarded-For': '1.2.3.4'})
+            responses.append(response.status_code)
+
+        threads = [threading.Thread(target=update, args=(key,)) for key in self.client_keys]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(responses, [201]*len(self.client_keys))
+        with self.app.app_context():
+            serial = Record.query.get(self.soa_id).serial
+            today = datetime.date.today().strftime('%Y%m%d')
+            self.assertEqual(serial, '%s%02d' % (today, len(self.client_keys)))
+
+
+class WriteBehindDynDNSTest(DBTestCase):
+
+    use_file_database = True
+
+    def set_up(self):
+        domain = Domain(name='test.com')
+        today = datetime.date.today().strftime('%Y%m%d')
+        soa_record = Record(name='test.com', type='SOA', content='x y %s00' % today,
+            domain=domain)
+        self.client_keys = []
+        objects = [domain, soa_record]
+        for num in range(3):
+            record = Record(name='host%d.test.com' % num, type='A', content='127.0.0.1',
+                domain=domain)
+            client = DynDNSClient(record=record)
+            self.client_keys.append(client.printable_key)
+            objects.extend([record, client])
+        ids = self.add_objects(*objects)
+        self.soa_id = ids[1]
+        self.record_ids = ids[2::2]
+        # Only flushed explicitly by the tests
+        self.queue = WriteBehindQueue(self.app, 3600, 2)
+        self.app.extensions['poff_dyndns_write_behind'] = self.queue
+
+
+    def tear_down(self):
+        self.queue.stop()
+
+
+    def update(self, num, ip):
+        return self.client.post('/update-record', data={'key': self.client_keys[num]},
+            headers={'X-Forwarded-For': ip})
+
+
+    def test_batched_updates(self):
+        self.assertEqual(self.update(0, '1.2.3.4').status_code, 202)
+        self.assertEqual(self.update(0, '1.2.3.5').status_code, 202)
+        self.assertEqual(self.update(1, '1.2.3.6').status_code, 202)
+        # Same as the queued update
+        self.assert200(self.update(1, '1.2.3.6'))
+        # The queue is full, so this is written right away
+        self.assert201(self.update(2, '1.2.3.7'))
+
+        with self.app.app_context():
+            self.assertEqual(Record.query.get(self.record_ids[0]).content, '127.0.0.1')
+            serial = int(Record.query.get(self.soa_id).serial)
+
+        self.assertEqual(self.queue.flush(), 2)
+        self.assertEqual(len(self.queue), 0)
+        with self.app.app_context():
+            contents = [Record.query.get(record_id).content for record_id in self.record_ids]
+            self.assertEqual(contents, ['1.2.3.5', '1.2.3.6', '1.2.3.7'])
+            self.assertEqual(int(Record.query.get(self.soa_id).serial), serial + 1)
+
+
+    def test_deleted_record_doesnt_lose_other_updates(self):
+        self.assertEqual(self.update(0, '1.2.3.4').status_code, 202)
+        self.assertEqual(self.update(1, '1.2.3.5').status_code, 202)
+        with self.app.app_context():
+            record = Record.query.get(self.record_ids[0])
+            db.session.delete(record.dyndns_client)
+            db.session.delete(record)
+            db.session.commit()
+
+        self.assertEqual(self.queue.flush(), 1)
+        with self.app.app_context():
+            self.assertEqual(Record.query.get(self.record_ids[1]).content, '1.2.3.5')
+
+
+    def test_revert_queued_update(self):
+        self.assertEqual(self.update(0, '1.2.3.4').status_code, 202)
+        # Changing back to the current content must replace the queued update
+        self.assertEqual(self.update(0, '127.0.0.1').status_code, 202)
+        self.queue.flush()
+        with self.app.app_context():
+            self.assertEqual(Record.query.get(self.record_ids[0]).content, '127.0.0.1')
+
+
+    def test_stop_writes_queued_updates(self):
+        self.assertEqual(self.update(0, '1.2.3.4').status_code, 202)
+        self.queue.stop()
+        with self.app.app_context():
+            self.assertEqual(Record.query.get(self.record_ids[0]).content, '1.2.3.4')
+        # Written synchronously after stopping
+        self.assert201(self.update(1, '1.2.3.5'))
+
+
+    def test_worker_flushes(self):
+        self.queue.stop()
+        self.queue = WriteBehindQueue(self.app, 0.01, 2)
+        self.app.extensions['poff_dyndns_write_behind'] = self.queue
+        self.assertEqual(self.update(0, '1.2.3.4').status_code, 202)
+        for _ in range(100):
+            time.sleep(0.01)
+            with self.app.app_context():
+                content = Record.query.get(self.record_ids[0]).content
+            if content == '1.2.3.4':
+                break
+        self.assertEqual(content, '1.2.3.4')
@@ -0,0 +1,99 @@
+from . import DBTestCase
+from poff.dyndnsserver import DynDNSServer
+from poff.models import Domain, DynDNSClient, Record
+
+import asyncio
+import json
+
+class DynDNSServerTest(DBTestCase):
+
+    use_file_database = True
+
+    def set_up(self):
+        domain = Domain(name='test.com')
+        soa_record = Record(name='test.com', type='SOA', content='x y 2014010100', domain=domain)
+        record = Record(name='www.test.com', type='A', content='127.0.0.1', domain=domain)
+        client = DynDNSClient(record=record)
+        self.client_key = client.printable_key
+        self.record_id = self.add_objects(domain, soa_record, record, client)[2]
+        self.server = DynDNSServer(self.app, threads=2, idle_timeout=5)
+
+
+    def tear_down(self):
+        self.server.executor.shutdown()
+
+
+    def run_requests(self, *requests):
+        """ Send the requests on one connection, and return the responses. """
+        async def run():
+            server = await self.server.start('127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            responses = []
+            for request in requests:
+                writer.write(request)
+                head = await reader.readuntil(b'\r\n\r\n')
+                lines = head.decode('latin-1').split('\r\n')
+                headers = dict(line.lower().split(': ', 1) for line in lines[1:] if line)
+                body = await reader.readexactly(int(headers['content-length']))
+                responses.append((int(lines[0].split(' ')[1]), headers, body))
+            writer.close()
+            server.close()
+            await server.wait_closed()
+            return responses
+        return asyncio.run(run())
+
+
+    def update_request(self, body, headers=()):
+        lines = [
+            'POST /update-record HTTP/1.1',
+            'Host: localhost',
+            'Content-Type: application/x-www-form-urlencoded',
+            'Content-Length: %d' % len(body),
+        ]
+        lines.extend(headers)
+        return ('\r\n'.join(lines) + '\r\n\r\n' + body).encode('latin-1')
+
+
+    def test_update_record(self):
+        body = 'record=www.test.com&key=%s' % self.client_key
+        responses = self.run_requests(
+            self.update_request(body, ['X-Forwarded-For: 1.2.3.4']),
+            self.update_request(body, ['X-Forwarded-For: 1.2.3.4', 'Accept: application/json']),
+            self.update_request('key=hopefully+invalid'),
+        )
+        self.assertEqual(responses[0][0], 201)
+        self.assertEqual(responses[0][2], b'updated 1.2.3.4\n')
+        self.assertEqual(responses[0][1]['connection'], 'keep-alive')
+        self.assertEqual(responses[1][0], 200)
+        self.assertEqual(json.loads(responses[1][2].decode('utf-8')),
+            {'status': 'unchanged', 'ip': '1.2.3.4'})
+        self.assertEqual(responses[2][0], 403)
+
+        with self.app.app_context():
+            self.assertEqual(Record.query.get(self.record_id).content, '1.2.3.4')
+
+
+    def test_other_paths(self):
+        responses = self.run_requests(
+            b'GET / HTTP/1.1\r\nHost: localhost\r\n\r\n',
+            b'GET /update-record HTTP/1.1\r\nHost: localhost\r\n\r\n',
+        )
+        self.assertEqual(responses[0][0], 404)
+        self.assertEqual(responses[1][0], 405)
+
+
+    def test_incomplete_body(self):
+        self.server.idle_timeout = 0.1
+        async def run():
+            server = await self.server.start('127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(self.update_request('record=www.test.com')[:-5])
+            # The server closes the connection without a response
+            response = await asyncio.wait_for(reader.read(), 5)
+            writer.close()
+            server.close()
+            await server.wait_closed()
+            return response
+        self.assertEqual(asyncio.run(run()), b'')
@@ -0,0 +1,65 @@
+from . import DBTestCase
+from poff import db
+from poff.cli import _missing_indexes, init
+
+from sqlalchemy import inspect
+import argparse
+
+class MissingIndexesTest(DBTestCase):
+
+    def missing_index_names(self, **kwargs):
+        with self.app.app_context():
+            return [index.name for index in _missing_indexes(db.engine, **kwargs)]
+
+
+    def test_none_missing_after_create_all(self):
+        self.assertEqual(self.missing_index_names(), [])
+
+
+    def test_missing_index(self):
+        with self.app.app_context():
+            db.engine.execute('DROP INDEX ix_records_domain_id_type')
+            db.engine.execute('DROP INDEX ix_domainmetadata_domain_id_kind')
+        self.assertEqual(self.missing_index_names(), [
+            'ix_domainmetadata_domain_id_kind',
+            'ix_records_domain_id_type',
+        ])
+
+
+    def test_covered_by_longer_index(self):
+        with self.app.app_context():
+            db.engine.execute('DROP INDEX ix_records_domain_id_type')
+            db.engine.execute('CREATE INDEX other_name ON records (domain_id, type, name)')
+        self.assertEqual(self.missing_index_names(), [])
+
+
+    def test_missing_table(self):
+        with self.app.app_context():
+            db.engine.execute('DROP TABLE dyn_dns_client')
+        self.assertEqual(self.missing_index_names(include_missing_tables=False), [])
+        self.assertEqual(self.missing_index_names(), ['ix_dyn_dns_client_key_digest'])
+
+
+class InitTest(DBTestCase):
+
+    use_file_database = True
+
+    def column_names(self, table_name):
+        with self.app.app_context():
+            return [column['name'] for column in inspect(db.engine).get_columns(table_name)]
+
+
+    def test_adds_missing_columns(self):
+        with self.app.app_context():
+            db.engine.execute('DROP INDEX ix_records_domain_id_reverse_name')
+            db.engine.execute('ALTER TABLE records DROP COLUMN reverse_name')
+            db.engine.execute('DROP INDEX ix_dyn_dns_client_key_digest')
+            db.engine.execute('ALTER TABLE dyn_dns_client DROP COLUMN key_digest')
+        self.assertNotIn('reverse_name', self.column_names('records'))
+        self.assertNotIn('key_digest', self.column_names('dyn_dns_client'))
+
+        init(argparse.Namespace(config_file=self.config_file.name, indexes=False, print=False))
+        self.assertIn('reverse_name', self.column_names('records'))
+        self.assertIn('key_digest', self.column_names('dyn_dns_client'))
+        with self.app.app_context():
+            self.assertEqual(_missing_indexes(db.engine), [])
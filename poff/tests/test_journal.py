@@ -0,0 +1,241 @@
+from . import DBTestCase
+from poff import db
+from poff.journal import prune_changes
+from poff.models import Domain, DomainMeta, Record, RecordChange
+
+import json
+import time
+
+
+class JournalTest(DBTestCase):
+
+    extra_config = (
+        'CHANGE_JOURNAL = True',
+    )
+
+    def set_up(self):
+        domain = Domain(name='test.com')
+        soa_record = Record(type='SOA', content='x y 2014010100', name='test.com', domain=domain)
+        record = Record(name='www.test.com', type='A', content='127.0.0.1', domain=domain)
+        self.domain_id, _, self.record_id = self.add_objects(domain, soa_record, record)
+
+
+    def serial(self):
+        with self.app.app_context():
+            return int(Domain.query.get(self.domain_id).soa_record.serial)
+
+
+    def get_changes(self, since):
+        response = self.client.get('/domains/%d/changes?since=%d' % (self.domain_id, since))
+        self.assert200(response)
+        return response.get_json()
+
+
+    def test_orm_changes(self):
+        initial_serial = self.serial()
+        self.assertEqual(self.get_changes(0), {'serial': initial_serial, 'changes': []})
+
+        response = self.client.post('/domains/%d/new_record' % self.domain_id, data={
+            'name': 'mail.test.com',
+            'type': 'A',
+            'content': '127.0.0.2',
+            'ttl': '300',
+        })
+        self.assertEqual(response.status_code, 302)
+        create_serial = self.serial()
+        with self.app.app_context():
+            record = Record.query.get(self.record_id)
+            record.content = '127.0.0.3'
+            db.session.commit()
+        update_serial = self.serial()
+        response = self.client.delete('/records/%d' % self.record_id)
+        self.assertEqual(response.status_code, 302)
+        delete_serial = self.serial()
+
+        changes = self.get_changes(initial_serial)
+        self.assertEqual(changes['serial'], delete_serial)
+        self.assertEqual([(c['serial'], c['action'], c['name'], c['content'])
+            for c in changes['changes']], [
+                (create_serial, 'create', 'mail.test.com', '127.0.0.2'),
+                (update_serial, 'update', 'www.test.com', '127.0.0.3'),
+                (delete_serial, 'delete', 'www.test.com', '127.0.0.3'),
+            ])
+        self.assertEqual(changes['changes'][0]['ttl'], 300)
+        self.assertEqual(changes['changes'][2]['id'], self.record_id)
+
+        changes = self.get_changes(update_serial)
+        self.assertEqual([c['action'] for c in changes['changes']], ['delete'])
+
+
+    def test_changeset(self):
+        initial_serial = self.serial()
+        with self.app.app_context():
+            record = Record(name='old.test.com', type='A', content='127.0.0.9',
+                domain_id=self.domain_id)
+            db.session.add(record)
+            db.session.commit()
+            old_id = record.id
+        serial = self.serial()
+
+        response = self.client.post('/api/v1/zones/%d/records' % self.domain_id,
+            content_type='application/json', data=json.dumps({
+                'create': [{'name': 'new.test.com', 'type': 'A', 'content': '127.0.0.4'}],
+                'update': [{'id': self.record_id, 'ttl': 60}],
+                'delete': [old_id],
+            }))
+        self.assert200(response)
+        changes = self.get_changes(serial)
+        self.assertEqual(sorted((c['action'], c['name'], c['ttl']) for c in changes['changes']), [
+            ('create', 'new.test.com', 3600),
+            ('delete', 'old.test.com', 3600),
+            ('update', 'www.test.com', 60),
+        ])
+        self.assertTrue(all(c['serial'] == self.serial() for c in changes['changes']))
+        with self.app.app_context():
+            new_id = Record.query.filter_by(name='new.test.com').one().id
+        self.assertIn(new_id, [c['id'] for c in changes['changes']])
+        self.assertEqual(len(self.get_changes(initial_serial)['changes']), 4)
+
+
+    def test_changeset_creates_inserted_in_bulk(self):
+        serial = self.serial()
+        creates = [{'name': 'host%d.test.com' % num, 'type': 'A', 'content': '127.0.0.1'}
+            for num in range(3)]
+        # Identical to an existing record, which mustn't be journaled as created
+        creates.append({'name': 'www.test.com', 'type': 'A', 'content': '127.0.0.1'})
+        with self.count_queries() as statements:
+            response = self.client.post('/api/v1/zones/%d/records' % self.domain_id,
+                content_type='application/json', data=json.dumps({'create': creates}))
+        self.assert200(response)
+        self.assertEqual(len([s for s in statements if s.startswith('INSERT INTO records')]), 1)
+
+        with self.app.app_context():
+            created_ids = set(record.id for record in Record.query.filter(
+                Record.domain_id == self.domain_id, Record.id != self.record_id,
+                Record.type != 'SOA'))
+        changes = self.get_changes(serial)['changes']
+        self.assertEqual(len(created_ids), 4)
+        self.assertEqual(set(c['id'] for c in changes), created_ids)
+        self.assertTrue(all(c['action'] == 'create' for c in changes))
+
+
+    def test_created_and_deleted_in_one_transaction(self):
+        serial = self.serial()
+        with self.app.app_context():
+            record = Record(name='tmp.test.com', type='A', content='127.0.0.9',
+                domain_id=self.domain_id)
+            db.session.add(record)
+            db.session.flush()
+            db.session.delete(record)
+            Record.query.get(self.record_id).ttl = 60
+            db.session.commit()
+        changes = self.get_changes(serial)['changes']
+        self.assertEqual([(c['action'], c['name']) for c in changes], [('update', 'www.test.com')])
+
+
+    def test_new_domain_not_journaled(self):
+        response = self.client.post('/domains', data={
+            'name': 'other.com',
+            'mname': 'ns1.other.com',
+            'rname': 'hostmaster@other.com',
+        })
+        self.assertEqual(response.status_code, 302)
+        with self.app.app_context():
+            self.assertEqual(Record.query.join(Domain).filter(Domain.name == 'other.com').count(),
+                2)
+            self.assertEqual(RecordChange.query.count(), 0)
+
+
+    def test_serial_wraparound(self):
+        with self.app.app_context():
+            db.session.add(DomainMeta(domain_id=self.domain_id,
+                kind=DomainMeta.SERIAL_STRATEGY_KIND, content='counter'))
+            Domain.query.get(self.domain_id).soa_record.serial = str(2**32 - 3)
+            db.session.commit()
+        # Bumped once by the commit
+        self.assertEqual(self.serial(), 2**32 - 2)
+        with self.app.app_context():
+            for ttl in (60, 120, 180):
+                Record.query.get(self.record_id).ttl = ttl
+                db.session.commit()
+
+        changes = self.get_changes(2**32 - 2)
+        self.assertEqual(changes['serial'], 2)
+        self.assertEqual([(c['serial'], c['ttl']) for c in changes['changes']],
+            [(2**32 - 1, 60), (1, 120), (2, 180)])
+        self.assertEqual([c['ttl'] for c in self.get_changes(2**32 - 1)['changes']], [120, 180])
+        self.assertEqual(self.get_changes(2)['changes'], [])
+
+        with self.app.app_context():
+            changes = RecordChange.query.order_by(RecordChange.id).all()
+            for change in changes[:2]:
+                change.created_at = int(time.time()) - 40*86400
+            db.session.commit()
+            self.assertEqual(prune_changes(30), 2)
+            db.session.commit()
+        response = self.client.get('/domains/%d/changes?since=%d' % (self.domain_id, 2**32 - 1))
+        self.assertEqual(response.status_code, 410)
+        self.assertEqual([c['ttl'] for c in self.get_changes(1)['changes']], [180])
+
+
+    def test_invalid_requests(self):
+        self.assert400(self.client.get('/domains/%d/changes' % self.domain_id))
+        self.assert400(self.client.get('/domains/%d/changes?since=foo' % self.domain_id))
+        self.assert404(self.client.get('/domains/1234/changes?since=0'))
+
+
+    def test_prune(self):
+        with self.app.app_context():
+            for ttl in (60, 120, 180):
+                Record.query.get(self.record_id).ttl = ttl
+                db.session.commit()
+            changes = RecordChange.query.order_by(RecordChange.id).all()
+            self.assertEqual(len(changes), 3)
+            old_serial = changes[0].serial
+            changes[0].created_at = int(time.time()) - 40*86400
+            db.session.commit()
+
+            self.assertEqual(prune_changes(30), 1)
+            db.session.commit()
+            meta = DomainMeta.query.filter_by(kind=DomainMeta.JOURNAL_PRUNED_KIND).one()
+            self.assertEqual(meta.content, str(old_serial))
+
+        response = self.client.get('/domains/%d/changes?since=0' % self.domain_id)
+        self.assertEqual(response.status_code, 410)
+        changes = self.get_changes(old_serial)['changes']
+        self.assertEqual([c['ttl'] for c in changes], [120, 180])
+
+        with self.app.app_context():
+            self.assertEqual(prune_changes(30, compact=True), 1)
+            db.session.commit()
+        changes = self.get_changes(old_serial)['changes']
+        self.assertEqual([c['ttl'] for c in changes], [180])
+
+
+    def test_compact_keeps_deletes(self):
+        serial = self.serial()
+        with self.app.app_context():
+            db.session.delete(Record.query.get(self.record_id))
+            db.session.commit()
+            # Like SQLite may do, reuse the id of the deleted record
+            db.session.add(Record(id=self.record_id, name='new.test.com', type='A',
+                content='127.0.0.2', domain_id=self.domain_id))
+            db.session.commit()
+            Record.query.get(self.record_id).ttl = 60
+            db.session.commit()
+
+            self.assertEqual(prune_changes(30, compact=True), 1)
+            db.session.commit()
+        changes = self.get_changes(serial)['changes']
+        self.assertEqual([(c['action'], c['name'], c['id']) for c in changes], [
+            ('delete', 'www.test.com', self.record_id),
+            ('update', 'new.test.com', self.record_id),
+        ])
+
+
+    def test_disabled(self):
+        self.app.config['CHANGE_JOURNAL'] = False
+        with self.app.app_context():
+            Record.query.get(self.record_id).ttl = 60
+            db.session.commit()
+            self.assertEqual(RecordChange.query.count(), 0)
@@ -0,0 +1,52 @@
+from . import FakeClock
+from poff.ratelimit import Counters, TokenBucketLimiter
+
+import unittest
+
+class TokenBucketLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limiter = TokenBucketLimiter(0.5, 2, max_keys=2, clock=self.clock)
+
+
+    def test_burst_then_limit(self):
+        self.assertEqual(self.limiter.consume('a'), 0)
+        self.assertEqual(self.limiter.consume('a'), 0)
+        self.assertEqual(self.limiter.consume('a'), 2)
+        # Other keys have their own bucket
+        self.assertEqual(self.limiter.consume('b'), 0)
+
+
+    def test_refill(self):
+        for _ in range(2):
+            self.limiter.consume('a')
+        self.clock.now = 1
+        self.assertEqual(self.limiter.consume('a'), 1)
+        self.clock.now = 3
+        self.assertEqual(self.limiter.consume('a'), 0)
+
+
+    def test_bounded_keys(self):
+        for key in ('a', 'b', 'c'):
+            self.limiter.consume(key)
+            self.limiter.consume(key)
+        # a has been dropped, and starts out full
+        self.assertEqual(self.limiter.consume('a'), 0)
+        self.assertNotEqual(self.limiter.consume('c'), 0)
+
+
+    def test_disabled(self):
+        limiter = TokenBucketLimiter(0, 0)
+        for _ in range(100):
+            self.assertEqual(limiter.consume('a'), 0)
+
+
+class CountersTest(unittest.TestCase):
+
+    def test_increment(self):
+        counters = Counters()
+        counters.increment('foo')
+        counters.increment('foo')
+        counters.increment('bar', 5)
+        self.assertEqual(counters.as_dict(), {'foo': 2, 'bar': 5})
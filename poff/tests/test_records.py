@@ -1,6 +1,9 @@
 from . import DBTestCase
+from poff import db
 from poff.models import Domain, Record
 
+import datetime
+
 class RecordTest(DBTestCase):
 
     def set_up(self):
@@ -105,3 +108,84 @@ class RecordTest(DBTestCase):
                     continue
                 self.assertEqual(record.name, subsubdomains[num] + '.subdomain.test.com')
                 num += 1
+
+
+    def test_reverse_name(self):
+        with self.app.app_context():
+            record = Record.query.get(self.record_id)
+            self.assertEqual(record.reverse_name, 'com.test.www')
+
+        data = {
+            'name': 'ftp.test.com',
+            'type': 'A',
+            'content': '127.0.0.2',
+        }
+        response = self.client.post('/records/%d' % self.record_id, data=data,
+            follow_redirects=True)
+        self.assert200(response)
+        with self.app.app_context():
+            record = Record.query.get(self.record_id)
+            self.assertEqual(record.reverse_name, 'com.test.ftp')
+
+
+    def test_records_in_subtree(self):
+        names = (
+            'int.test.com',
+            'a.int.test.com',
+            'b.a.int.test.com',
+            'aint.test.com',
+            'int.test.community',
+        )
+        self.add_objects(*[Record(name=name, type='A', content='127.0.0.1',
+            domain_id=self.domain_id) for name in names])
+        with self.app.app_context():
+            records = Record.query.filter(Record.in_subtree('int.test.com'))\
+                .order_by(Record.reverse_name)
+            self.assertEqual([r.name for r in records], [
+                'int.test.com',
+                'a.int.test.com',
+                'b.a.int.test.com',
+            ])
+
+
+    def test_records_without_reverse_name(self):
+        with self.app.app_context():
+            # Like records added by pdns itself
+            for name in ('a.www.test.com', 'mail.test.com', 'a_b.test.com'):
+                db.engine.execute("INSERT INTO records (domain_id, name, type, content) "
+                    "VALUES (?, ?, 'A', '127.0.0.1')", self.domain_id, name)
+            domain = Domain.query.get(self.domain_id)
+            self.assertEqual([r.name for r in domain.records], [
+                'test.com',
+                'a_b.test.com',
+                'mail.test.com',
+                'www.test.com',
+                'a.www.test.com',
+            ])
+            records = Record.query.filter(Record.in_subtree('www.test.com'))
+            self.assertEqual(sorted(r.name for r in records), ['a.www.test.com', 'www.test.com'])
+            self.assertEqual(Record.query.filter(Record.in_subtree('b.test.com')).count(), 0)
+
+
+    def test_one_serial_bump_per_transaction(self):
+        with self.app.app_context():
+            for num in range(5):
+                db.session.add(Record(name='host%d.test.com' % num, type='A',
+                    content='127.0.0.1', domain_id=self.domain_id))
+            db.session.flush()
+            Record.query.get(self.record_id).content = '127.0.0.2'
+            db.session.flush()
+            db.session.delete(Record.query.filter_by(name='host0.test.com').one())
+            db.session.commit()
+
+            today = datetime.datetime.now()
+            self.assertEqual(Record.query.get(self.soa_id).serial, today.strftime('%Y%m%d00'))
+
+
+    def test_no_serial_bump_for_unserved_changes(self):
+        with self.app.app_context():
+            record = Record.query.get(self.record_id)
+            record.reverse_name = None
+            db.session.commit()
+
+            self.assertEqual(Record.query.get(self.soa_id).serial, '2014010100')
@@ -0,0 +1,62 @@
+from . import DBTestCase
+from poff import db
+from poff.models import Domain, Record
+
+import os
+import tempfile
+
+class ReplicaTest(DBTestCase):
+
+    use_file_database = True
+
+    def _set_up(self):
+        replica_fd, self.replica_file = tempfile.mkstemp(suffix='.sqlite')
+        os.close(replica_fd)
+        self.extra_config = [
+            'SQLALCHEMY_REPLICA_DATABASE_URI = "sqlite:///%s"' % self.replica_file,
+        ]
+        super(ReplicaTest, self)._set_up()
+
+
+    def _tear_down(self):
+        super(ReplicaTest, self)._tear_down()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.replica_file + suffix):
+                os.remove(self.replica_file + suffix)
+
+
+    def set_up(self):
+        self.replica_engine = db.get_replica_engine(self.app)
+        db.metadata.create_all(self.replica_engine)
+        self.add_objects(Domain(name='primary.com'))
+        self.replica_engine.execute("INSERT INTO domains (name, type) VALUES ('replica.com', 'NATIVE')")
+
+
+    def test_get_reads_from_replica(self):
+        response = self.client.get('/')
+        self.assert200(response)
+        self.assertIn(b'replica.com', response.data)
+        self.assertNotIn(b'primary.com', response.data)
+
+        response = self.client.get('/api/v1/zones')
+        self.assertEqual([zone['name'] for zone in response.get_json()['zones']], ['replica.com'])
+
+
+    def test_writes_go_to_primary(self):
+        response = self.client.post('/domains', data={'name': 'test.com'})
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('poff-read-primary=1', response.headers['Set-Cookie'])
+        with self.app.app_context():
+            self.assertEqual(Record.query.filter_by(name='test.com', type='SOA').count(), 1)
+        self.assertEqual(self.replica_engine.execute('SELECT count(*) FROM records').scalar(), 0)
+
+        # Read your writes after the redirect
+        response = self.client.get('/')
+        self.assertIn(b'test.com', response.data)
+        self.assertNotIn(b'replica.com', response.data)
+
+
+    def test_no_cookie_without_redirect(self):
+        response = self.client.post('/update-record', data={'key': 'hopefully invalid'})
+        self.assertForbidden(response)
+        self.assertNotIn('Set-Cookie', response.headers)
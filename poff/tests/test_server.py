@@ -0,0 +1,49 @@
+from . import DBTestCase
+from poff.server import PreforkServer
+
+import os
+import signal
+import time
+import urllib.request
+
+class PreforkServerTest(DBTestCase):
+
+    use_file_database = True
+
+    def test_serve_and_stop(self):
+        server = PreforkServer(self.app, '127.0.0.1', 0, workers=2, max_requests=2,
+            graceful_timeout=5)
+        pid = os.fork()
+        if not pid:
+            try:
+                server.run()
+            finally:
+                os._exit(0)
+        server.server.server_close()
+
+        try:
+            # Enough requests to recycle all the workers
+            for _ in range(6):
+                response = urllib.request.urlopen('http://127.0.0.1:%d/' % server.port, timeout=10)
+                self.assertEqual(response.status, 200)
+        finally:
+            os.kill(pid, signal.SIGTERM)
+            _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+
+
+    def test_backoff_on_failing_workers(self):
+        server = PreforkServer(self.app, '127.0.0.1', 0, workers=1)
+        def fail():
+            raise RuntimeError('Failed to start')
+        server._run_worker = fail
+        try:
+            delays = []
+            for _ in range(3):
+                server._spawn()
+                server._reap(block=True)
+                delays.append(server._next_spawn - time.monotonic())
+        finally:
+            server.server.server_close()
+        self.assertEqual(server._quick_failures, 3)
+        self.assertTrue(0 < delays[0] < delays[1] < delays[2] <= 0.4, delays)
@@ -0,0 +1,194 @@
+from . import DBTestCase
+from poff import db
+from poff.models import Domain, DomainMeta, Record
+from poff.zonefile import ZoneFileError, ZoneRecord, export_zone, import_zone, parse_zone
+
+import json
+import textwrap
+import unittest
+
+ZONE = textwrap.dedent('''\
+    $TTL 1h
+    $ORIGIN example.com.
+    @   IN  SOA ns1 hostmaster.example.com. (
+                2020010100 ; serial
+                3600 600 86400 300 )
+        IN  NS  ns1
+        IN  NS  ns.other.net.
+        IN  MX  10 mail
+    ns1 300 IN A 192.0.2.1
+    www     IN 1d CNAME @
+    txt     TXT "v=spf1 -all; not a comment" "second"
+    _sip._tcp SRV 10 60 5060 sip
+''')
+
+
+class ParseZoneTest(unittest.TestCase):
+
+    def test_parse(self):
+        records = list(parse_zone(ZONE.splitlines(True)))
+        self.assertEqual(records, [
+            ZoneRecord(3, 'example.com', 'SOA', 3600, None,
+                'ns1.example.com hostmaster.example.com 2020010100 3600 600 86400 300'),
+            ZoneRecord(6, 'example.com', 'NS', 3600, None, 'ns1.example.com'),
+            ZoneRecord(7, 'example.com', 'NS', 3600, None, 'ns.other.net'),
+            ZoneRecord(8, 'example.com', 'MX', 3600, 10, 'mail.example.com'),
+            ZoneRecord(9, 'ns1.example.com', 'A', 300, None, '192.0.2.1'),
+            ZoneRecord(10, 'www.example.com', 'CNAME', 86400, None, 'example.com'),
+            ZoneRecord(11, 'txt.example.com', 'TXT', 3600, None,
+                '"v=spf1 -all; not a comment" "second"'),
+            ZoneRecord(12, '_sip._tcp.example.com', 'SRV', 3600, 10, '60 5060 sip.example.com'),
+        ])
+
+
+    def test_origin_argument(self):
+        records = list(parse_zone(['www A 192.0.2.1\n'], origin='Example.com.'))
+        self.assertEqual(records[0].name, 'www.example.com')
+
+
+    def test_ttl_units(self):
+        records = list(parse_zone(['$TTL 1h30\n', 'www.example.com. 1W2d A 192.0.2.1\n',
+            'mail.example.com. A 192.0.2.2\n']))
+        self.assertEqual([record.ttl for record in records], [777600, 3630])
+
+
+    def test_errors(self):
+        for zone, message in (
+                ('www A 192.0.2.1', 'line 1: Relative name www without an origin'),
+                ('www.example.com. IN FOO bar', 'line 1: Unsupported record type FOO'),
+                ('www.example.com. CH A 192.0.2.1', 'line 1: Unsupported class CH'),
+                ('$INCLUDE other.zone', 'line 1: Unsupported directive $INCLUDE'),
+                ('example.com. SOA ( a. b. 1', 'line 1: Unbalanced parentheses'),
+                ('example.com. TXT "foo', 'line 1: Unterminated string'),
+                ('example.com. MX mail.example.com.', 'line 1: Invalid priority'),
+                ):
+            with self.assertRaises(ZoneFileError) as context:
+                list(parse_zone(zone.splitlines(True)))
+            self.assertEqual(str(context.exception), message)
+
+
+class ImportZoneTest(DBTestCase):
+
+    def test_import(self):
+        with self.app.app_context():
+            domain, count = import_zone(ZONE.splitlines(True))
+            db.session.commit()
+            self.assertEqual(count, 8)
+            domain = Domain.query.filter_by(name='example.com').one()
+            self.assertEqual(domain.soa_record.serial, '2020010100')
+            self.assertEqual(Record.query.filter_by(domain_id=domain.id).count(), 8)
+            mx = Record.query.filter_by(type='MX').one()
+            self.assertEqual((mx.prio, mx.content), (10, 'mail.example.com'))
+            self.assertEqual(mx.reverse_name, 'com.example')
+            kinds = set(meta.kind for meta in DomainMeta.query.filter_by(domain_id=domain.id))
+            self.assertEqual(kinds, set(['SOA-EDIT', 'NSEC3NARROW', 'NSEC3PARAMS']))
+
+
+    def test_import_many_records(self):
+        lines = ['example.com. SOA ns1.example.com. hostmaster.example.com. 1 2 3 4 5\n']
+        lines.extend('host%d.example.com. A 192.0.2.1\n' % num for num in range(250))
+        with self.app.app_context():
+            domain, count = import_zone(iter(lines))
+            db.session.commit()
+            self.assertEqual(count, 251)
+            self.assertEqual(Record.query.filter_by(domain_id=domain.id).count(), 251)
+
+
+    def test_import_errors(self):
+        for zone, message in (
+                ('www.example.com. A 192.0.2.1', 'The zone must start with its SOA record'),
+                ('example.com. SOA a. b. 1 2 3 4 5\nexample.com. SOA a. b. 1 2 3 4 5',
+                    'line 2: Only one SOA record is allowed'),
+                ('example.com. SOA a. b. 1 2 3 4 5\nwww.other.com. A 192.0.2.1',
+                    'line 2: www.other.com is outside of example.com'),
+                ):
+            with self.app.app_context():
+                with self.assertRaises(ZoneFileError) as context:
+                    import_zone(zone.splitlines(True))
+                self.assertEqual(str(context.exception), message)
+                db.session.rollback()
+
+
+    def test_api_import(self):
+        response = self.client.post('/api/v1/zones/import', data=ZONE.encode('utf-8'),
+            content_type='text/dns')
+        self.assert201(response)
+        self.assertEqual(response.get_json()['name'], 'example.com')
+        self.assertEqual(response.get_json()['record_count'], 8)
+
+        response = self.client.post('/api/v1/zones/import', data=ZONE.encode('utf-8'),
+            content_type='text/dns')
+        self.assert400(response)
+        self.assertEqual(response.get_json(), {'errors': ['Domain example.com already exists']})
+
+
+    def test_api_import_error_rolls_back(self):
+        zone = 'example.com. SOA a. b. 1 2 3 4 5\nwww.example.com. FOO bar\n'
+        response = self.client.post('/api/v1/zones/import', data=zone.encode('utf-8'),
+            content_type='text/dns')
+        self.assert400(response)
+        self.assertEqual(response.get_json(), {'errors': ['line 2: Unsupported record type FOO']})
+        with self.app.app_context():
+            self.assertEqual(Domain.query.count(), 0)
+
+
+class ExportZoneTest(DBTestCase):
+
+    def set_up(self):
+        with self.app.app_context():
+            domain, _ = import_zone(ZONE.splitlines(True))
+            db.session.commit()
+            self.domain_id = domain.id
+
+
+    def test_export_roundtrip(self):
+        with self.app.app_context():
+            domain = Domain.query.get(self.domain_id)
+            lines = list(export_zone(domain))
+        self.assertEqual(lines[0], '$ORIGIN example.com.\n')
+        self.assertEqual(lines[1], 'example.com.\t3600\tIN\tSOA\tns1.example.com. '
+            'hostmaster.example.com. 2020010100 3600 600 86400 300\n')
+        exported = [record[1:] for record in parse_zone(lines)]
+        original = [record[1:] for record in parse_zone(ZONE.splitlines(True))]
+        self.assertEqual(sorted(exported), sorted(original))
+
+
+    def test_export_without_ttl(self):
+        with self.app.app_context():
+            # pdns allows records without a TTL
+            Record.query.filter_by(name='www.example.com').one().ttl = None
+            db.session.commit()
+            lines = list(export_zone(Domain.query.get(self.domain_id)))
+        self.assertIn('www.example.com.\t3600\tIN\tCNAME\texample.com.\n', lines)
+
+
+    def test_export_endpoint(self):
+        response = self.client.get('/domains/%d/export' % self.domain_id)
+        self.assert200(response)
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(response.headers['Content-Disposition'],
+            'attachment; filename="example.com.zone"')
+        self.assertIn(b'www.example.com.\t86400\tIN\tCNAME\texample.com.\n', response.data)
+
+
+    def test_export_ndjson(self):
+        with self.app.app_context():
+            record = Record.query.filter_by(name='www.example.com').one()
+            record.disabled = True
+            db.session.commit()
+        response = self.client.get('/domains/%d/export?format=ndjson' % self.domain_id)
+        self.assert200(response)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        records = [json.loads(line) for line in response.data.decode('utf-8').splitlines()]
+        self.assertEqual(len(records), 8)
+        self.assertEqual(records[0]['type'], 'SOA')
+        www = [r for r in records if r['name'] == 'www.example.com'][0]
+        self.assertEqual(www['disabled'], True)
+
+        response = self.client.get('/domains/%d/export' % self.domain_id)
+        self.assertIn(b'; www.example.com.', response.data)
+
+
+    def test_export_invalid_format(self):
+        self.assert400(self.client.get('/domains/%d/export?format=xml' % self.domain_id))
+        self.assert404(self.client.get('/domains/1234/export'))
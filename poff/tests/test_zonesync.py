@@ -0,0 +1,143 @@
+from . import DBTestCase
+from poff import db
+from poff.models import Domain, DynDNSClient, Record, RecordChange
+from poff.zonefile import import_zone
+from poff.zonesync import ZoneSyncError, apply_diff, diff_zone, load_zone
+
+import textwrap
+import unittest
+
+ZONE = textwrap.dedent('''\
+    $ORIGIN example.com.
+    @   3600 IN SOA ns1 hostmaster 2020010100 3600 600 86400 300
+        3600 IN NS  ns1
+        3600 IN MX  10 mail
+    ns1 300  IN A   192.0.2.1
+    txt 3600 IN TXT "hello"
+''')
+
+DEFINITION = textwrap.dedent('''\
+    domain: example.com
+    records:
+      - {name: '@', type: NS, content: ns1.example.com}
+      - {name: '@', type: MX, content: mail.example.com, prio: 20}
+      - {name: ns1, type: A, content: 192.0.2.1, ttl: 300}
+      - {name: www.example.com., type: A, content: 192.0.2.2, ttl: 60}
+''')
+
+
+class LoadZoneTest(unittest.TestCase):
+
+    def test_load(self):
+        domain_name, desired = load_zone(DEFINITION)
+        self.assertEqual(domain_name, 'example.com')
+        self.assertEqual(desired, {
+            ('example.com', 'NS', 'ns1.example.com'): (3600, None, False),
+            ('example.com', 'MX', 'mail.example.com'): (3600, 20, False),
+            ('ns1.example.com', 'A', '192.0.2.1'): (300, None, False),
+            ('www.example.com', 'A', '192.0.2.2'): (60, None, False),
+        })
+
+
+    def test_errors(self):
+        for definition, message in (
+                ('- foo', 'Expected a mapping with the domain name in "domain"'),
+                ('domain: example.com\nrecords: {}', 'Expected "records" to be a list'),
+                ('domain: example.com\nrecords: [{name: www, type: A}]',
+                    'records[0]: content is required'),
+                ('domain: example.com\nrecords: [{name: www, type: FOO, content: bar}]',
+                    'records[0]: Unsupported record type FOO'),
+                ('domain: example.com\nrecords: [{name: "@", type: SOA, content: a b 1}]',
+                    "records[0]: SOA records can't be managed"),
+                ('domain: example.com\nrecords: [{name: www.other.com., type: A, content: x}]',
+                    'records[0]: www.other.com is outside of example.com'),
+                ('domain: example.com\nrecords: [{name: www, type: A, content: x, ttl: 1h}]',
+                    'records[0]: ttl and prio must be integers'),
+                ('domain: example.com\nrecords: [{name: www, type: A, content: x}, '
+                    '{name: www, type: A, content: x}]',
+                    'records[1]: Duplicate record www.example.com A x'),
+                ):
+            with self.assertRaises(ZoneSyncError) as context:
+                load_zone(definition)
+            self.assertEqual(str(context.exception), message)
+
+
+class ApplyZoneTest(DBTestCase):
+
+    extra_config = (
+        'CHANGE_JOURNAL = True',
+    )
+
+    def set_up(self):
+        with self.app.app_context():
+            domain, _ = import_zone(ZONE.splitlines(True))
+            db.session.commit()
+            self.domain_id = domain.id
+
+
+    def test_diff(self):
+        _, desired = load_zone(DEFINITION)
+        with self.app.app_context():
+            diff = diff_zone(Domain.query.get(self.domain_id), desired)
+        self.assertEqual([(r['name'], r['type'], r['content']) for r in diff.creates],
+            [('www.example.com', 'A', '192.0.2.2')])
+        self.assertEqual([(r['name'], r['type'], r['prio']) for r in diff.updates],
+            [('example.com', 'MX', 20)])
+        self.assertEqual([(r['name'], r['type']) for r in diff.deletes],
+            [('txt.example.com', 'TXT')])
+
+
+    def test_apply(self):
+        _, desired = load_zone(DEFINITION)
+        with self.app.app_context():
+            domain = Domain.query.get(self.domain_id)
+            ns1_id = Record.query.filter_by(name='ns1.example.com').one().id
+            apply_diff(domain, diff_zone(domain, desired))
+            db.session.commit()
+
+            records = Record.query.filter_by(domain_id=self.domain_id)\
+                .filter(Record.type != 'SOA')
+            self.assertEqual(sorted((r.name, r.type, r.content, r.ttl, r.prio) for r in records), [
+                ('example.com', 'MX', 'mail.example.com', 3600, 20),
+                ('example.com', 'NS', 'ns1.example.com', 3600, None),
+                ('ns1.example.com', 'A', '192.0.2.1', 300, None),
+                ('www.example.com', 'A', '192.0.2.2', 60, None),
+            ])
+            # Unchanged records are kept as they are
+            self.assertEqual(Record.query.filter_by(name='ns1.example.com').one().id, ns1_id)
+            www = Record.query.filter_by(name='www.example.com').one()
+            self.assertEqual(www.reverse_name, 'com.example.www')
+            serial = Domain.query.get(self.domain_id).soa_record.serial
+            self.assertNotEqual(serial, '2020010100')
+            changes = RecordChange.query.filter_by(serial=int(serial))
+            self.assertEqual(sorted((c.action, c.type) for c in changes),
+                [('create', 'A'), ('delete', 'TXT'), ('update', 'MX')])
+
+            # Applying it again is a no-op which doesn't bump the serial
+            diff = diff_zone(domain, desired)
+            self.assertEqual(diff, ([], [], []))
+            apply_diff(domain, diff)
+            db.session.commit()
+            self.assertEqual(Domain.query.get(self.domain_id).soa_record.serial, serial)
+
+
+    def test_dyndns_records_are_kept(self):
+        with self.app.app_context():
+            record = Record.query.filter_by(name='ns1.example.com').one()
+            db.session.add(DynDNSClient(record=record))
+            db.session.commit()
+
+            domain = Domain.query.get(self.domain_id)
+            diff = diff_zone(domain, {})
+            self.assertEqual(sorted(r['type'] for r in diff.deletes), ['MX', 'NS', 'TXT'])
+            apply_diff(domain, diff)
+            db.session.commit()
+            self.assertEqual(Record.query.filter_by(name='ns1.example.com').count(), 1)
+
+            # The content of DynDNS records changes, so they aren't duplicated either
+            diff = diff_zone(domain, {
+                ('ns1.example.com', 'A', '192.0.2.9'): (300, None, False),
+                ('ns1.example.com', 'TXT', 'foo'): (300, None, False),
+            })
+            self.assertEqual([(r['name'], r['type']) for r in diff.creates],
+                [('ns1.example.com', 'TXT')])
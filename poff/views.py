@@ -1,12 +1,11 @@
-from . import db, base62
-from .models import (Domain, DomainForm, DynDNSClient, Record, RecordForm, DomainMeta, TsigKey,
-    TsigKeyForm)
+from . import db, dyndns, journal, zonefile
+from .models import (Domain, DomainForm, DomainOverview, DomainSummary, DynDNSClient, Record,
+    RecordForm, DomainMeta, TsigKey, TsigKeyForm)
 
-from flask import abort, redirect, render_template, flash, request, Blueprint
+from flask import (abort, current_app, jsonify, redirect, render_template, flash, request,
+    url_for, stream_with_context, Blueprint, Response)
 from flask.views import MethodView
 from logging import getLogger
-import os
-import hmac
 
 _logger = getLogger('poff.views')
 
@@ -15,9 +14,7 @@ mod = Blueprint('views', __name__)
 
 @mod.context_processor
 def default_context():
-    domains = Domain.query.order_by(Domain.name).all()
     return {
-        'domains': domains,
         'tsigkeyform': TsigKeyForm(),
         'domainform': DomainForm(),
         'recordform': RecordForm(),
@@ -26,46 +23,50 @@ def default_context():
 
 @mod.route('/')
 def main():
-    return render_template('domains.html')
+    return render_domain_index()
+
+
+def render_domain_index(**context):
+    """ Render a page of the domain list. """
+    page = request.args.get('page', 1, type=int)
+    per_page = current_app.config.get('DOMAINS_PER_PAGE', 50)
+    pagination = Domain.query.order_by(Domain.name).paginate(page=page, per_page=per_page)
+    context['pagination'] = pagination
+    context['domains'] = DomainSummary.load(pagination.items)
+    return render_template('domains.html', **context)
+
+
+def render_domain(domain, **context):
+    """ Render the page of a single domain with all its records. """
+    context['domain'] = DomainOverview.load([domain])[0]
+    return render_template('domain.html', **context)
+
+
+def redirect_to_domain(domain_id):
+    return redirect(url_for('.domain_details', domain_id=domain_id))
 
 
 @mod.route('/domains', methods=['POST'])
 def domains():
     form = DomainForm()
     if form.validate_on_submit():
-        domain = Domain()
         mname = form.mname.data or form.name.data
         rname = form.rname.data or 'hostmaster.' + form.name.data
-        del form['mname']
-        del form['rname']
-        form.populate_obj(domain)
-
-        soa_record = Record(content='%(mname)s %(rname)s 1970010100' % {
-                'mname': mname,
-                'rname': rname,
-            },
-            domain=domain,
-            type='SOA',
-            name=domain.name,
-        )
+        domain, soa_record = Domain.create(form.name.data, '%(mname)s %(rname)s 1970010100' % {
+            'mname': mname,
+            'rname': rname,
+        })
         soa_record.update_serial()
 
         spf_record = Record(content='v=spf1 -all', domain=domain, type='TXT',
             name=domain.name)
-
-        db.session.add(domain)
-        db.session.add(soa_record)
         db.session.add(spf_record)
-        db.session.add(DomainMeta(domain=domain, kind='SOA-EDIT', content='INCEPTION-INCREMENT'))
-        db.session.add(DomainMeta(domain=domain, kind='NSEC3NARROW', content='1'))
-        nsec3params = '1 0 1 %s' % os.urandom(16).hex()
-        db.session.add(DomainMeta(domain=domain, kind='NSEC3PARAMS', content=nsec3params))
         _logger.info('New domain saved: %s', domain.name)
         flash('New domain added successfully!', 'success')
     else:
         flash('Failed to validate new domain, check the errors in the form below', 'error')
         _logger.debug('New domain failed form validation.')
-        return render_template('domains.html', domainform=form), 400
+        return render_domain_index(domainform=form), 400
     return redirect('/')
 
 
@@ -105,6 +106,11 @@ class MethodOverrideView(MethodView):
 
 class DomainView(MethodOverrideView):
 
+    def get(self, domain_id):
+        domain = Domain.query.get_or_404(domain_id)
+        return render_domain(domain)
+
+
     def post(self, domain_id):
         domain = Domain.query.get_or_404(domain_id)
         form = DomainForm()
@@ -117,13 +123,12 @@ class DomainView(MethodOverrideView):
             abort(400)
 
         form.populate_obj(domain)
-        domain.update_soa()
-        return redirect('/')
+        return redirect_to_domain(domain.id)
 
 
     def delete(self, domain_id):
         domain = Domain.query.get_or_404(domain_id)
-        db.session.delete(domain)
+        domain.delete()
         _logger.info("Deleting domain %s", domain.name)
         flash('Domain %s deleted successfully' % domain.name, 'info')
         return redirect('/')
@@ -136,11 +141,9 @@ class RecordView(MethodOverrideView):
         form = RecordForm()
         if form.validate_on_submit():
             form.populate_obj(record)
-            domain = record.domain
-            domain.update_soa()
             _logger.info('Record %s modified', record.name)
             flash('Record successfully modified.', 'success')
-            return redirect('/')
+            return redirect_to_domain(record.domain_id)
         else:
             _logger.info('Record modification failed form validation: %s', form.errors)
             flash('Failed to validate record modifications', 'warning')
@@ -148,16 +151,50 @@ class RecordView(MethodOverrideView):
                 'form_errors': form.errors,
                 'recordform': form,
             }
-            return render_template('domains.html', **context), 400
+            return render_domain(record.domain, **context), 400
 
 
     def delete(self, record_id):
         record = Record.query.get_or_404(record_id)
-        record.domain.update_soa()
         db.session.delete(record)
         _logger.info("Deleting record %s", record.name)
         flash('Record %s deleted successfully.' % record.name, 'success')
-        return redirect('/')
+        return redirect_to_domain(record.domain_id)
+
+
+@mod.route('/domains/<int:domain_id>/export')
+def export_domain(domain_id):
+    """ Stream the records of the domain as a BIND zone file, or NDJSON with ?format=ndjson. """
+    domain = Domain.query.get_or_404(domain_id)
+    export_format = request.args.get('format', 'bind')
+    if export_format not in zonefile.EXPORT_FORMATS:
+        abort(400)
+    if export_format == 'ndjson':
+        mimetype, extension = 'application/x-ndjson', 'ndjson'
+    else:
+        mimetype, extension = 'text/plain', 'zone'
+    lines = zonefile.export_zone(domain, export_format)
+    return Response(stream_with_context(lines), mimetype=mimetype, headers={
+        'Content-Disposition': 'attachment; filename="%s.%s"' % (domain.name, extension),
+    })
+
+
+@mod.route('/domains/<int:domain_id>/changes')
+def domain_changes(domain_id):
+    """ The record changes of the domain after the serial given by ?since=, as JSON. A 410 means
+    the changes have been pruned and the whole zone must be read again.
+    """
+    domain = Domain.query.get_or_404(domain_id)
+    try:
+        since = int(request.args['since'])
+    except (KeyError, ValueError):
+        abort(400)
+    try:
+        changes = [journal.change_json(change)
+            for change in journal.changes_since(domain.id, since)]
+    except journal.ChangesPrunedError as error:
+        return jsonify(errors=[str(error)]), 410
+    return jsonify(serial=int(domain.soa_record.serial), changes=changes)
 
 
 @mod.route('/domains/<int:domain_id>/new_record', methods=['POST'])
@@ -173,15 +210,14 @@ def new_record(domain_id):
         if record.type == 'MX':
             record.prio = record.prio or 0
 
-        domain.update_soa()
         db.session.add(record)
         _logger.info('New record saved: %s', record.name)
         flash('New record saved successfully!', 'success')
     else:
         _logger.debug('Record failed form validation')
         flash('Failed to validate new record, check the errors in the form below!', 'warning')
-        return render_template('domains.html', recordform=form), 400
-    return redirect('/')
+        return render_domain(domain, recordform=form), 400
+    return redirect_to_domain(domain.id)
 
 
 @mod.route('/domains/<int:domain_id>/tsigkeys', methods=['POST'])
@@ -192,7 +228,7 @@ def domain_tsigkeys(domain_id):
     if not form.validate_on_submit():
         _logger.debug('TsigKey failed form validation')
         flash('Failed to validate new DynDNS key', 'warning')
-        return render_template('domains.html', tsigkeyform=form), 400
+        return render_domain(domain, tsigkeyform=form), 400
 
     tsigkey = TsigKey()
     form.populate_obj(tsigkey)
@@ -205,7 +241,7 @@ def domain_tsigkeys(domain_id):
 
     _logger.info('Added tsigkey for for "%s"', domain.name)
     flash('New dyndns key added successfully!', 'success')
-    return redirect('/')
+    return redirect_to_domain(domain.id)
 
 
 class TsigKeyView(MethodOverrideView):
@@ -221,17 +257,20 @@ class TsigKeyView(MethodOverrideView):
 
         _logger.info('DynDNS key %s deleted', tsigkey.name)
         flash('DynDNS key %s deleted' % tsigkey.name, 'success')
-        return redirect('/')
+        return redirect_to_domain(domain.id)
 
 
 @mod.route('/records/<int:record_id>/new-dyndns-client', methods=['POST'])
 def new_dyndns_client(record_id):
     record = Record.query.get_or_404(record_id)
+    shared_client = DynDNSClient.find_shared(record)
     client = DynDNSClient(record=record)
+    if shared_client:
+        client.share_key(shared_client)
     db.session.add(client)
     _logger.info('New DynDNS client created for record %s', record.name)
     flash('New DynDNS client created!', 'success')
-    return redirect('/')
+    return redirect_to_domain(record.domain_id)
 
 
 @mod.route('/records/<int:record_id>/rekey', methods=['POST'])
@@ -239,35 +278,36 @@ def rekey_dyndns_record(record_id):
     record = Record.query.get(record_id)
     if not record or not record.dyndns_client:
         abort(404)
-    dyndns_client = record.dyndns_client
-    dyndns_client.set_new_key()
-    return redirect('/')
+    record.dyndns_client.rekey()
+    return redirect_to_domain(record.domain_id)
 
 
 @mod.route('/update-record', methods=['POST'])
 def update_record():
-    record_name = request.form.get('record')
-    record = Record.query.filter_by(name=record_name, type='A').first()
-    if not record or not record.dyndns_client:
-        abort(404)
-    submitted_key = str(request.form.get('key', ''))
-    record_key = base62.encode(record.dyndns_client.key)
-    if hmac.compare_digest(submitted_key, record_key):
-        origin_ip = request.access_route[0]
-        if origin_ip.startswith('::ffff:'):
-            origin_ip = origin_ip[len('::ffff:'):]
-        if record.content != origin_ip:
-            _logger.info('Updating record %s to %s', record.name, origin_ip)
-            flash('Successfully updated record to new IP: %s' % origin_ip, 'success')
-            record.content = origin_ip
-            record.domain.update_soa()
-            return '', 201
-        else:
-            flash('Still on the same IP, no change applied', 'success')
-            return ''
-    else:
-        _logger.warning('Bad auth for trying to update record %s', record.name)
-        abort(403)
+    result = dyndns.update(request.form, request.access_route)
+    return dyndns_response(result)
+
+
+def dyndns_response(result):
+    """ Create the response to a DynDNS update.
+
+    If DYNDNS_STATELESS is set (the default) the session isn't used, and the body is a short status
+    line like `updated 1.2.3.4`, or a JSON object if the client prefers JSON. Otherwise the message
+    is flashed, like for the rest of the views.
+    """
+    if not current_app.config['DYNDNS_STATELESS']:
+        if result.status_code >= 400:
+            # Returned rather than aborted to keep headers like Retry-After
+            return dyndns.STATUSES[result.status_code], result.status_code, result.headers
+        flash(result.message, 'success')
+        return '', result.status_code
+
+    prefer_json = request.accept_mimetypes.best_match(['text/plain', 'application/json']) \
+        == 'application/json'
+    body, content_type = dyndns.format_body(result, prefer_json)
+    headers = dict(result.headers)
+    headers['Content-Type'] = content_type
+    return body, result.status_code, headers
 
 
 class DynDNSClientView(MethodOverrideView):
@@ -277,7 +317,7 @@ class DynDNSClientView(MethodOverrideView):
         db.session.delete(client)
         _logger.info('DynDNS client for record %s deleted.', client.record.name)
         flash('DynDNS client deleted!')
-        return redirect('/')
+        return redirect_to_domain(client.record.domain_id)
 
 
 mod.add_url_rule('/domains/<int:domain_id>', view_func=DomainView.as_view('domain_details'))
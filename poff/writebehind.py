@@ -0,0 +1,121 @@
+from collections import OrderedDict
+from logging import getLogger
+import os
+import threading
+
+_logger = getLogger('poff.writebehind')
+
+
+class WriteBehindQueue(object):
+    """ Queues DynDNS record updates, and writes them in batches from a background thread.
+
+    Every `interval` seconds the queued updates are written in one transaction, so the SOA serial
+    of each zone is bumped once per batch. Updates to the same record are coalesced, the last one
+    wins. At most `max_size` records are queued, `put` returns False when full and the caller
+    should write the update itself.
+    """
+
+    def __init__(self, app, interval, max_size):
+        self.app = app
+        self.interval = interval
+        self.max_size = max_size
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+        self._pid = None
+
+
+    def put(self, record_id, domain_id, content):
+        """ Queue setting the content of a record. Returns False if the queue is full or stopped. """
+        with self._lock:
+            if self._stopped:
+                return False
+            self._ensure_worker()
+            if record_id not in self._pending and len(self._pending) >= self.max_size:
+                return False
+            self._pending[record_id] = (domain_id, content)
+            return True
+
+
+    def pending(self, record_id):
+        """ Get the queued content of a record, or None if there's no queued update. """
+        with self._lock:
+            update = self._pending.get(record_id)
+        return update[1] if update else None
+
+
+    def __len__(self):
+        return len(self._pending)
+
+
+    def flush(self):
+        """ Write all queued updates in one transaction. Returns the number of records updated.
+
+        Records deleted since their update was queued are skipped.
+        """
+        from . import db
+        from .models import Record, invalidate_dyndns_cache, journal_changes, mark_zone_changed
+        records = Record.__table__
+
+        with self._lock:
+            pending, self._pending = self._pending, OrderedDict()
+        if not pending:
+            return 0
+        with self.app.app_context():
+            try:
+                # Unlike bulk_update_mappings this doesn't fail if a record no longer exists
+                result = db.session.execute(records.update()
+                    .where(records.c.id == db.bindparam('record_id'))
+                    .values(content=db.bindparam('new_content')), [
+                        {'record_id': record_id, 'new_content': content}
+                        for record_id, (_, content) in pending.items()
+                    ])
+                updated = result.rowcount if result.rowcount >= 0 else len(pending)
+                records_by_domain = {}
+                for record_id, (domain_id, _) in pending.items():
+                    records_by_domain.setdefault(domain_id, []).append(record_id)
+                for domain_id, record_ids in records_by_domain.items():
+                    mark_zone_changed(domain_id)
+                    journal_changes(domain_id, 'update', record_ids)
+                invalidate_dyndns_cache(record_ids=list(pending))
+                db.session.commit()
+            except Exception: # pylint: disable=broad-except
+                db.session.rollback()
+                _logger.exception('Failed to write %d queued DynDNS updates', len(pending))
+                return 0
+        _logger.debug('Wrote %d queued DynDNS updates', updated)
+        return updated
+
+
+    def stop(self):
+        """ Stop the worker and write the remaining updates. """
+        with self._lock:
+            self._stopped = True
+            thread, self._thread = self._thread, None
+        self._wakeup.set()
+        if thread and self._pid == os.getpid():
+            thread.join()
+        self.flush()
+
+
+    def _ensure_worker(self):
+        # Threads doesn't survive a fork, and the queued updates belong to the parent
+        pid = os.getpid()
+        if self._pid != pid:
+            self._pid = pid
+            self._pending = OrderedDict()
+            self._thread = None
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='poff-write-behind')
+            self._thread.daemon = True
+            self._thread.start()
+
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.interval)
+            if self._stopped:
+                break
+            self.flush()
@@ -0,0 +1,303 @@
+from . import db
+from .models import Domain, Record, _RECORD_TYPES, in_tree_order, reverse_name
+
+from collections import namedtuple
+import json
+import re
+
+# Rows per INSERT statement, with 8 columns per row this stays below the bound parameter limit
+# of older SQLite versions
+_BATCH_SIZE = 100
+
+_CLASSES = ('IN', 'CH', 'HS', 'CS')
+
+# Used for records without a TTL, like the default-ttl of pdns
+_DEFAULT_TTL = 3600
+
+_TTL_UNITS = {
+    's': 1,
+    'm': 60,
+    'h': 3600,
+    'd': 86400,
+    'w': 604800,
+}
+
+_TTL_RE = re.compile(r'^(\d+[smhdw]?)+$', re.IGNORECASE)
+
+# Positions of the domain names in the record data of each type, which are made absolute
+_NAME_FIELDS = {
+    'AFSDB': (1,),
+    'ALIAS': (0,),
+    'CNAME': (0,),
+    'MX': (1,),
+    'NS': (0,),
+    'PTR': (0,),
+    'RP': (0, 1),
+    'SOA': (0, 1),
+    'SRV': (3,),
+}
+
+# Types where the first field of the record data is stored in the prio column
+_PRIO_TYPES = ('MX', 'SRV')
+
+# Rows fetched from the database at a time when exporting
+_EXPORT_WINDOW = 1000
+
+EXPORT_FORMATS = ('bind', 'ndjson')
+
+
+ZoneRecord = namedtuple('ZoneRecord', ['line', 'name', 'type', 'ttl', 'prio', 'content'])
+
+
+class ZoneFileError(Exception):
+    pass
+
+
+def parse_zone(lines, origin=None, default_ttl=_DEFAULT_TTL):
+    """ Parse a BIND master file, yielding a `ZoneRecord` for each record.
+
+    `lines` can be any iterable of lines, like an open file, and is only read as far as needed.
+    Names are returned absolute without the trailing dot, as pdns stores them. Raises
+    `ZoneFileError` for invalid or unsupported content.
+    """
+    origin = _strip_dot(origin.lower()) if origin else None
+    ttl = None
+    owner = None
+    for line_number, tokens, owner_omitted in _logical_lines(lines):
+        if tokens[0].startswith('$'):
+            directive = tokens[0].upper()
+            if directive == '$ORIGIN' and len(tokens) == 2:
+                origin = absolute_name(tokens[1], origin, line_number)
+            elif directive == '$TTL' and len(tokens) == 2:
+                ttl = _parse_ttl(tokens[1], line_number)
+            else:
+                raise ZoneFileError('line %d: Unsupported directive %s' % (line_number,
+                    tokens[0]))
+            continue
+
+        if not owner_omitted:
+            owner = absolute_name(tokens.pop(0), origin, line_number)
+        elif owner is None:
+            raise ZoneFileError('line %d: Missing owner name' % line_number)
+
+        # The TTL and class are optional, and can come in any order
+        record_ttl = None
+        while tokens:
+            token = tokens[0]
+            if token.upper() in _CLASSES:
+                if token.upper() != 'IN':
+                    raise ZoneFileError('line %d: Unsupported class %s' % (line_number, token))
+            elif record_ttl is None and _TTL_RE.match(token):
+                record_ttl = _parse_ttl(token, line_number)
+            else:
+                break
+            tokens.pop(0)
+        if not tokens:
+            raise ZoneFileError('line %d: Missing record type' % line_number)
+
+        record_type = tokens.pop(0).upper()
+        if record_type not in _RECORD_TYPES:
+            raise ZoneFileError('line %d: Unsupported record type %s' % (line_number,
+                record_type))
+        if not tokens:
+            raise ZoneFileError('line %d: Missing record data' % line_number)
+        for index in _NAME_FIELDS.get(record_type, ()):
+            if index < len(tokens):
+                tokens[index] = absolute_name(tokens[index], origin, line_number)
+        prio = None
+        if record_type in _PRIO_TYPES:
+            try:
+                prio = int(tokens.pop(0))
+            except ValueError:
+                raise ZoneFileError('line %d: Invalid priority' % line_number)
+
+        if record_ttl is None:
+            record_ttl = ttl if ttl is not None else default_ttl
+        yield ZoneRecord(line_number, owner, record_type, record_ttl, prio, ' '.join(tokens))
+
+
+def import_zone(lines, origin=None):
+    """ Create a domain from a BIND master file.
+
+    The file must start with the SOA record of the domain. The domain, its SOA record and metadata
+    are created like for domains created in the web interface, and the rest of the records are
+    inserted in batches as they're parsed. Nothing is committed. Returns the domain and the number
+    of records imported.
+    """
+    records = parse_zone(lines, origin)
+    soa = next(records, None)
+    if soa is None or soa.type != 'SOA':
+        raise ZoneFileError('The zone must start with its SOA record')
+    domain_name = soa.name
+    if Domain.query.filter_by(name=domain_name).first():
+        raise ZoneFileError('Domain %s already exists' % domain_name)
+
+    domain, soa_record = Domain.create(domain_name, soa.content)
+    soa_record.ttl = soa.ttl
+    db.session.flush()
+
+    count = 1
+    batch = []
+    for record in records:
+        if record.type == 'SOA':
+            raise ZoneFileError('line %d: Only one SOA record is allowed' % record.line)
+        if record.name != domain_name and not record.name.endswith('.' + domain_name):
+            raise ZoneFileError('line %d: %s is outside of %s' % (record.line, record.name,
+                domain_name))
+        batch.append({
+            'domain_id': domain.id,
+            'name': record.name,
+            'type': record.type,
+            'content': record.content,
+            'ttl': record.ttl,
+            'prio': record.prio,
+            'disabled': False,
+            'reverse_name': reverse_name(record.name),
+        })
+        count += 1
+        if len(batch) == _BATCH_SIZE:
+            _insert(batch)
+            batch = []
+    if batch:
+        _insert(batch)
+    return domain, count
+
+
+def export_zone(domain, export_format='bind'):
+    """ Export the records of a domain, yielding lines of a BIND zone file or NDJSON.
+
+    The SOA record comes first, followed by the rest sorted like in the web interface. Records are
+    streamed from the database and never loaded all at once. Disabled records are commented out
+    in the BIND format.
+    """
+    columns = (Record.id, Record.name, Record.type, Record.content, Record.ttl, Record.prio,
+        Record.disabled)
+    soa = db.session.query(*columns)\
+        .filter(Record.domain_id == domain.id, Record.type == 'SOA')
+    records = in_tree_order(db.session.query(*columns)\
+        .filter(Record.domain_id == domain.id, Record.type != 'SOA')\
+        .execution_options(stream_results=True)\
+        .yield_per(_EXPORT_WINDOW))
+
+    if export_format == 'ndjson':
+        for query in (soa, records):
+            for row in query:
+                yield json.dumps(row._asdict()) + '\n'
+        return
+
+    yield '$ORIGIN %s.\n' % domain.name
+    for query in (soa, records):
+        for row in query:
+            ttl = row.ttl if row.ttl is not None else _DEFAULT_TTL
+            line = '%s.\t%s\tIN\t%s\t%s\n' % (row.name, ttl, row.type,
+                _export_rdata(row.type, row.prio, row.content))
+            yield '; ' + line if row.disabled else line
+
+
+def _export_rdata(record_type, prio, content):
+    """ The inverse of the conversion done by `parse_zone`, making names absolute again. """
+    name_fields = _NAME_FIELDS.get(record_type)
+    if not name_fields:
+        return content
+    tokens = content.split()
+    if record_type in _PRIO_TYPES:
+        tokens.insert(0, str(prio or 0))
+    for index in name_fields:
+        if index < len(tokens) and not tokens[index].endswith('.'):
+            tokens[index] += '.'
+    return ' '.join(tokens)
+
+
+def _insert(rows):
+    db.session.execute(Record.__table__.insert().values(rows))
+
+
+def _logical_lines(lines):
+    """ Split the lines into tokens, joining lines within parentheses and stripping comments.
+
+    Yields a tuple of the line number the entry starts on, its tokens, and whether it starts with
+    whitespace, meaning the owner is the same as the previous entry.
+    """
+    tokens = []
+    start = None
+    owner_omitted = False
+    depth = 0
+    for line_number, line in enumerate(lines, 1):
+        line = line.rstrip('\r\n')
+        if depth == 0:
+            start = line_number
+            owner_omitted = line[:1].isspace()
+        depth = _tokenize(line, tokens, depth, line_number)
+        if depth == 0 and tokens:
+            yield start, tokens, owner_omitted
+            tokens = []
+    if depth:
+        raise ZoneFileError('line %d: Unbalanced parentheses' % start)
+
+
+def _tokenize(line, tokens, depth, line_number):
+    """ Append the tokens of the line to `tokens`, and return the new parentheses depth. """
+    index = 0
+    length = len(line)
+    while index < length:
+        char = line[index]
+        if char.isspace():
+            index += 1
+        elif char == ';':
+            break
+        elif char == '(':
+            depth += 1
+            index += 1
+        elif char == ')':
+            depth -= 1
+            if depth < 0:
+                raise ZoneFileError('line %d: Unbalanced parentheses' % line_number)
+            index += 1
+        elif char == '"':
+            end = index + 1
+            while end < length and line[end] != '"':
+                end += 2 if line[end] == '\\' else 1
+            if end >= length:
+                raise ZoneFileError('line %d: Unterminated string' % line_number)
+            tokens.append(line[index:end + 1])
+            index = end + 1
+        else:
+            end = index
+            while end < length and not line[end].isspace() and line[end] not in ';()"':
+                end += 2 if line[end] == '\\' else 1
+            tokens.append(line[index:end])
+            index = end
+    return depth
+
+
+def absolute_name(name, origin, line_number=None):
+    """ Make a name from a zone file absolute, lowercased and without the trailing dot.
+
+    `@` is the origin, and names without a trailing dot are relative to it. Raises
+    `ZoneFileError` if the name is relative and there's no origin, mentioning the line number if
+    given.
+    """
+    location = 'line %d: ' % line_number if line_number is not None else ''
+    if name == '@':
+        if origin is None:
+            raise ZoneFileError('%s@ used without an origin' % location)
+        return origin
+    if name.endswith('.'):
+        return _strip_dot(name.lower())
+    if origin is None:
+        raise ZoneFileError('%sRelative name %s without an origin' % (location, name))
+    return '%s.%s' % (name.lower(), origin)
+
+
+def _strip_dot(name):
+    return name[:-1] if name.endswith('.') else name
+
+
+def _parse_ttl(value, line_number):
+    if value.isdigit():
+        return int(value)
+    if not _TTL_RE.match(value):
+        raise ZoneFileError('line %d: Invalid TTL %s' % (line_number, value))
+    # Like BIND, a number without a unit is in seconds, so 1h30 is 3630
+    return sum(int(number) * _TTL_UNITS[unit.lower() or 's']
+        for number, unit in re.findall(r'(\d+)([smhdw]?)', value, re.IGNORECASE))
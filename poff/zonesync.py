@@ -0,0 +1,140 @@
+from . import db
+from .models import (DynDNSClient, Record, _RECORD_TYPES, bulk_insert_records, journal_changes,
+    mark_zone_changed, reverse_name)
+from .zonefile import ZoneFileError, absolute_name
+
+from collections import namedtuple
+import yaml
+
+# Upper bound of ids per IN clause, to stay below the bound parameter limit of SQLite
+_CHUNK_SIZE = 500
+
+ZoneDiff = namedtuple('ZoneDiff', ['creates', 'updates', 'deletes'])
+
+
+class ZoneSyncError(Exception):
+    pass
+
+
+def load_zone(stream):
+    """ Load the desired state of a zone from YAML.
+
+    The YAML is a mapping with the `domain` name and a list of `records`, each with a `name`,
+    `type` and `content`, and optionally `ttl`, `prio` and `disabled`. Names are relative to the
+    domain unless they end with a dot, `@` is the domain itself. Returns the domain name and a
+    dict from (name, type, content) to the (ttl, prio, disabled) of each record.
+    """
+    zone = yaml.safe_load(stream)
+    if not isinstance(zone, dict) or not isinstance(zone.get('domain'), str):
+        raise ZoneSyncError('Expected a mapping with the domain name in "domain"')
+    domain_name = zone['domain'].lower().rstrip('.')
+    records = zone.get('records')
+    if records is None:
+        records = []
+    elif not isinstance(records, list):
+        raise ZoneSyncError('Expected "records" to be a list')
+
+    desired = {}
+    for index, record in enumerate(records):
+        def error(message):
+            return ZoneSyncError('records[%d]: %s' % (index, message))
+        if not isinstance(record, dict):
+            raise error('Expected a mapping')
+        for field in ('name', 'type', 'content'):
+            if not isinstance(record.get(field), (str, int)) or record[field] == '':
+                raise error('%s is required' % field)
+        record_type = str(record['type']).upper()
+        if record_type not in _RECORD_TYPES:
+            raise error('Unsupported record type %s' % record_type)
+        if record_type == 'SOA':
+            raise error("SOA records can't be managed")
+        try:
+            name = absolute_name(str(record['name']), domain_name)
+        except ZoneFileError:
+            raise error('Invalid name %s' % record['name'])
+        if name != domain_name and not name.endswith('.' + domain_name):
+            raise error('%s is outside of %s' % (name, domain_name))
+        ttl = record.get('ttl', 3600)
+        prio = record.get('prio')
+        if record_type == 'MX':
+            # Like the form does
+            prio = prio or 0
+        disabled = record.get('disabled', False)
+        if not isinstance(ttl, int) or (prio is not None and not isinstance(prio, int)):
+            raise error('ttl and prio must be integers')
+        if not isinstance(disabled, bool):
+            raise error('disabled must be a boolean')
+
+        key = (name, record_type, str(record['content']))
+        if key in desired:
+            raise error('Duplicate record %s %s %s' % key)
+        desired[key] = (ttl, prio, disabled)
+    return domain_name, desired
+
+
+def diff_zone(domain, desired):
+    """ Compare the desired records with the records of the domain.
+
+    Records are matched on name, type and content, a matched record is updated if its TTL, prio
+    or disabled flag differs. SOA records and records with a DynDNS client are left alone, as
+    they're changed outside of the zone definition, and desired records with the name and type of
+    a DynDNS record are skipped rather than created next to it. Returns a `ZoneDiff` with lists of
+    the records to create, update and delete, as mappings of their column values.
+    """
+    existing = db.session.query(Record.id, Record.name, Record.type, Record.content, Record.ttl,
+            Record.prio, Record.disabled)\
+        .outerjoin(DynDNSClient, DynDNSClient.record_id == Record.id)\
+        .filter(Record.domain_id == domain.id)\
+        .filter(Record.type != 'SOA')\
+        .filter(DynDNSClient.id.is_(None))\
+        .order_by(Record.id)
+
+    dyndns_keys = set(db.session.query(Record.name, Record.type)
+        .join(DynDNSClient, DynDNSClient.record_id == Record.id)
+        .filter(Record.domain_id == domain.id))
+    remaining = {key: attributes for key, attributes in desired.items()
+        if key[:2] not in dyndns_keys}
+    updates = []
+    deletes = []
+    for record_id, name, record_type, content, ttl, prio, disabled in existing:
+        attributes = remaining.pop((name, record_type, content), None)
+        if attributes is None:
+            deletes.append(dict(_columns(name, record_type, content, (ttl, prio, disabled)),
+                id=record_id))
+        elif attributes != (ttl, prio, bool(disabled)):
+            updates.append(dict(_columns(name, record_type, content, attributes), id=record_id))
+
+    creates = [dict(_columns(name, record_type, content, attributes), domain_id=domain.id,
+            reverse_name=reverse_name(name))
+        for (name, record_type, content), attributes in sorted(remaining.items())]
+    return ZoneDiff(creates, updates, deletes)
+
+
+def apply_diff(domain, diff):
+    """ Apply a diff from `diff_zone` to the session, marking the zone changed if anything changed
+    so the SOA serial is bumped once on commit. Nothing is committed.
+
+    The DynDNS caches are left alone, as records with DynDNS clients aren't part of diffs.
+    """
+    bulk_insert_records(domain.id, diff.creates)
+    db.session.bulk_update_mappings(Record, diff.updates)
+    record_ids = [record['id'] for record in diff.deletes]
+    journal_changes(domain.id, 'update', [record['id'] for record in diff.updates])
+    journal_changes(domain.id, 'delete', record_ids)
+    for start in range(0, len(record_ids), _CHUNK_SIZE):
+        chunk = record_ids[start:start + _CHUNK_SIZE]
+        Record.query.filter(Record.id.in_(chunk)).delete(synchronize_session=False)
+    if diff.creates or diff.updates or diff.deletes:
+        mark_zone_changed(domain.id)
+
+
+def _columns(name, record_type, content, attributes):
+    ttl, prio, disabled = attributes
+    return {
+        'name': name,
+        'type': record_type,
+        'content': content,
+        'ttl': ttl,
+        'prio': prio,
+        'disabled': disabled,
+    }
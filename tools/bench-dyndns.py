@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+Measure the CPU time spent per DynDNS update, with and without DYNDNS_STATELESS.
+
+Usage: ./venv/bin/python tools/bench-dyndns.py [<requests>]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from poff import create_app, db
+from poff.models import Domain, DynDNSClient, Record
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    runners = dict((stateless, setup(stateless)) for stateless in (False, True))
+    results = dict((stateless, []) for stateless in runners)
+    # Interleave the modes and keep the best round, to reduce noise
+    for _ in range(5):
+        for stateless, run in runners.items():
+            results[stateless].append(run(requests))
+    for stateless, rounds in results.items():
+        unchanged = min(r[0] for r in rounds)
+        changed = min(r[1] for r in rounds)
+        print('DYNDNS_STATELESS=%-5s  unchanged: %6.0fus/req  changed: %6.0fus/req' % (
+            stateless, unchanged*1e6, changed*1e6))
+
+
+def setup(stateless):
+    workdir = tempfile.mkdtemp()
+    config_file = os.path.join(workdir, 'config.py')
+    with open(config_file, 'w') as config_fh:
+        config_fh.write('\n'.join([
+            'SQLALCHEMY_DATABASE_URI = "sqlite://"',
+            'SECRET_KEY = "benchmark"',
+            'DYNDNS_DIGEST_KEY = "benchmark"',
+            'DYNDNS_STATELESS = %r' % stateless,
+            # Every request comes from the same few addresses
+            'DYNDNS_RATE_LIMIT_BURST = 0',
+        ]))
+    app = create_app(config_file)
+    with app.app_context():
+        db.create_all()
+        domain = Domain(name='bench.com')
+        soa_record = Record(name='bench.com', type='SOA', content='x y 1', domain=domain)
+        record = Record(name='www.bench.com', type='A', content='127.0.0.1', domain=domain)
+        dyndns_client = DynDNSClient(record=record)
+        db.session.add_all([domain, soa_record, record, dyndns_client])
+        db.session.commit()
+        key = dyndns_client.printable_key
+        db.engine.execute("INSERT INTO domainmetadata (domain_id, kind, content) "
+            "VALUES (%d, 'X-POFF-SERIAL', 'counter')" % domain.id)
+
+    # DynDNS clients are usually scripts without a cookie jar
+    client = app.test_client(use_cookies=False)
+    def run_with_ips(requests, ips):
+        start = time.process_time()
+        for num in range(requests):
+            client.post('/update-record', data={'key': key},
+                headers={'X-Forwarded-For': ips[num % len(ips)]})
+        return (time.process_time() - start) / requests
+
+    def run(requests):
+        return (
+            run_with_ips(requests, ['10.0.0.1']),
+            run_with_ips(requests, ['10.0.0.1', '10.0.0.2']),
+        )
+    return run
+
+
+if __name__ == '__main__':
+    main()